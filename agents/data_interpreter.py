@@ -4,6 +4,46 @@ import pandas as pd
 import numpy as np
 import logging
 import config
+import re
+import hashlib
+from functools import lru_cache
+from services.llm_cache import SemanticCache
+
+try:
+    import numba  # noqa: F401 - нужен для engine="numba" в pandas
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Ключевые слова типов анализа - одно сканирование запроса вместо трех
+ANALYSIS_TYPE_RE = re.compile(
+    r"(?P<trend>тренд|динамик|изменен)"
+    r"|(?P<comparison>сравнен|\bvs\b|против)"
+    r"|(?P<anomaly>аномал|отклонен|выброс)",
+    re.IGNORECASE
+)
+ANALYSIS_TYPE_PRIORITY = ("trend", "comparison", "anomaly")
+
+# Рекомендация визуализации в ответе LLM - первое упоминание типа графика
+VISUALIZATION_RE = re.compile(
+    r"(?P<line_chart>линейн)"
+    r"|(?P<pie_chart>кругл)"
+    r"|(?P<scatter_plot>рассеян)",
+    re.IGNORECASE
+)
+
+@lru_cache(maxsize=512)
+def _classify_analysis(query: str, shape: tuple) -> str:
+    """Определяет тип анализа по запросу и размеру данных (кешируется)"""
+    found = {m.lastgroup for m in ANALYSIS_TYPE_RE.finditer(query)}
+    for analysis_type in ANALYSIS_TYPE_PRIORITY:
+        if analysis_type in found:
+            return analysis_type
+    
+    rows, cols = shape
+    if rows <= 5 or cols <= 2:
+        return "simple"
+    return "advanced"
 
 class DataInterpreterAgent:
     def __init__(self):
@@ -13,6 +53,7 @@ class DataInterpreterAgent:
             api_key=config.GIGACHAT_API_KEY
         )
         self.logger = logging.getLogger("data_interpreter")
+        self.llm_cache = SemanticCache(self.llm)
         
     @traceable  # Интеграция с LangSmith
     def analyze(self, df: pd.DataFrame, user_query: str, context: dict) -> dict:
@@ -53,18 +94,7 @@ class DataInterpreterAgent:
 
     def _determine_analysis_type(self, df: pd.DataFrame, query: str) -> str:
         """Определяет тип анализа на основе запроса и данных"""
-        query_lower = query.lower()
-        
-        if any(kw in query_lower for kw in ["тренд", "динамика", "изменение"]):
-            return "trend"
-        elif any(kw in query_lower for kw in ["сравнен", "vs", "против"]):
-            return "comparison"
-        elif any(kw in query_lower for kw in ["аномал", "отклонен", "выброс"]):
-            return "anomaly"
-        elif len(df) <= 5 or len(df.columns) <= 2:
-            return "simple"
-        else:
-            return "advanced"
+        return _classify_analysis(query, df.shape)
 
     def _simple_analysis(self, df: pd.DataFrame, query: str) -> dict:
         """Простой анализ для небольших наборов данных"""
@@ -72,14 +102,12 @@ class DataInterpreterAgent:
         
         # Основные статистики для числовых колонок
         num_cols = df.select_dtypes(include=np.number).columns
-        for col in num_cols:
-            stats = {
-                "min": df[col].min(),
-                "max": df[col].max(),
-                "mean": df[col].mean(),
-                "median": df[col].median()
-            }
-            insights.append(f"**{col}**: min={stats['min']}, max={stats['max']}, avg={stats['mean']:.2f}")
+        if len(num_cols):
+            # Все редукции за один вызов вместо четырех на колонку
+            stats = df[num_cols].agg(["min", "max", "mean"]).to_dict()
+            for col in num_cols:
+                col_stats = stats[col]
+                insights.append(f"**{col}**: min={col_stats['min']}, max={col_stats['max']}, avg={col_stats['mean']:.2f}")
         
         # Форматирование результатов
         response = f"Результаты по запросу '{query}':\n"
@@ -99,15 +127,22 @@ class DataInterpreterAgent:
         if not date_col:
             return self._fallback_analysis(df, query, "Не найдена колонка с датами")
         
-        # Группировка по временным периодам
-        df['period'] = df[date_col].dt.to_period('M')
-        grouped = df.groupby('period').sum(numeric_only=True)
+        # Группировка по месяцам без изменения исходного DataFrame
+        period = df[date_col].to_numpy().astype('datetime64[M]')
+        numeric = df.select_dtypes(include=np.number)
+        if NUMBA_AVAILABLE:
+            grouped = numeric.groupby(period).sum(engine="numba", engine_kwargs={"parallel": True})
+        else:
+            grouped = numeric.groupby(period).sum()
+        grouped.index = grouped.index.strftime("%Y-%m")
+        sample = grouped.head()
+        data_text = self._df_for_prompt(sample, index=True)
         
         # Формируем промпт для LLM
         prompt = f"""Проанализируй временной тренд на основе данных:
         
         Данные (агрегированные по месяцам):
-        {grouped.head().to_markdown()}
+        {data_text}
         
         Запрос пользователя: {query}
         
@@ -117,30 +152,31 @@ class DataInterpreterAgent:
         3. Необычные наблюдения
         """
         
-        analysis = self.llm.generate(prompt)
+        analysis = self._generate_cached(prompt, query, self._cache_namespace("trend", df, data_text))
         
         return {
             "analysis_type": "trend",
             "content": analysis,
-            "data_sample": grouped.head().to_dict(),
+            "data_sample": sample.to_dict(),
             "recommended_visualization": "line_chart"
         }
 
     def _comparison_analysis(self, df: pd.DataFrame, query: str) -> dict:
         """Сравнительный анализ"""
-        prompt = f"""Проведи сравнительный анализ данных:
+        data_text = f"""Первые 5 строк данных:
+        {self._df_for_prompt(df)}
         
-        Первые 5 строк данных:
-        {df.head().to_markdown()}
+        Полный размер данных: {len(df)} строк, {len(df.columns)} колонок"""
+        prompt = f"""Проведи сравнительный анализ данных:
         
-        Полный размер данных: {len(df)} строк, {len(df.columns)} колонок
+        {data_text}
         
         Запрос пользователя: {query}
         
         Сравни основные показатели и выдели ключевые различия.
         """
         
-        analysis = self.llm.generate(prompt)
+        analysis = self._generate_cached(prompt, query, self._cache_namespace("comparison", df, data_text))
         
         return {
             "analysis_type": "comparison",
@@ -153,15 +189,24 @@ class DataInterpreterAgent:
         # Простой метод обнаружения выбросов
         anomalies = []
         num_cols = df.select_dtypes(include=np.number).columns
-        
-        for col in num_cols:
-            q1 = df[col].quantile(0.25)
-            q3 = df[col].quantile(0.75)
+
+        if len(num_cols):
+            # Квартили всех колонок на уровне numpy; NaN-безопасный путь только там, где есть пропуски
+            values = df[num_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+            has_nan = np.isnan(values).any(axis=0)
+            quantiles = np.empty((2, values.shape[1]))
+            if not has_nan.all():
+                quantiles[:, ~has_nan] = np.quantile(values[:, ~has_nan], [0.25, 0.75], axis=0)
+            if has_nan.any():
+                quantiles[:, has_nan] = np.nanquantile(values[:, has_nan], [0.25, 0.75], axis=0)
+            q1, q3 = quantiles
             iqr = q3 - q1
-            outliers = df[(df[col] < (q1 - 1.5 * iqr)) | (df[col] > (q3 + 1.5 * iqr))]
-            
-            if not outliers.empty:
-                anomalies.append(f"**{col}**: {len(outliers)} выбросов")
+
+            # Считаем выбросы без материализации отфильтрованных строк
+            counts = ((values < q1 - 1.5 * iqr) | (values > q3 + 1.5 * iqr)).sum(axis=0)
+            for col, count in zip(num_cols, counts):
+                if count:
+                    anomalies.append(f"**{col}**: {count} выбросов")
         
         # Формируем отчет
         if not anomalies:
@@ -178,6 +223,7 @@ class DataInterpreterAgent:
 
     def _advanced_analysis(self, df: pd.DataFrame, query: str, context: dict) -> dict:
         """Расширенный анализ с использованием LLM"""
+        data_text = self._df_for_prompt(df)
         prompt = f"""Ты senior data analyst. Проанализируй данные и ответь на вопрос.
         
         Контекст:
@@ -185,12 +231,12 @@ class DataInterpreterAgent:
         - Запрос: {query}
         
         Данные (первые 5 строк):
-        {df.head().to_markdown()}
+        {data_text}
         
         Технические характеристики данных:
         - Всего строк: {len(df)}
         - Всего колонок: {len(df.columns)}
-        - Типы данных: {df.dtypes.to_dict()}
+        - Типы данных: {self._dtypes_for_prompt(df)}
         
         Задание:
         1. Сформулируй ключевые инсайты
@@ -199,16 +245,12 @@ class DataInterpreterAgent:
         4. Определи оптимальный способ визуализации
         """
         
-        analysis = self.llm.generate(prompt)
+        namespace = self._cache_namespace("advanced", df, f"{data_text}|{len(df)}|{context.get('schema', 'N/A')}")
+        analysis = self._generate_cached(prompt, query, namespace)
         
         # Извлекаем рекомендации по визуализации
-        visualization = "bar_chart"
-        if "линейный" in analysis.lower():
-            visualization = "line_chart"
-        elif "кругл" in analysis.lower():
-            visualization = "pie_chart"
-        elif "рассеян" in analysis.lower():
-            visualization = "scatter_plot"
+        match = VISUALIZATION_RE.search(analysis)
+        visualization = match.lastgroup if match else "bar_chart"
         
         return {
             "analysis_type": "advanced",
@@ -217,6 +259,41 @@ class DataInterpreterAgent:
             "data_sample": df.head(3).to_dict()
         }
 
+    def _df_for_prompt(self, df: pd.DataFrame, n: int = 5, index: bool = False) -> str:
+        """Компактное CSV-представление первых строк для промпта (меньше токенов, чем markdown)"""
+        return df.head(n).round(4).to_csv(index=index)
+
+    def _dtypes_for_prompt(self, df: pd.DataFrame, limit: int = 30) -> str:
+        """Компактный список типов колонок для промпта"""
+        dtypes = df.dtypes
+        summary = ", ".join(f"{col}:{dtype}" for col, dtype in zip(dtypes.index[:limit], dtypes.iloc[:limit]))
+        if len(dtypes) > limit:
+            summary += f", …+{len(dtypes) - limit} more"
+        return summary
+
+    def _cache_namespace(self, analysis_type: str, df: pd.DataFrame, data_text: str) -> str:
+        """
+        Пространство имен семантического кеша: тип анализа, сигнатура колонок и хеш
+        данных из промпта - разные наборы с одинаковыми колонками не смешиваются
+        """
+        signature = ",".join(f"{col}:{dtype}" for col, dtype in df.dtypes.items())
+        data_hash = hashlib.blake2b(data_text.encode(), digest_size=16).hexdigest()
+        return f"{analysis_type}|{signature}|{data_hash}"
+
+    def _generate_cached(self, prompt: str, query: str, namespace: str) -> str:
+        """
+        Вызывает LLM через семантический кеш. Сопоставляется только вопрос пользователя:
+        данные уже зафиксированы пространством имен, а эмбеддинг всего промпта
+        почти не зависит от чисел в нем
+        """
+        cached = self.llm_cache.lookup(query, namespace)
+        if cached is not None:
+            return cached
+        
+        response = self.llm.generate(prompt)
+        self.llm_cache.remember(query, response, namespace)
+        return response
+
     def _handle_empty_data(self, query: str) -> dict:
         """Обработка случая с пустыми данными"""
         return {
@@ -228,15 +305,16 @@ class DataInterpreterAgent:
 
     def _fallback_analysis(self, df: pd.DataFrame, query: str, reason: str) -> dict:
         """Фолбэк-анализ при проблемах"""
+        data_text = self._df_for_prompt(df)
         prompt = f"""Пользователь запросил: {query}
         Но возникла проблема: {reason}
         
         Данные:
-        {df.head().to_markdown()}
+        {data_text}
         
         Предложи альтернативный анализ или уточняющий вопрос."""
         
-        response = self.llm.generate(prompt)
+        response = self._generate_cached(prompt, query, self._cache_namespace("fallback", df, f"{data_text}|{reason}"))
         return {
             "analysis_type": "fallback",
             "content": response,
@@ -1,25 +1,57 @@
 from langsmith import traceable
 from gigachain import GigaChatModel
-import matplotlib.pyplot as plt
-import seaborn as sns
 import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
 import numpy as np
 import io
 import base64
 import logging
 import config
 import re
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator
+from services.llm_cache import SemanticCache, astream_llm
+
+def _is_measure(dtype) -> bool:
+    """Числовая колонка без флагов: bool не считается числом, как в select_dtypes(include=np.number)"""
+    return is_numeric_dtype(dtype) and not is_bool_dtype(dtype)
+
+@dataclass
+class DataProfile:
+    """Сводка по колонкам DataFrame, общая для всех этапов построения истории"""
+    numeric_cols: list
+    category_cols: list
+    date_cols: list
+    low_card_cols: list  # меньше 10 уникальных значений
+    bar_category_cols: list  # меньше 20 уникальных значений
+    nunique: pd.Series
+    dtypes: pd.Series
+
+# Параметры Pillow: быстрое сжатие важнее размера для превью в чате
+IMAGE_SAVE_OPTIONS = {
+    "png": {"compress_level": 1, "optimize": False},
+    "webp": {"quality": 85, "method": 0},
+}
 
 class DataStorytellerAgent:
-    def __init__(self):
+    def __init__(self, image_format: str = "png"):
         self.llm = GigaChatModel(
             model="GigaChat-Pro",
             temperature=0.7,
             api_key=config.GIGACHAT_API_KEY
         )
         self.logger = logging.getLogger("data_storyteller")
-        self.color_palette = sns.color_palette("viridis")
-        plt.style.use("seaborn-whitegrid")
+        self.llm_cache = SemanticCache(self.llm)
+        # pyplot не потокобезопасен - рисуем в одном фоновом потоке
+        self._plot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storyteller_plot")
+        # Синхронный create_story рисует в вызывающем потоке на той же фигуре -
+        # построение и сохранение графика сериализуются
+        self._plot_lock = threading.Lock()
+        self.image_format = image_format if image_format in IMAGE_SAVE_OPTIONS else "png"
         
     @traceable
     def create_story(self, analysis_result: dict, df: pd.DataFrame, user_query: str) -> dict:
@@ -31,37 +63,149 @@ class DataStorytellerAgent:
         :return: Словарь с текстом истории и визуализациями
         """
         try:
-            # Определяем тип визуализации
-            vis_type = analysis_result.get("recommended_visualization", "auto")
-            if vis_type == "auto":
-                vis_type = self._determine_visualization_type(df, analysis_result["analysis_type"])
+            # Профиль колонок вычисляется один раз для всего пайплайна
+            profile = self._profile(df)
+            vis_type = self._resolve_visualization_type(df, analysis_result, profile)
             
             # Генерируем историю
             narrative = self._generate_narrative(analysis_result, user_query)
             
             # Создаем визуализацию
-            visualization = self._create_visualization(df, vis_type, analysis_result)
+            visualization = self._create_visualization(df, vis_type, analysis_result, profile)
             
-            return {
-                "narrative": narrative,
-                "visualization": visualization,
-                "visualization_type": vis_type,
-                "analysis_type": analysis_result["analysis_type"],
-                "data_sample": df.head(3).to_dict() if not df.empty else {}
-            }
+            return self._build_story(narrative, visualization, vis_type, analysis_result, df)
         except Exception as e:
-            self.logger.error(f"Story creation failed: {str(e)}")
-            return {
-                "error": "story_error",
-                "message": "Не удалось создать визуальную историю",
-                "details": str(e),
-                "fallback_narrative": analysis_result.get("content", "")
-            }
+            return self._story_error(e, analysis_result)
+
+    @traceable
+    async def acreate_story(self, analysis_result: dict, df: pd.DataFrame, user_query: str, stream: bool = False) -> dict:
+        """
+        Асинхронный вариант create_story: генерация текста через LLM и
+        построение графика выполняются параллельно
+        :param analysis_result: Результат от DataInterpreterAgent
+        :param df: Исходный DataFrame с данными
+        :param user_query: Оригинальный запрос пользователя
+        :param stream: Если True, narrative - асинхронный итератор фрагментов текста,
+            а narrative_done - future с полным текстом
+        :return: Словарь с текстом истории и визуализациями
+        """
+        try:
+            profile = self._profile(df)
+            vis_type = self._resolve_visualization_type(df, analysis_result, profile)
+            
+            if stream:
+                return await self._acreate_streaming_story(analysis_result, df, user_query, vis_type, profile)
+            
+            # Запускаем LLM и рисуем график, пока ждем ответ
+            narrative_task = asyncio.create_task(self._agenerate_narrative(analysis_result, user_query))
+            loop = asyncio.get_running_loop()
+            try:
+                visualization = await loop.run_in_executor(
+                    self._plot_executor,
+                    self._create_visualization, df, vis_type, analysis_result, profile
+                )
+            except BaseException:
+                narrative_task.cancel()
+                raise
+            narrative = await narrative_task
+            
+            return self._build_story(narrative, visualization, vis_type, analysis_result, df)
+        except Exception as e:
+            return self._story_error(e, analysis_result)
+
+    async def _acreate_streaming_story(self, analysis_result: dict, df: pd.DataFrame, user_query: str,
+                                       vis_type: str, profile: DataProfile) -> dict:
+        """Строит историю с потоковым текстом: токены LLM копятся, пока рисуется график"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        narrative_done = loop.create_future()
+        
+        async def produce():
+            parts = []
+            try:
+                async for chunk in self._astream_narrative(analysis_result, user_query):
+                    parts.append(chunk)
+                    queue.put_nowait(chunk)
+                narrative_done.set_result("".join(parts))
+            except asyncio.CancelledError:
+                narrative_done.cancel()
+                raise
+            except Exception as e:
+                self.logger.error(f"Narrative streaming failed: {str(e)}")
+                narrative_done.set_exception(e)
+            finally:
+                queue.put_nowait(None)
+        
+        async def narrative() -> AsyncIterator[str]:
+            while (chunk := await queue.get()) is not None:
+                yield chunk
+            # Пробрасываем ошибку генерации вызывающему коду
+            await narrative_done
+        
+        producer = asyncio.create_task(produce())
+        try:
+            visualization = await loop.run_in_executor(
+                self._plot_executor,
+                self._create_visualization, df, vis_type, analysis_result, profile
+            )
+        except BaseException:
+            producer.cancel()
+            raise
+        
+        story = self._build_story(narrative(), visualization, vis_type, analysis_result, df)
+        story["narrative_done"] = narrative_done
+        return story
+
+    def _resolve_visualization_type(self, df: pd.DataFrame, analysis_result: dict, profile: DataProfile) -> str:
+        """Определяет тип визуализации из рекомендации анализа или по данным"""
+        vis_type = analysis_result.get("recommended_visualization", "auto")
+        if vis_type == "auto":
+            vis_type = self._determine_visualization_type(df, analysis_result["analysis_type"], profile)
+        return vis_type
+
+    def _build_story(self, narrative, visualization: dict, vis_type: str, analysis_result: dict, df: pd.DataFrame) -> dict:
+        """Собирает итоговый ответ"""
+        return {
+            "narrative": narrative,
+            "visualization": visualization,
+            "visualization_type": vis_type,
+            "analysis_type": analysis_result["analysis_type"],
+            "data_sample": df.head(3).to_dict() if not df.empty else {}
+        }
+
+    def _story_error(self, error: Exception, analysis_result: dict) -> dict:
+        """Ответ при сбое построения истории"""
+        self.logger.error(f"Story creation failed: {str(error)}")
+        return {
+            "error": "story_error",
+            "message": "Не удалось создать визуальную историю",
+            "details": str(error),
+            "fallback_narrative": analysis_result.get("content", "")
+        }
+
+    def _profile(self, df: pd.DataFrame) -> DataProfile:
+        """
+        Строит профиль колонок DataFrame. Вызывается один раз на историю, дальше профиль
+        передается явно; DataFrame вызывающего кода не изменяется
+        """
+        dtypes = df.dtypes
+        nunique = df.nunique(dropna=False)
+        columns = df.columns
+        profile = DataProfile(
+            numeric_cols=columns[dtypes.map(_is_measure).to_numpy(dtype=bool)].tolist(),
+            category_cols=df.select_dtypes(include='category').columns.tolist(),
+            date_cols=columns[columns.astype(str).str.contains("date", case=False, regex=False)].tolist(),
+            low_card_cols=columns[(nunique < 10).to_numpy()].tolist(),
+            bar_category_cols=columns[(nunique < 20).to_numpy()].tolist(),
+            nunique=nunique,
+            dtypes=dtypes
+        )
+        return profile
 
-    def _determine_visualization_type(self, df: pd.DataFrame, analysis_type: str) -> str:
+    def _determine_visualization_type(self, df: pd.DataFrame, analysis_type: str, profile: DataProfile) -> str:
         """Определяет оптимальный тип визуализации"""
-        num_cols = len(df.select_dtypes(include=np.number).columns)
-        cat_cols = len(df.select_dtypes(include='category').columns)
+        num_cols = len(profile.numeric_cols)
+        cat_cols = len(profile.category_cols)
         
         if analysis_type == "trend":
             return "line_chart"
@@ -81,7 +225,56 @@ class DataStorytellerAgent:
 
     def _generate_narrative(self, analysis: dict, user_query: str) -> str:
         """Генерирует текстовое повествование на основе анализа"""
-        prompt = f"""Ты data storyteller. Создай понятную историю на основе анализа данных.
+        namespace = self._narrative_namespace(analysis)
+        cached = self.llm_cache.lookup(user_query, namespace)
+        if cached is not None:
+            return cached
+        
+        narrative = self.llm.generate(self._narrative_prompt(analysis, user_query))
+        self.llm_cache.remember(user_query, narrative, namespace)
+        return narrative
+
+    async def _agenerate_narrative(self, analysis: dict, user_query: str) -> str:
+        """Асинхронно генерирует текстовое повествование"""
+        namespace = self._narrative_namespace(analysis)
+        cached = await asyncio.to_thread(self.llm_cache.lookup, user_query, namespace)
+        if cached is not None:
+            return cached
+        
+        prompt = self._narrative_prompt(analysis, user_query)
+        if hasattr(self.llm, "agenerate"):
+            narrative = await self.llm.agenerate(prompt)
+        else:
+            narrative = await asyncio.to_thread(self.llm.generate, prompt)
+        await asyncio.to_thread(self.llm_cache.remember, user_query, narrative, namespace)
+        return narrative
+
+    async def _astream_narrative(self, analysis: dict, user_query: str) -> AsyncIterator[str]:
+        """Потоково генерирует текстовое повествование"""
+        namespace = self._narrative_namespace(analysis)
+        cached = await asyncio.to_thread(self.llm_cache.lookup, user_query, namespace)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
+        async for chunk in astream_llm(self.llm, self._narrative_prompt(analysis, user_query)):
+            parts.append(chunk)
+            yield chunk
+        await asyncio.to_thread(self.llm_cache.remember, user_query, "".join(parts), namespace)
+
+    def _narrative_namespace(self, analysis: dict) -> str:
+        """
+        Пространство имен кеша повествований: тип анализа + хеш его результатов.
+        В кеше сопоставляется только запрос пользователя, поэтому истории по разным
+        результатам анализа не должны попадать в одно пространство
+        """
+        content_hash = hashlib.blake2b(str(analysis.get("content", "")).encode(), digest_size=16).hexdigest()
+        return f"narrative|{analysis['analysis_type']}|{content_hash}"
+
+    def _narrative_prompt(self, analysis: dict, user_query: str) -> str:
+        """Формирует промпт для генерации повествования"""
+        return f"""Ты data storyteller. Создай понятную историю на основе анализа данных.
         
         Результаты анализа:
         {analysis['content']}
@@ -102,141 +295,152 @@ class DataStorytellerAgent:
         "На основе вашего запроса о [тема] мы обнаружили, что [ключевой инсайт]. 
         Это проявляется в [пример]. Мы рекомендуем [действие]."
         """
-        
-        return self.llm.generate(prompt)
 
-    def _create_visualization(self, df: pd.DataFrame, vis_type: str, analysis: dict) -> dict:
+    def _create_visualization(self, df: pd.DataFrame, vis_type: str, analysis: dict, profile: DataProfile) -> dict:
         """Создает визуализацию данных"""
         if df.empty:
             return {"type": "text", "content": "Нет данных для визуализации"}
         
+        with self._plot_lock:
+            return self._draw_visualization(df, vis_type, analysis, profile)
+
+    def _draw_visualization(self, df: pd.DataFrame, vis_type: str, analysis: dict, profile: DataProfile) -> dict:
+        """Строит график выбранного типа на общей фигуре (вызывается под _plot_lock)"""
         try:
             if vis_type == "line_chart":
-                return self._create_line_chart(df, analysis)
+                return self._create_line_chart(df, analysis, profile)
             elif vis_type == "bar_chart":
-                return self._create_bar_chart(df, analysis)
+                return self._create_bar_chart(df, analysis, profile)
             elif vis_type == "pie_chart":
-                return self._create_pie_chart(df, analysis)
+                return self._create_pie_chart(df, analysis, profile)
             elif vis_type == "scatter_plot":
-                return self._create_scatter_plot(df, analysis)
+                return self._create_scatter_plot(df, analysis, profile)
             elif vis_type == "histogram":
-                return self._create_histogram(df, analysis)
+                return self._create_histogram(df, analysis, profile)
             elif vis_type == "summary_table":
                 return self._create_summary_table(df, analysis)
             else:
-                return self._create_bar_chart(df, analysis)  # Фолбэк
+                return self._create_bar_chart(df, analysis, profile)  # Фолбэк
         except Exception as e:
             self.logger.warning(f"Visualization failed: {str(e)}")
             return self._create_summary_table(df, analysis)
 
-    def _create_line_chart(self, df: pd.DataFrame, analysis: dict) -> dict:
+    def _create_line_chart(self, df: pd.DataFrame, analysis: dict, profile: DataProfile) -> dict:
         """Создает линейный график для временных рядов"""
         # Ищем колонку с датой
-        date_col = next((col for col in df.columns if "date" in col.lower()), None)
+        date_col = profile.date_cols[0] if profile.date_cols else None
         if not date_col:
             date_col = df.index.name if df.index.name else "index"
         
         # Ищем числовую колонку
-        value_col = next((col for col in df.columns if df[col].dtype in ['int64', 'float64']), None)
+        value_col = profile.numeric_cols[0] if profile.numeric_cols else None
         if not value_col:
             return self._create_summary_table(df, analysis)
         
-        plt.figure(figsize=(10, 6))
+        ax = self._reset_axes()
         
         # Если есть категории для группировки
-        category_col = next((col for col in df.columns if col not in [date_col, value_col] and df[col].nunique() < 10), None)
+        category_col = next((col for col in profile.low_card_cols if col not in (date_col, value_col)), None)
         
         if category_col:
             for i, (name, group) in enumerate(df.groupby(category_col)):
-                plt.plot(group[date_col], group[value_col], 
-                         label=name, color=self.color_palette[i], marker='o')
-            plt.legend(title=category_col)
+                ax.plot(group[date_col], group[value_col], 
+                        label=name, color=self.color_palette[i], marker='o')
+            ax.legend(title=category_col)
         else:
-            plt.plot(df[date_col], df[value_col], color=self.color_palette[0], marker='o')
+            ax.plot(df[date_col], df[value_col], color=self.color_palette[0], marker='o')
         
-        plt.title(analysis.get("title", f'Динамика показателя "{value_col}"'))
-        plt.xlabel(date_col)
-        plt.ylabel(value_col)
-        plt.grid(True)
-        plt.xticks(rotation=45)
+        ax.set_title(analysis.get("title", f'Динамика показателя "{value_col}"'))
+        ax.set_xlabel(date_col)
+        ax.set_ylabel(value_col)
+        ax.grid(True)
+        ax.tick_params(axis='x', labelrotation=45)
         
-        return self._plot_to_base64(plt)
+        return self._plot_to_base64()
 
-    def _create_bar_chart(self, df: pd.DataFrame, analysis: dict) -> dict:
+    def _create_bar_chart(self, df: pd.DataFrame, analysis: dict, profile: DataProfile) -> dict:
         """Создает столбчатую диаграмму"""
         # Ищем категориальную колонку
-        category_col = next((col for col in df.columns if df[col].nunique() < 20), None)
+        category_col = profile.bar_category_cols[0] if profile.bar_category_cols else None
         if not category_col:
             category_col = df.index.name if df.index.name else "index"
         
         # Ищем числовую колонку
-        value_col = next((col for col in df.columns if df[col].dtype in ['int64', 'float64']), None)
-        if not value_col:
-            # Если нет числовой колонки, считаем частоты
-            value_counts = df[category_col].value_counts().reset_index()
-            category_col = "index"
-            value_col = value_counts.columns[1]
-            df = value_counts
+        value_col = profile.numeric_cols[0] if profile.numeric_cols else None
         
-        plt.figure(figsize=(10, 6))
-        sns.barplot(x=category_col, y=value_col, data=df, palette=self.color_palette)
+        if value_col:
+            # Среднее по категории, как оценка по умолчанию в sns.barplot
+            heights = df.groupby(category_col, sort=False)[value_col].mean()
+        else:
+            # Если нет числовой колонки, рисуем частоты топ-20 категорий
+            heights = df[category_col].value_counts().head(20)
+            value_col = "Количество"
+        
+        ax = self._reset_axes()
+        colors = [self.color_palette[i % len(self.color_palette)] for i in range(len(heights))]
+        ax.bar([str(label) for label in heights.index], heights.to_numpy(), color=colors)
         
-        plt.title(analysis.get("title", f'Сравнение по "{category_col}"'))
-        plt.xlabel(category_col)
-        plt.ylabel(value_col)
-        plt.xticks(rotation=45)
+        ax.set_title(analysis.get("title", f'Сравнение по "{category_col}"'))
+        ax.set_xlabel(category_col)
+        ax.set_ylabel(value_col)
+        ax.tick_params(axis='x', labelrotation=45)
         
-        return self._plot_to_base64(plt)
+        return self._plot_to_base64()
 
-    def _create_pie_chart(self, df: pd.DataFrame, analysis: dict) -> dict:
+    def _create_pie_chart(self, df: pd.DataFrame, analysis: dict, profile: DataProfile) -> dict:
         """Создает круговую диаграмму"""
         # Ищем категориальную колонку
-        category_col = next((col for col in df.columns if df[col].nunique() < 10), None)
+        category_col = profile.low_card_cols[0] if profile.low_card_cols else None
         if not category_col:
-            return self._create_bar_chart(df, analysis)
+            return self._create_bar_chart(df, analysis, profile)
         
         counts = df[category_col].value_counts()
         
-        plt.figure(figsize=(8, 8))
-        plt.pie(counts, labels=counts.index, autopct='%1.1f%%', 
-                colors=self.color_palette, startangle=90)
-        plt.title(analysis.get("title", f'Распределение по "{category_col}"'))
+        ax = self._reset_axes(figsize=(8, 8))
+        ax.pie(counts, labels=counts.index, autopct='%1.1f%%', 
+               colors=self.color_palette, startangle=90)
+        ax.set_title(analysis.get("title", f'Распределение по "{category_col}"'))
         
-        return self._plot_to_base64(plt)
+        return self._plot_to_base64()
 
-    def _create_scatter_plot(self, df: pd.DataFrame, analysis: dict) -> dict:
+    def _create_scatter_plot(self, df: pd.DataFrame, analysis: dict, profile: DataProfile) -> dict:
         """Создает диаграмму рассеяния"""
-        num_cols = [col for col in df.columns if df[col].dtype in ['int64', 'float64']]
+        num_cols = profile.numeric_cols
         if len(num_cols) < 2:
             return self._create_summary_table(df, analysis)
         
         x_col, y_col = num_cols[:2]
         
-        plt.figure(figsize=(10, 6))
-        sns.scatterplot(x=x_col, y=y_col, data=df, 
-                        hue=df[num_cols[2]] if len(num_cols) > 2 else None,
-                        palette=self.color_palette)
+        hue_col = num_cols[2] if len(num_cols) > 2 else None
+        
+        ax = self._reset_axes()
+        if hue_col:
+            points = ax.scatter(df[x_col].to_numpy(), df[y_col].to_numpy(),
+                                c=df[hue_col].to_numpy(), cmap="viridis")
+            self._colorbar = self._fig.colorbar(points, ax=ax, label=hue_col)
+        else:
+            ax.scatter(df[x_col].to_numpy(), df[y_col].to_numpy(), color=self.color_palette[0])
         
-        plt.title(analysis.get("title", f'Соотношение "{x_col}" и "{y_col}"'))
-        plt.xlabel(x_col)
-        plt.ylabel(y_col)
+        ax.set_title(analysis.get("title", f'Соотношение "{x_col}" и "{y_col}"'))
+        ax.set_xlabel(x_col)
+        ax.set_ylabel(y_col)
         
-        return self._plot_to_base64(plt)
+        return self._plot_to_base64()
 
-    def _create_histogram(self, df: pd.DataFrame, analysis: dict) -> dict:
+    def _create_histogram(self, df: pd.DataFrame, analysis: dict, profile: DataProfile) -> dict:
         """Создает гистограмму распределения"""
-        num_col = next((col for col in df.columns if df[col].dtype in ['int64', 'float64']), None)
+        num_col = profile.numeric_cols[0] if profile.numeric_cols else None
         if not num_col:
             return self._create_summary_table(df, analysis)
         
-        plt.figure(figsize=(10, 6))
-        sns.histplot(df[num_col], kde=True, color=self.color_palette[0])
+        ax = self._reset_axes()
+        self._sns.histplot(df[num_col], kde=True, color=self.color_palette[0], ax=ax)
         
-        plt.title(analysis.get("title", f'Распределение "{num_col}"'))
-        plt.xlabel(num_col)
-        plt.ylabel("Частота")
+        ax.set_title(analysis.get("title", f'Распределение "{num_col}"'))
+        ax.set_xlabel(num_col)
+        ax.set_ylabel("Частота")
         
-        return self._plot_to_base64(plt)
+        return self._plot_to_base64()
 
     def _create_summary_table(self, df: pd.DataFrame, analysis: dict) -> dict:
         """Создает текстовое представление таблицы"""
@@ -256,15 +460,48 @@ class DataStorytellerAgent:
             "format": "markdown"
         }
 
-    def _plot_to_base64(self, plt) -> dict:
-        """Конвертирует matplotlib plot в base64"""
+    def _ensure_mpl(self):
+        """Лениво загружает matplotlib и seaborn при первом построении графика"""
+        if hasattr(self, "_mpl_ready"):
+            return
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        
+        self._sns = sns
+        self.color_palette = sns.color_palette("viridis")
+        plt.style.use("seaborn-whitegrid")
+        # Одна фигура на агента, очищается перед каждым графиком
+        self._fig, self._ax = plt.subplots(figsize=(10, 6))
+        # Исходная ячейка сетки: colorbar отнимает у основных осей часть места
+        self._ax_spec = self._ax.get_subplotspec()
+        self._colorbar = None
+        self._mpl_ready = True
+
+    def _reset_axes(self, figsize: tuple = (10, 6)):
+        """Очищает общую фигуру агента перед построением нового графика"""
+        self._ensure_mpl()
+        # Убираем colorbar прошлого графика и возвращаем основным осям всю ячейку
+        if self._colorbar is not None:
+            self._colorbar.remove()
+            self._colorbar = None
+            self._ax.set_subplotspec(self._ax_spec)
+        self._ax.clear()
+        self._fig.set_size_inches(*figsize)
+        return self._ax
+
+    def _plot_to_base64(self) -> dict:
+        """Конвертирует текущую фигуру агента в base64"""
         buf = io.BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-        plt.close()
-        buf.seek(0)
-        img_base64 = base64.b64encode(buf.read()).decode('utf-8')
+        self._fig.savefig(
+            buf, format=self.image_format, bbox_inches='tight', dpi=100,
+            pil_kwargs=IMAGE_SAVE_OPTIONS[self.image_format]
+        )
+        img_base64 = base64.b64encode(buf.getbuffer()).decode('utf-8')
         return {
             "type": "image",
             "format": "base64",
+            "mime_type": f"image/{self.image_format}",
             "data": img_base64
         }
\ No newline at end of file
@@ -1,21 +1,132 @@
 from langsmith import traceable
-from gigachain import GigaChatModel
-import requests
+import httpx
+import asyncio
 import json
 import logging
 import config
 import time
+import re
+import threading
+from typing import List, Tuple
+from services.error_store import get_error_store
+from services.llm_cache import ExactCache, get_exact_cache
+from services.http_session import get_http_client
+from services.llm_fallback import build_fallback_llm
+
+# Стратегии, которые может выбрать LLM, и схема ее ответа
+STRATEGIES = (
+    "retry", "retry_after_delay", "simplify_query",
+    "alternative_approach", "escalate_to_human", "inform_user"
+)
+STRATEGY_SCHEMA = {
+    "type": "object",
+    "properties": {"strategy": {"type": "string", "enum": list(STRATEGIES)}},
+    "required": ["strategy"]
+}
+STRATEGY_MAX_RETRIES = 3
+
+# Статичные инструкции идут в начале промпта, данные об ошибке - в конце,
+# чтобы общий префикс переиспользовался кешем промптов провайдера
+_STRATEGY_SYSTEM_PROMPT = f"""Система обработки запросов столкнулась с ошибкой. Определи лучшую стратегию восстановления.
+
+Доступные стратегии:
+1. retry - Повторить операцию немедленно
+2. retry_after_delay - Повторить после паузы (5-15 сек)
+3. simplify_query - Упростить запрос пользователя
+4. alternative_approach - Попробовать альтернативный метод
+5. escalate_to_human - Эскалировать в техническую поддержку
+6. inform_user - Сообщить пользователю об ошибке
+
+Выбери наиболее подходящую стратегию. Верни только JSON по схеме:
+{json.dumps(STRATEGY_SCHEMA, ensure_ascii=False)}
+Пример: {{"strategy": "retry"}}"""
+
+_SIMPLIFY_SYSTEM_PROMPT = """Упрости запрос пользователя для избежания ошибки.
+
+Упрощенный запрос должен:
+1. Сохранить основную суть оригинального запроса
+2. Быть более конкретным
+3. Избегать сложных конструкций
+4. Использовать более простые формулировки"""
+
+_ALTERNATIVE_SYSTEM_PROMPT = """Для запроса пользователя возникла ошибка в одном из компонентов системы.
+Предложи альтернативный подход к обработке запроса без использования этого компонента."""
+
+_INFORM_SYSTEM_PROMPT = """Создай понятное сообщение об ошибке для пользователя.
+
+Требования к сообщению:
+1. Будь вежливым и извинись
+2. Объясни суть проблемы простым языком
+3. Предложи возможные решения
+4. Сообщение должно быть не длиннее 2 предложений"""
+
+# Максимум одновременно обрабатываемых ошибок в handle_errors_batch
+MAX_CONCURRENT_ERRORS = 32
+
+# Ошибка считается повторяющейся, если ее паттерн уже встречался
+# RECURRING_ERROR_COUNT раз за последние RECURRING_ERROR_WINDOW секунд
+RECURRING_ERROR_COUNT = 2
+RECURRING_ERROR_WINDOW = 3600
+
+# Предохранитель LLM: после серии сбоев используем шаблоны, пока проверка не пройдет
+LLM_FAILURE_THRESHOLD = 3
+LLM_PROBE_INTERVAL = 5  # секунд
+LLM_PROBE_SUCCESSES = 3
+
+# Шаблонные ответы при недоступной LLM
+_DEFAULT_USER_MESSAGE = (
+    "Извините, при обработке запроса произошла ошибка. "
+    "Попробуйте повторить его чуть позже или переформулировать."
+)
+
+# Типы ошибок по ключевым словам в сообщении (порядок - приоритет)
+ERROR_TYPE_PATTERNS = [
+    (re.compile(r"sql|syntax", re.IGNORECASE), "sql_error"),
+    (re.compile(r"timeout|timed out", re.IGNORECASE), "timeout"),
+    (re.compile(r"connection|network", re.IGNORECASE), "network_error"),
+    (re.compile(r"auth|access|permission", re.IGNORECASE), "access_denied"),
+    (re.compile(r"not found|no data", re.IGNORECASE), "data_not_found"),
+    (re.compile(r"validation|invalid", re.IGNORECASE), "validation_error"),
+]
+
+# Ключ, под которым в данных об ошибке хранится вычисленный тип
+CLASSIFIED_TYPE_KEY = "_classified_type"
+
+# Стратегии для частых ошибок, не требующие вызова LLM
+STRATEGY_TABLE = {
+    "timeout": "retry",
+    "network_error": "retry_after_delay",
+    "access_denied": "escalate",
+    "data_not_found": "simplify_query",
+}
+
+_JIRA_SYSTEM_PROMPT = """Создай техническое описание ошибки для тикета в Jira.
+
+Включи:
+1. Подробное описание проблемы
+2. Шаги для воспроизведения (если применимо)
+3. Предполагаемую причину
+4. Связанные системные логи (если есть)"""
 
 class FallbackAgent:
     def __init__(self):
-        self.llm = GigaChatModel(
-            model="GigaChat-Pro",
-            temperature=0.3,
-            api_key=config.GIGACHAT_API_KEY
-        )
+        # GigaChat-Pro с переходом на резервные модели при таймауте
+        self.llm = build_fallback_llm("GigaChat-Pro", temperature=0.3)
         self.logger = logging.getLogger("fallback_agent")
-        self.error_history = {}
-        self.strategy_counter = {}
+        # Только точные совпадения: промпты начинаются с длинной статичной инструкции,
+        # и эмбеддинги разных ошибок почти совпадают - семантический поиск подменял бы ответы.
+        # Кеш общий для процесса (агент создается на каждый запрос), ключи - в пространствах "fallback|..."
+        self.response_cache = get_exact_cache()
+        # Пул соединений к Jira и Slack: TLS-рукопожатие не повторяется на каждый вызов (общий пул процесса)
+        self.http = get_http_client()
+        # Async HTTP-клиент эскалации создается при первом использовании
+        self._async_http = None
+        # История ошибок в SQLite: переживает перезапуск и видна всем процессам
+        self.error_store = get_error_store(retention=RECURRING_ERROR_WINDOW)
+        # Состояние предохранителя LLM
+        self._llm_failures = 0
+        self._probe_lock = threading.Lock()
+        self._probe_running = False
         
     @traceable
     def handle_error(self, error_data: dict, original_request: dict) -> dict:
@@ -26,78 +137,72 @@ class FallbackAgent:
         :return: Решение по обработке ошибки
         """
         try:
-            # Анализ ошибки
-            error_type = self._classify_error(error_data)
-            error_id = self._generate_error_id(error_data)
+            # Анализ ошибки: тип вычисляется один раз и переиспользуется всеми шагами
+            error_data = self._with_error_type(error_data)
+            error_type = error_data[CLASSIFIED_TYPE_KEY]
+            now_ts = int(time.time())
+            error_id = self._generate_error_id(error_data, error_type, now_ts)
             
             # Проверка на повторяющиеся ошибки
-            if self._is_recurring_error(error_id):
+            if self._is_recurring_error(error_id, now_ts):
                 return self._handle_recurring_error(error_id, error_data, original_request)
             
             # Определение стратегии
             strategy = self._determine_strategy(error_type, error_data, original_request)
             
             # Регистрация ошибки
-            self._register_error(error_id, error_data, strategy)
+            self._register_error(error_id, error_data, strategy, now_ts)
             
             # Выполнение стратегии
             return self._execute_strategy(strategy, error_data, original_request)
             
         except Exception as e:
-            self.logger.critical(f"Fallback failure: {str(e)}")
+            self.logger.critical("Fallback failure: %s", e)
             return self._critical_fallback(original_request)
 
     def _classify_error(self, error_data: dict) -> str:
         """Классифицирует тип ошибки"""
-        error_msg = error_data.get("message", "").lower()
+        # Тип уже вычислен в handle_error
+        error_type = error_data.get(CLASSIFIED_TYPE_KEY)
+        if error_type:
+            return error_type
+        
+        error_msg = error_data.get("message", "")
         
         # Определение типа ошибки по ключевым словам
-        if "sql" in error_msg or "syntax" in error_msg:
-            return "sql_error"
-        elif "timeout" in error_msg or "timed out" in error_msg:
-            return "timeout"
-        elif "connection" in error_msg or "network" in error_msg:
-            return "network_error"
-        elif "auth" in error_msg or "access" in error_msg or "permission" in error_msg:
-            return "access_denied"
-        elif "not found" in error_msg or "no data" in error_msg:
-            return "data_not_found"
-        elif "validation" in error_msg or "invalid" in error_msg:
-            return "validation_error"
-        else:
-            return "unknown_error"
+        for pattern, error_type in ERROR_TYPE_PATTERNS:
+            if pattern.search(error_msg):
+                return error_type
+        return "unknown_error"
+
+    def _with_error_type(self, error_data: dict) -> dict:
+        """Возвращает копию данных об ошибке с вычисленным типом"""
+        return {**error_data, CLASSIFIED_TYPE_KEY: self._classify_error(error_data)}
 
-    def _generate_error_id(self, error_data: dict) -> str:
+    def _generate_error_id(self, error_data: dict, error_type: str, timestamp: int) -> str:
         """Генерирует уникальный ID ошибки"""
-        error_type = self._classify_error(error_data)
         component = error_data.get("component", "unknown")
-        timestamp = int(time.time())
         return f"ERR-{error_type[:3]}-{component[:3]}-{timestamp}"
 
-    def _is_recurring_error(self, error_id: str) -> bool:
+    def _is_recurring_error(self, error_id: str, now_ts: int) -> bool:
         """Проверяет, повторяется ли ошибка"""
-        # Упрощенная проверка по базовому паттерну (без полного ID)
-        error_pattern = error_id.split('-')[:3]
-        pattern_key = '-'.join(error_pattern)
-        
-        # Счетчик повторений
-        count = self.strategy_counter.get(pattern_key, 0)
-        return count >= 2  # Если ошибка повторилась более 2 раз
+        # Упрощенная проверка по базовому паттерну (без полного ID) за последний час
+        since = now_ts - RECURRING_ERROR_WINDOW
+        return self.error_store.count_since(self._pattern_key(error_id), since) >= RECURRING_ERROR_COUNT
+
+    def _pattern_key(self, error_id: str) -> str:
+        """Паттерн ошибки: тип и компонент, без времени"""
+        return '-'.join(error_id.split('-')[:3])
 
     def _determine_strategy(self, error_type: str, error_data: dict, request: dict) -> str:
         """Определяет стратегию восстановления"""
         # Простые правила для частых ошибок
-        if error_type == "timeout":
-            return "retry"
-        elif error_type == "network_error":
-            return "retry_after_delay"
-        elif error_type == "access_denied":
-            return "escalate"
-        elif error_type == "data_not_found":
-            return "simplify_query"
+        strategy = STRATEGY_TABLE.get(error_type)
+        if strategy:
+            return strategy
         
         # Для сложных случаев используем LLM
-        prompt = f"""Система обработки запросов столкнулась с ошибкой. Определи лучшую стратегию восстановления.
+        prompt = f"""{_STRATEGY_SYSTEM_PROMPT}
 
 Детали ошибки:
 - Тип: {error_type}
@@ -107,20 +212,125 @@ class FallbackAgent:
 
 Оригинальный запрос пользователя:
 {request.get('text', '')}
+"""
+        
+        # В кеш попадает только стратегия, прошедшая проверку, а не сырой ответ модели
+        key = self._cache_key(prompt, "fallback|strategy", {"response_format": "json"})
+        strategy = self.response_cache.get(key)
+        if strategy:
+            return strategy
+        
+        default = json.dumps({"strategy": "inform_user"})
+        for _ in range(STRATEGY_MAX_RETRIES + 1):
+            response = self._safe_generate(
+                prompt, "fallback|strategy", default=default, use_cache=False, response_format="json"
+            )
+            strategy = self._parse_strategy(response)
+            if strategy:
+                # Шаблон при открытом предохранителе не кешируем
+                if response is not default:
+                    self.response_cache.set(key, strategy)
+                return strategy
+            # Повтор сразу: пауза на пути запроса только задержала бы ответ пользователю
+            self.logger.warning("Invalid strategy response: %.100s", response)
+        
+        return "inform_user"
 
-Доступные стратегии:
-1. retry - Повторить операцию немедленно
-2. retry_after_delay - Повторить после паузы (5-15 сек)
-3. simplify_query - Упростить запрос пользователя
-4. alternative_approach - Попробовать альтернативный метод
-5. escalate_to_human - Эскалировать в техническую поддержку
-6. inform_user - Сообщить пользователю об ошибке
+    def _parse_strategy(self, response: str) -> str:
+        """Извлекает стратегию из JSON-ответа LLM, None если ответ некорректен"""
+        try:
+            result = json.loads(response)
+            strategy = result.get("strategy") if isinstance(result, dict) else None
+        except (json.JSONDecodeError, TypeError):
+            # Модель могла вернуть только название стратегии
+            strategy = response.strip().strip('"')
+        
+        if isinstance(strategy, str) and strategy.lower() in STRATEGIES:
+            return strategy.lower()
+        return None
 
-Выбери наиболее подходящую стратегию. Ответ должен содержать только название стратегии.
-"""
+    def _safe_generate(self, prompt: str, namespace: str, default: str, use_cache: bool = True, **kwargs) -> str:
+        """
+        Вызывает LLM через кеш с предохранителем
+        После LLM_FAILURE_THRESHOLD сбоев подряд сразу возвращает шаблон,
+        пока фоновая проверка не подтвердит доступность модели
+        :param prompt: Промпт для LLM
+        :param namespace: Пространство имен кеша ответов
+        :param default: Шаблонный ответ при недоступной LLM
+        :param use_cache: False - вызвать LLM в обход кеша
+        :param kwargs: Дополнительные параметры для generate
+        :return: Ответ LLM или шаблон
+        """
+        if self._llm_failures >= LLM_FAILURE_THRESHOLD:
+            self._start_health_probe()
+            return default
         
-        response = self.llm.generate(prompt)
-        return response.strip().lower()
+        try:
+            if use_cache:
+                response = self._cached_generate(prompt, namespace, **kwargs)
+            else:
+                response = self.llm.generate(prompt, **kwargs)
+        except Exception as e:
+            self._llm_failures += 1
+            self.logger.warning("LLM call failed (%d in a row): %s", self._llm_failures, e)
+            if self._llm_failures >= LLM_FAILURE_THRESHOLD:
+                self._start_health_probe()
+            return default
+        
+        self._llm_failures = 0
+        return response
+
+    def _cached_generate(self, prompt: str, namespace: str, **kwargs) -> str:
+        """Вызывает LLM через кеш точных совпадений промпта"""
+        key = self._cache_key(prompt, namespace, kwargs)
+        response = self.response_cache.get(key)
+        if response is None:
+            response = self.llm.generate(prompt, **kwargs)
+            self.response_cache.set(key, response)
+        return response
+
+    async def _acached_generate(self, prompt: str, namespace: str, **kwargs) -> str:
+        """Асинхронный вариант _cached_generate"""
+        key = self._cache_key(prompt, namespace, kwargs)
+        response = self.response_cache.get(key)
+        if response is None:
+            if hasattr(self.llm, "agenerate"):
+                response = await self.llm.agenerate(prompt, **kwargs)
+            else:
+                response = await asyncio.to_thread(self.llm.generate, prompt, **kwargs)
+            self.response_cache.set(key, response)
+        return response
+
+    def _cache_key(self, prompt: str, namespace: str, kwargs: dict) -> str:
+        """Ключ кеша: пространство имен, параметры вызова и полный промпт"""
+        if kwargs:
+            namespace = f"{namespace}|{sorted(kwargs.items())}"
+        return ExactCache.make_key(namespace, prompt)
+
+    def _start_health_probe(self):
+        """Запускает фоновую проверку LLM, если она еще не запущена"""
+        with self._probe_lock:
+            if self._probe_running:
+                return
+            self._probe_running = True
+        self.logger.error("LLM circuit open, using template responses")
+        threading.Thread(target=self._llm_health_probe, name="fallback_llm_probe", daemon=True).start()
+
+    def _llm_health_probe(self):
+        """Пингует LLM, пока не будет LLM_PROBE_SUCCESSES успешных ответов подряд"""
+        successes = 0
+        while successes < LLM_PROBE_SUCCESSES:
+            time.sleep(LLM_PROBE_INTERVAL)
+            try:
+                self.llm.generate("ping")
+                successes += 1
+            except Exception:
+                successes = 0
+        
+        self._llm_failures = 0
+        with self._probe_lock:
+            self._probe_running = False
+        self.logger.info("LLM circuit closed, live responses restored")
 
     def _execute_strategy(self, strategy: str, error_data: dict, request: dict) -> dict:
         """Выполняет выбранную стратегию"""
@@ -140,7 +350,7 @@ class FallbackAgent:
     def _retry_strategy(self, error_data: dict, request: dict) -> dict:
         """Стратегия немедленного повтора"""
         component = error_data.get("component")
-        self.logger.info(f"Retrying operation for {component}")
+        self.logger.info("Retrying operation for %s", component)
         
         return {
             "strategy": "retry",
@@ -156,7 +366,7 @@ class FallbackAgent:
     def _delayed_retry_strategy(self, error_data: dict, request: dict) -> dict:
         """Стратегия повтора с задержкой"""
         delay = 10  # секунд
-        self.logger.info(f"Scheduling retry after {delay} seconds")
+        self.logger.info("Scheduling retry after %s seconds", delay)
         
         return {
             "strategy": "retry_after_delay",
@@ -173,20 +383,14 @@ class FallbackAgent:
         """Стратегия упрощения запроса"""
         original_query = request.get("text", "")
         
-        prompt = f"""Упрости запрос пользователя для избежания ошибки:
-        
+        prompt = f"""{_SIMPLIFY_SYSTEM_PROMPT}
+
 Оригинальный запрос: {original_query}
 Ошибка: {error_data.get('message', 'Нет дополнительной информации')}
 
-Упрощенный запрос должен:
-1. Сохранить основную суть оригинального запроса
-2. Быть более конкретным
-3. Избегать сложных конструкций
-4. Использовать более простые формулировки
-
 Упрощенный запрос:"""
         
-        simplified_query = self.llm.generate(prompt)
+        simplified_query = self._safe_generate(prompt, "fallback|simplify", default=original_query)
         
         return {
             "strategy": "simplify_query",
@@ -202,15 +406,18 @@ class FallbackAgent:
         component = error_data.get("component")
         original_query = request.get("text", "")
         
-        prompt = f"""Для запроса пользователя возникла ошибка в компоненте {component}. 
-Предложи альтернативный подход к обработке запроса без использования этого компонента.
+        prompt = f"""{_ALTERNATIVE_SYSTEM_PROMPT}
 
+Компонент: {component}
 Оригинальный запрос: {original_query}
 Ошибка: {error_data.get('message')}
 
 Альтернативный подход:"""
         
-        approach = self.llm.generate(prompt)
+        approach = self._safe_generate(
+            prompt, "fallback|alternative",
+            default=f"Обработать запрос без использования компонента {component}"
+        )
         
         return {
             "strategy": "alternative_approach",
@@ -229,38 +436,21 @@ class FallbackAgent:
         # Отправляем уведомление в Slack
         self._notify_slack(error_data, ticket_id)
         
-        return {
-            "strategy": "escalate_to_human",
-            "action": {
-                "type": "create_ticket",
-                "ticket_id": ticket_id,
-                "system": "Jira"
-            },
-            "user_message": (
-                "Произошла сложная ошибка. Наша команда уже уведомлена. "
-                f"Тикет: #{ticket_id}. Приносим извинения за неудобства!"
-            )
-        }
+        return self._escalation_result(ticket_id)
 
     def _inform_user_strategy(self, error_data: dict, request: dict) -> dict:
         """Стратегия информирования пользователя"""
         error_type = self._classify_error(error_data)
         
         # Генерация понятного сообщения об ошибке
-        prompt = f"""Создай понятное сообщение об ошибке для пользователя:
-        
+        prompt = f"""{_INFORM_SYSTEM_PROMPT}
+
 Тип ошибки: {error_type}
 Техническое сообщение: {error_data.get('message', 'Нет дополнительной информации')}
 
-Требования к сообщению:
-1. Будь вежливым и извинись
-2. Объясни суть проблемы простым языком
-3. Предложи возможные решения
-4. Сообщение должно быть не длиннее 2 предложений
-
 Сообщение пользователю:"""
         
-        user_message = self.llm.generate(prompt)
+        user_message = self._safe_generate(prompt, "fallback|inform", default=_DEFAULT_USER_MESSAGE)
         
         return {
             "strategy": "inform_user",
@@ -270,129 +460,147 @@ class FallbackAgent:
             "user_message": user_message
         }
 
-    def _register_error(self, error_id: str, error_data: dict, strategy: str):
+    def _register_error(self, error_id: str, error_data: dict, strategy: str, timestamp: int):
         """Регистрирует ошибку в истории"""
-        # Упрощенный ключ для группировки похожих ошибок
-        pattern_key = '-'.join(error_id.split('-')[:3])
-        
-        # Обновляем счетчик
-        self.strategy_counter[pattern_key] = self.strategy_counter.get(pattern_key, 0) + 1
-        
-        # Сохраняем детали ошибки
-        self.error_history[error_id] = {
-            "timestamp": int(time.time()),
-            "error_data": error_data,
-            "strategy": strategy,
-            "resolved": False
-        }
+        self.error_store.record(
+            error_id,
+            self._pattern_key(error_id),
+            timestamp,
+            self._classify_error(error_data),
+            error_data.get("component", "unknown"),
+            strategy
+        )
         
-        self.logger.warning(f"Error registered: {error_id}, strategy: {strategy}")
+        self.logger.warning("Error registered: %s, strategy: %s", error_id, strategy)
 
     def _create_jira_ticket(self, error_data: dict, request: dict) -> str:
         """Создает тикет в Jira"""
         try:
             # Формирование описания ошибки
-            prompt = f"""Создай техническое описание ошибки для тикета в Jira:
+            prompt = self._jira_prompt(error_data, request)
+            description = self._cached_generate(prompt, "fallback|jira")
             
-Ошибка в компоненте: {error_data.get('component', 'unknown')}
-Тип ошибки: {self._classify_error(error_data)}
-Сообщение: {error_data.get('message', 'Нет сообщения')}
-Статус код: {error_data.get('status_code', 'N/A')}
-
-Запрос пользователя: {request.get('text', '')}
-
-Включи:
-1. Подробное описание проблемы
-2. Шаги для воспроизведения (если применимо)
-3. Предполагаемую причину
-4. Связанные системные логи (если есть)
-"""
-            description = self.llm.generate(prompt)
-            
-            payload = {
-                "fields": {
-                    "project": {"key": config.JIRA_PROJECT_KEY},
-                    "summary": f"[AI System] {error_data.get('component')} Error: {self._classify_error(error_data)}",
-                    "description": description,
-                    "issuetype": {"name": "Bug"},
-                    "priority": {"name": "High"},
-                    "labels": ["ai_system", "fallback"]
-                }
-            }
-            
-            response = requests.post(
+            response = self.http.post(
                 f"{config.JIRA_BASE_URL}/rest/api/2/issue",
-                json=payload,
-                auth=(config.JIRA_USER, config.JIRA_API_TOKEN),
-                headers={"Content-Type": "application/json"}
+                json=self._jira_payload(error_data, description),
+                auth=(config.JIRA_USER, config.JIRA_API_TOKEN)
             )
             
             if response.status_code == 201:
                 return response.json().get("key", "UNKNOWN-001")
             else:
-                self.logger.error(f"Jira create failed: {response.text}")
+                self.logger.error("Jira create failed: %s", response.text)
                 return "FAILED-" + str(int(time.time()))
                 
         except Exception as e:
-            self.logger.error(f"Jira integration error: {str(e)}")
+            self.logger.error("Jira integration error: %s", e)
             return "ERROR-" + str(int(time.time()))
 
+    def _jira_prompt(self, error_data: dict, request: dict) -> str:
+        """Формирует промпт для описания тикета"""
+        return f"""{_JIRA_SYSTEM_PROMPT}
+
+Ошибка в компоненте: {error_data.get('component', 'unknown')}
+Тип ошибки: {self._classify_error(error_data)}
+Сообщение: {error_data.get('message', 'Нет сообщения')}
+Статус код: {error_data.get('status_code', 'N/A')}
+
+Запрос пользователя: {request.get('text', '')}
+"""
+
+    def _jira_payload(self, error_data: dict, description: str) -> dict:
+        """Формирует тело запроса на создание тикета"""
+        return {
+            "fields": {
+                "project": {"key": config.JIRA_PROJECT_KEY},
+                "summary": f"[AI System] {error_data.get('component')} Error: {self._classify_error(error_data)}",
+                "description": description,
+                "issuetype": {"name": "Bug"},
+                "priority": {"name": "High"},
+                "labels": ["ai_system", "fallback"]
+            }
+        }
+
     def _notify_slack(self, error_data: dict, ticket_id: str):
         """Отправляет уведомление в Slack"""
         try:
-            message = {
-                "text": f":fire: *Critical System Error* :fire:",
-                "blocks": [
-                    {
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": f"*{error_data.get('component', 'Unknown')}* encountered an error!"
-                        }
-                    },
-                    {
-                        "type": "section",
-                        "fields": [
-                            {"type": "mrkdwn", "text": f"*Type:*\n{self._classify_error(error_data)}"},
-                            {"type": "mrkdwn", "text": f"*Ticket:*\n{ticket_id}"},
-                            {"type": "mrkdwn", "text": f"*Message:*\n{error_data.get('message', 'No details')}"}
-                        ]
-                    },
-                    {
-                        "type": "divider"
-                    },
-                    {
-                        "type": "actions",
-                        "elements": [
-                            {
-                                "type": "button",
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "View in Jira"
-                                },
-                                "url": f"{config.JIRA_BASE_URL}/browse/{ticket_id}"
-                            }
-                        ]
-                    }
-                ]
-            }
-            
-            requests.post(config.SLACK_WEBHOOK_URL, json=message)
-            
+            self.http.post(config.SLACK_WEBHOOK_URL, json=self._slack_message(error_data, ticket_id))
         except Exception as e:
-            self.logger.error(f"Slack notification failed: {str(e)}")
+            self.logger.error("Slack notification failed: %s", e)
+
+    def _slack_message(self, error_data: dict, ticket_id: str) -> dict:
+        """Формирует уведомление для Slack"""
+        return {
+            "text": f":fire: *Critical System Error* :fire:",
+            "blocks": [
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": f"*{error_data.get('component', 'Unknown')}* encountered an error!"
+                    }
+                },
+                {
+                    "type": "section",
+                    "fields": [
+                        {"type": "mrkdwn", "text": f"*Type:*\n{self._classify_error(error_data)}"},
+                        {"type": "mrkdwn", "text": f"*Ticket:*\n{ticket_id}"},
+                        {"type": "mrkdwn", "text": f"*Message:*\n{error_data.get('message', 'No details')}"}
+                    ]
+                },
+                {
+                    "type": "divider"
+                },
+                {
+                    "type": "actions",
+                    "elements": [
+                        {
+                            "type": "button",
+                            "text": {
+                                "type": "plain_text",
+                                "text": "View in Jira"
+                            },
+                            "url": f"{config.JIRA_BASE_URL}/browse/{ticket_id}"
+                        }
+                    ]
+                }
+            ]
+        }
 
     def _handle_recurring_error(self, error_id: str, error_data: dict, request: dict) -> dict:
         """Обрабатывает повторяющиеся ошибки"""
-        self.logger.error(f"Recurring error detected: {error_id}")
+        self.logger.error("Recurring error detected: %s", error_id)
         
         # Эскалация в Jira с высоким приоритетом
         ticket_id = self._create_jira_ticket(error_data, request)
-        self._notify_slack({
+        self._notify_slack(self._recurring_error_data(error_data), ticket_id)
+        
+        return self._recurring_result(ticket_id)
+
+    def _recurring_error_data(self, error_data: dict) -> dict:
+        """Помечает ошибку как повторяющуюся для уведомления"""
+        return {
             **error_data,
             "message": f"RECURRING ERROR: {error_data.get('message')}"
-        }, ticket_id)
-        
+        }
+
+    def _escalation_result(self, ticket_id: str) -> dict:
+        """Ответ стратегии эскалации"""
+        return {
+            "strategy": "escalate_to_human",
+            "action": {
+                "type": "create_ticket",
+                "ticket_id": ticket_id,
+                "system": "Jira"
+            },
+            "user_message": (
+                "Произошла сложная ошибка. Наша команда уже уведомлена. "
+                f"Тикет: #{ticket_id}. Приносим извинения за неудобства!"
+            )
+        }
+
+    def _recurring_result(self, ticket_id: str) -> dict:
+        """Ответ при повторяющейся ошибке"""
         return {
             "strategy": "escalate_recurring",
             "action": {
@@ -405,6 +613,102 @@ class FallbackAgent:
             )
         }
 
+    async def handle_error_async(self, error_data: dict, original_request: dict) -> dict:
+        """
+        Асинхронный вариант handle_error: эскалация в Jira и Slack
+        не блокирует event loop
+        :param error_data: Данные об ошибке
+        :param original_request: Оригинальный запрос пользователя
+        :return: Решение по обработке ошибки
+        """
+        try:
+            error_data = self._with_error_type(error_data)
+            error_type = error_data[CLASSIFIED_TYPE_KEY]
+            now_ts = int(time.time())
+            error_id = self._generate_error_id(error_data, error_type, now_ts)
+            
+            if self._is_recurring_error(error_id, now_ts):
+                return await self._handle_recurring_error_async(error_id, error_data, original_request)
+            
+            strategy = await asyncio.to_thread(self._determine_strategy, error_type, error_data, original_request)
+            self._register_error(error_id, error_data, strategy, now_ts)
+            
+            if strategy == "escalate_to_human":
+                return await self._escalation_strategy_async(error_data, original_request)
+            return await asyncio.to_thread(self._execute_strategy, strategy, error_data, original_request)
+            
+        except Exception as e:
+            self.logger.critical("Fallback failure: %s", e)
+            return self._critical_fallback(original_request)
+
+    async def handle_errors_batch(self, errors: List[Tuple[dict, dict]]) -> List[dict]:
+        """
+        Обрабатывает пачку ошибок конкурентно
+        :param errors: Список пар (error_data, original_request)
+        :return: Решения в порядке входного списка
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_ERRORS)
+        
+        async def handle(error_data: dict, request: dict) -> dict:
+            async with semaphore:
+                return await self.handle_error_async(error_data, request)
+        
+        return await asyncio.gather(*(handle(error_data, request) for error_data, request in errors))
+
+    async def _escalation_strategy_async(self, error_data: dict, request: dict) -> dict:
+        """Асинхронная стратегия эскалации к человеку"""
+        ticket_id = await self._acreate_jira_ticket(error_data, request)
+        await self._anotify_slack(error_data, ticket_id)
+        return self._escalation_result(ticket_id)
+
+    async def _handle_recurring_error_async(self, error_id: str, error_data: dict, request: dict) -> dict:
+        """Асинхронно обрабатывает повторяющиеся ошибки"""
+        self.logger.error("Recurring error detected: %s", error_id)
+        
+        ticket_id = await self._acreate_jira_ticket(error_data, request)
+        await self._anotify_slack(self._recurring_error_data(error_data), ticket_id)
+        return self._recurring_result(ticket_id)
+
+    async def _acreate_jira_ticket(self, error_data: dict, request: dict) -> str:
+        """Асинхронно создает тикет в Jira"""
+        try:
+            description = await self._acached_generate(self._jira_prompt(error_data, request), "fallback|jira")
+            
+            response = await self._get_async_http().post(
+                f"{config.JIRA_BASE_URL}/rest/api/2/issue",
+                json=self._jira_payload(error_data, description),
+                auth=(config.JIRA_USER, config.JIRA_API_TOKEN)
+            )
+            if response.status_code == 201:
+                return response.json().get("key", "UNKNOWN-001")
+            self.logger.error("Jira create failed: %s", response.text)
+            return "FAILED-" + str(int(time.time()))
+                
+        except Exception as e:
+            self.logger.error("Jira integration error: %s", e)
+            return "ERROR-" + str(int(time.time()))
+
+    async def _anotify_slack(self, error_data: dict, ticket_id: str):
+        """Асинхронно отправляет уведомление в Slack"""
+        try:
+            await self._get_async_http().post(config.SLACK_WEBHOOK_URL, json=self._slack_message(error_data, ticket_id))
+        except Exception as e:
+            self.logger.error("Slack notification failed: %s", e)
+
+    def _get_async_http(self) -> httpx.AsyncClient:
+        """Лениво создает общий async HTTP-клиент для Jira и Slack"""
+        if self._async_http is None or self._async_http.is_closed:
+            self._async_http = httpx.AsyncClient(
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+            )
+        return self._async_http
+
+    async def aclose(self):
+        """Закрывает async HTTP-клиент"""
+        if self._async_http is not None and not self._async_http.is_closed:
+            await self._async_http.aclose()
+
     def _critical_fallback(self, request: dict) -> dict:
         """Аварийный фолбэк при сбое самого FallbackAgent"""
         return {
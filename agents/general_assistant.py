@@ -1,23 +1,155 @@
 from langsmith import traceable
-from gigachain import GigaChatModel
-import requests
 import json
 import logging
 import config
 import re
+import random
+import time
 import datetime
-from typing import List, Dict
+from collections import defaultdict
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+from services.llm_cache import SemanticCache
+from services.http_session import get_http_client
+from services.llm_fallback import build_fallback_llm
+
+try:
+    import tiktoken
+    _TOKENIZER = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _TOKENIZER = None
+
+try:
+    from sklearn.cluster import MiniBatchKMeans
+    SKLEARN_AVAILABLE = True
+except ImportError:
+    SKLEARN_AVAILABLE = False
+
+# Бюджет истории диалога в промпте определения тем
+MAX_HISTORY_TOKENS = 1500
+CHARS_PER_TOKEN = 4  # оценка без tiktoken
+SUMMARY_REFRESH_TURNS = 10  # новых реплик до пересчета сводки
+
+# Темы диалога: число кластеров и сколько последних реплик кластеризуется
+TOPIC_CLUSTERS = 3
+TOPIC_HISTORY_MESSAGES = 50
+
+# Как часто пересчитывается текущая дата (секунд)
+CURRENT_DATE_REFRESH = 60
+
+# Время жизни погоды и новостей компании в кеше (секунд)
+EXTERNAL_DATA_TTL = 600
+
+# Статичные инструкции идут в начале промпта, данные запроса - в конце,
+# чтобы общий префикс переиспользовался кешем промптов провайдера
+# Типы запросов по ключевым словам - одно сканирование запроса вместо пяти
+# (применяется к запросу после casefold)
+QUERY_TYPE_RE = re.compile(
+    r"(?P<greeting>привет|здравствуй|добрый|хай|здорово)"
+    r"|(?P<system_info>версия|обнов|дата релиза|сборк|статус)"
+    r"|(?P<small_talk>как дела|как жизнь|настроени|погод|новост)"
+    r"|(?P<contextual>напомни|что говорил|ранее|в прошлый раз)"
+    r"|(?P<complex_task>объясни|расскажи|сравни|проанализируй)"
+)
+QUERY_TYPE_PRIORITY = ("greeting", "system_info", "small_talk", "contextual", "complex_task")
+
+# Подписи ролей в истории диалога
+_ROLE_LABELS = {"user": "User", "assistant": "Assistant", "system": "System"}
+
+# Готовые ответы на приветствия и вопросы о делах
+_GREETINGS = (
+    "Привет! Чем могу помочь?",
+    "Здравствуйте! Готов помочь с аналитикой и не только.",
+    "Приветствую! Как ваши дела сегодня?",
+    "Рад вас видеть! Что вас интересует?",
+    "Добрый день! Чем займемся сегодня?"
+)
+_HOW_ARE_YOU_RESPONSES = (
+    "У меня всё отлично, работаю на полную мощность!",
+    "Как у цифрового помощника - прекрасно! Готов помогать вам.",
+    "Лучше не бывает, особенно когда могу помочь вам!",
+    "Все системы функционируют нормально, спасибо, что спросили!"
+)
+
+# Форматирование сложных ответов: нумерация -> маркеры и выделение ключевых терминов за один проход
+COMPLEX_FORMAT_RE = re.compile(r"(\n\d+\.\s)|(Важно:|Ключевое:|Рекомендация:)")
+# Первые 5 предложений (совпадает, только если предложений больше 5)
+FIRST_SENTENCES_RE = re.compile(r"(?:.*?\. ){5}", re.DOTALL)
+
+_CONTEXTUAL_SYSTEM_PROMPT = """Ты интеллектуальный помощник. Ответь на запрос пользователя, используя контекст.
+
+Ответ должен быть:
+- Максимально полезным
+- Учитывать историю диалога
+- Вежливым и дружелюбным
+- Не более 3 предложений"""
+
+_COMPLEX_TASK_SYSTEM_PROMPT = """Ты старший аналитик компании {company}.
+Ответь на сложный запрос пользователя, следуя инструкциям.
+
+Структура ответа:
+1. Краткое резюме сути запроса
+2. Пошаговое объяснение/решение
+3. Ключевые выводы
+4. Рекомендации (если применимо)
+5. Дополнительные ресурсы (если нужны)
+
+Используй профессиональный, но доступный язык. Допустимы маркированные списки."""
+
+_TOPICS_SYSTEM_PROMPT = """Определи основные темы в истории диалога.
+Выведи только список тем через запятую, без дополнительного текста."""
+
+# Словарь тем: центр каждого кластера реплик сопоставляется ближайшей метке
+_TOPIC_LABELS = (
+    "продажи", "выручка", "прибыль", "расходы", "бюджет",
+    "маркетинг", "реклама", "клиенты", "заказы", "доставка",
+    "склад", "закупки", "поставщики", "цены", "скидки",
+    "отчетность", "аналитика", "прогноз", "KPI", "конверсия",
+    "персонал", "зарплата", "найм", "обучение", "отпуск",
+    "финансы", "налоги", "бухгалтерия", "платежи", "договоры",
+    "проекты", "сроки", "задачи", "встречи", "планирование",
+    "IT-инфраструктура", "база данных", "доступы", "безопасность", "интеграции",
+    "документация", "инструкции", "ошибки системы", "поддержка", "обновления",
+    "погода", "новости компании", "приветствие", "качество", "стратегия"
+)
+
+_SUMMARY_SYSTEM_PROMPT = """Кратко, одним предложением, опиши, о чем шел диалог.
+Если есть предыдущая сводка, дополни ее новыми репликами."""
+
+_FALLBACK_SYSTEM_PROMPT = """Ты не знаешь точного ответа на вопрос пользователя, но хочешь помочь. Предложи:
+1. Альтернативные формулировки вопроса
+2. Связанные темы, которые ты знаешь
+3. Возможность перенаправить запрос специалисту
+
+Ответ должен быть вежливым и полезным."""
+
+def _tail_tokens(text: str, max_tokens: int) -> Tuple[str, bool]:
+    """
+    Обрезает текст до последних max_tokens токенов
+    :return: Обрезанный текст и признак того, что обрезка была
+    """
+    if _TOKENIZER is not None:
+        tokens = _TOKENIZER.encode(text)
+        if len(tokens) <= max_tokens:
+            return text, False
+        return _TOKENIZER.decode(tokens[-max_tokens:]), True
+    
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text, False
+    return text[-max_chars:], True
 
 class GeneralAssistant:
     def __init__(self):
-        self.llm = GigaChatModel(
-            model="GigaChat-Plus",
-            temperature=0.7,
-            api_key=config.GIGACHAT_API_KEY,
-            max_tokens=500
-        )
+        # GigaChat-Plus с переходом на резервные модели при таймауте
+        self.llm = build_fallback_llm("GigaChat-Plus", temperature=0.7, max_tokens=500)
         self.logger = logging.getLogger("general_assistant")
-        self.context_memory = {}
+        self.llm_cache = SemanticCache(self.llm)
+        # Переиспользуемые соединения для внешних API (погода) (общий пул процесса)
+        self.http = get_http_client()
+        # Память диалога по пользователям: user_id -> {ключ: значение}
+        self.context_memory: Dict[str, Dict] = defaultdict(dict)
         self.personality = {
             "name": "Алексей",
             "role": "Цифровой помощник",
@@ -25,11 +157,28 @@ class GeneralAssistant:
             "knowledge": "эксперт в аналитике данных и бизнес-процессах компании"
         }
         self.system_context = {
-            "current_date": datetime.datetime.now().strftime("%Y-%m-%d"),
             "company": "ТехноКорп",
             "system_version": "2.3.1"
         }
-        
+        self._current_date = None
+        self._date_checked_at = 0.0
+        self._complex_task_prompt = _COMPLEX_TASK_SYSTEM_PROMPT.format(company=self.system_context["company"])
+        # Погода и новости: ключ -> (время истечения, значение)
+        self._external_cache: Dict[str, tuple] = {}
+        # Сводки длинной истории пересчитываются в фоне, не задерживая ответ
+        self._summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="assistant_summary")
+        # Эмбеддинги словаря тем, вычисляются при первом обращении
+        self._topic_label_embs = None
+        
+    @property
+    def current_date(self) -> str:
+        """Текущая дата (YYYY-MM-DD), пересчитывается не чаще раза в минуту"""
+        now = time.monotonic()
+        if self._current_date is None or now - self._date_checked_at > CURRENT_DATE_REFRESH:
+            self._current_date = datetime.date.today().isoformat()
+            self._date_checked_at = now
+        return self._current_date
+
     @traceable
     def respond(self, user_query: str, chat_history: List[Dict] = None, user_context: Dict = None) -> Dict:
         """
@@ -40,72 +189,60 @@ class GeneralAssistant:
         :return: Ответ помощника
         """
         try:
+            user_context = user_context or {}
+            user_id = user_context.get("user_id")
+            
+            # Запрос приводится к нижнему регистру один раз для всех проверок
+            query_folded = user_query.casefold()
+            
             # Определяем тип запроса
-            query_type = self._classify_query(user_query)
+            query_type = self._classify_query(user_query, query_folded)
             
             # Обработка в зависимости от типа
             if query_type == "greeting":
-                return self._handle_greeting(user_query)
+                return self._handle_greeting(user_query, user_id)
             elif query_type == "system_info":
-                return self._handle_system_info(user_query)
+                return self._handle_system_info(user_query, query_folded)
             elif query_type == "small_talk":
-                return self._handle_small_talk(user_query)
+                return self._handle_small_talk(user_query, query_folded)
             elif query_type == "contextual":
                 return self._handle_contextual(user_query, chat_history, user_context)
             elif query_type == "complex_task":
                 return self._handle_complex_task(user_query, chat_history, user_context)
             else:
-                return self._fallback_response(user_query)
+                return self._fallback_response(user_query, user_id)
                 
         except Exception as e:
             self.logger.error(f"General assistant error: {str(e)}")
             return self._error_response(user_query)
 
-    def _classify_query(self, query: str) -> str:
+    def _classify_query(self, query: str, query_folded: str = None) -> str:
         """Классифицирует тип запроса"""
-        query_lower = query.lower()
-        
-        # Проверка приветствий
-        if re.search(r"привет|здравствуй|добрый|хай|здорово", query_lower):
-            return "greeting"
-        
-        # Проверка системных запросов
-        if re.search(r"версия|обнов|дата релиза|сборк|статус", query_lower):
-            return "system_info"
-        
-        # Проверка разговорных запросов
-        if re.search(r"как дела|как жизнь|настроени|погод|новост", query_lower):
-            return "small_talk"
-        
-        # Проверка контекстных запросов
-        if re.search(r"напомни|что говорил|ранее|в прошлый раз", query_lower):
-            return "contextual"
-        
-        # Проверка сложных запросов
-        if len(query.split()) > 10 or re.search(r"объясни|расскажи|сравни|проанализируй", query_lower):
+        if query_folded is None:
+            query_folded = query.casefold()
+        found = {m.lastgroup for m in QUERY_TYPE_RE.finditer(query_folded)}
+        for query_type in QUERY_TYPE_PRIORITY:
+            if query_type in found:
+                return query_type
+        
+        # Длинные запросы считаем сложными
+        if len(query.split()) > 10:
             return "complex_task"
         
         return "unknown"
 
-    def _handle_greeting(self, query: str) -> Dict:
+    def _handle_greeting(self, query: str, user_id: str = None) -> Dict:
         """Обработка приветственных сообщений"""
-        greetings = [
-            "Привет! Чем могу помочь?",
-            "Здравствуйте! Готов помочь с аналитикой и не только.",
-            "Приветствую! Как ваши дела сегодня?",
-            "Рад вас видеть! Что вас интересует?",
-            "Добрый день! Чем займемся сегодня?"
-        ]
-        
         # Выбор случайного приветствия
-        response = np.random.choice(greetings)
+        response = random.choice(_GREETINGS)
         
         # Добавляем имя, если оно есть в запросе
         name_match = re.search(r"(?:меня зовут|я) (\w+)", query, re.IGNORECASE)
         if name_match:
             name = name_match.group(1)
             response = f"{response.split('!')[0]}, {name}! {response.split('!')[1]}"
-            self.context_memory["user_name"] = name
+            if user_id:
+                self.context_memory[user_id]["user_name"] = name
         
         return {
             "type": "text",
@@ -117,14 +254,17 @@ class GeneralAssistant:
             ]
         }
 
-    def _handle_system_info(self, query: str) -> Dict:
+    def _handle_system_info(self, query: str, query_folded: str = None) -> Dict:
         """Обработка запросов о системе"""
-        if re.search(r"версия|версии", query.lower()):
+        if query_folded is None:
+            query_folded = query.casefold()
+        
+        if re.search(r"версия|версии", query_folded):
             response = f"Текущая версия системы: {self.system_context['system_version']}"
-        elif re.search(r"обнов|новое", query.lower()):
+        elif re.search(r"обнов|новое", query_folded):
             response = "Последнее обновление было вчера. Добавлена поддержка новых отчетов по клиентской аналитике."
-        elif re.search(r"дата|число|день", query.lower()):
-            response = f"Сегодня {self.system_context['current_date']}"
+        elif re.search(r"дата|число|день", query_folded):
+            response = f"Сегодня {self.current_date}"
         else:
             response = "Система работает в штатном режиме. Все компоненты функционируют нормально."
         
@@ -134,24 +274,21 @@ class GeneralAssistant:
             "system_info": True
         }
 
-    def _handle_small_talk(self, query: str) -> Dict:
+    def _handle_small_talk(self, query: str, query_folded: str = None) -> Dict:
         """Обработка разговорных запросов"""
+        if query_folded is None:
+            query_folded = query.casefold()
+        
         # Специальные случаи
-        if re.search(r"как дела|как жизнь", query.lower()):
-            responses = [
-                "У меня всё отлично, работаю на полную мощность!",
-                "Как у цифрового помощника - прекрасно! Готов помогать вам.",
-                "Лучше не бывает, особенно когда могу помочь вам!",
-                "Все системы функционируют нормально, спасибо, что спросили!"
-            ]
-            response = np.random.choice(responses)
+        if re.search(r"как дела|как жизнь", query_folded):
+            response = random.choice(_HOW_ARE_YOU_RESPONSES)
         
-        elif re.search(r"погод", query.lower()):
+        elif "погод" in query_folded:
             # Интеграция с внешним API погоды
             weather = self._get_weather()
             response = f"Сейчас {weather['description']}, температура {weather['temp']}°C"
         
-        elif re.search(r"новост", query.lower()):
+        elif "новост" in query_folded:
             # Получение последних новостей компании
             news = self._get_company_news()
             response = f"Последние новости компании:\n{news}"
@@ -170,25 +307,19 @@ class GeneralAssistant:
         # Извлечение контекста из истории
         context = self._extract_context(chat_history, user_context)
         
-        prompt = f"""Ты интеллектуальный помощник. Ответь на запрос пользователя, используя контекст:
-        
-        Контекст:
-        - Имя пользователя: {context.get('user_name', 'неизвестно')}
-        - Роль: {context.get('role', 'пользователь')}
-        - История диалога (последние 3 реплики):
-          {self._format_chat_history(chat_history[-3:])}
-        - Системная информация: версия {self.system_context['system_version']}, дата {self.system_context['current_date']}
-        
-        Запрос пользователя: {query}
-        
-        Ответ должен быть:
-        - Максимально полезным
-        - Учитывать историю диалога
-        - Вежливым и дружелюбным
-        - Не более 3 предложений
-        """
+        prompt = f"""{_CONTEXTUAL_SYSTEM_PROMPT}
+
+Контекст:
+- Системная информация: версия {self.system_context['system_version']}, дата {self.current_date}
+- Имя пользователя: {context.get('user_name', 'неизвестно')}
+- Роль: {context.get('role', 'пользователь')}
+- История диалога (последние 3 реплики):
+{self._format_chat_history(chat_history[-3:])}
+
+Запрос пользователя: {query}
+"""
         
-        response = self.llm.generate(prompt)
+        response = self._generate_for_user(prompt, "contextual", user_context.get("user_id"))
         return {
             "type": "text",
             "content": response,
@@ -200,27 +331,17 @@ class GeneralAssistant:
         # Извлечение контекста
         context = self._extract_context(chat_history, user_context)
         
-        prompt = f"""Ты старший аналитик компании {self.system_context['company']}. 
-        Ответь на сложный запрос пользователя, следуя инструкциям:
-        
-        Информация о пользователе:
-        - Имя: {context.get('user_name', 'неизвестно')}
-        - Роль: {context.get('role', 'пользователь')}
-        - Уровень знаний: {context.get('expertise', 'средний')}
-        
-        Запрос: {query}
-        
-        Структура ответа:
-        1. Краткое резюме сути запроса
-        2. Пошаговое объяснение/решение
-        3. Ключевые выводы
-        4. Рекомендации (если применимо)
-        5. Дополнительные ресурсы (если нужны)
-        
-        Используй профессиональный, но доступный язык. Допустимы маркированные списки.
-        """
+        prompt = f"""{self._complex_task_prompt}
+
+Информация о пользователе:
+- Имя: {context.get('user_name', 'неизвестно')}
+- Роль: {context.get('role', 'пользователь')}
+- Уровень знаний: {context.get('expertise', 'средний')}
+
+Запрос: {query}
+"""
         
-        response = self.llm.generate(prompt)
+        response = self._generate_for_user(prompt, "complex", user_context.get("user_id"))
         
         # Пост-обработка для улучшения читаемости
         formatted_response = self._format_complex_response(response)
@@ -234,92 +355,212 @@ class GeneralAssistant:
 
     def _extract_context(self, chat_history: List[Dict], user_context: Dict) -> Dict:
         """Извлекает контекст из истории и данных пользователя"""
+        user_id = user_context.get("user_id")
+        # Анонимные пользователи не делят одну запись памяти: для них память не ведется
+        memory = self.context_memory[user_id] if user_id else {}
         context = {
-            "user_name": self.context_memory.get("user_name", "пользователь"),
+            "user_name": memory.get("user_name", "пользователь"),
             "role": user_context.get("role", "сотрудник"),
             "expertise": user_context.get("expertise_level", "средний")
         }
         
         # Извлечение тем из истории
         if chat_history:
-            topics = self._extract_topics(chat_history)
+            topics = self._extract_topics(chat_history, user_id)
             context["recent_topics"] = topics[:3]
             
         # Сохранение в памяти
-        self.context_memory.update(context)
+        memory.update(context)
         return context
 
-    def _extract_topics(self, chat_history: List[Dict]) -> List[str]:
+    def _extract_topics(self, chat_history: List[Dict], user_id: str = None) -> List[str]:
         """Извлекает основные темы из истории диалога"""
-        history_text = "\n".join([msg["content"] for msg in chat_history])
-        
-        prompt = f"""Определи основные темы в истории диалога:
-        
-        История:
-        {history_text}
-        
-        Выведи только список тем через запятую, без дополнительного текста.
-        """
+        # Локальная кластеризация эмбеддингов; LLM - только если модель недоступна
+        topics = self._cluster_topics(chat_history)
+        if topics is not None:
+            return topics
+        
+        history_text = "\n".join(msg["content"] for msg in chat_history)
+        
+        # Длинная история: последние MAX_HISTORY_TOKENS токенов + сводка более ранней части
+        recent_text, truncated = _tail_tokens(history_text, MAX_HISTORY_TOKENS)
+        summary = None
+        if truncated and user_id is not None:
+            earlier_text = history_text[:len(history_text) - len(recent_text)]
+            summary = self._rolling_summary(user_id, earlier_text, len(chat_history))
+        
+        summary_block = f"Сводка ранней части диалога: {summary}\n\n" if summary else ""
+        prompt = f"""{_TOPICS_SYSTEM_PROMPT}
+
+{summary_block}История:
+{recent_text}
+"""
         
-        topics = self.llm.generate(prompt)
+        topics = self._generate_for_user(prompt, "topics", user_id)
         return [t.strip() for t in topics.split(",") if t.strip()]
 
+    def _cluster_topics(self, chat_history: List[Dict]) -> Optional[List[str]]:
+        """
+        Определяет темы кластеризацией эмбеддингов реплик
+        :param chat_history: История диалога
+        :return: Метки тем от крупного кластера к мелкому или None,
+            если модель эмбеддингов или scikit-learn недоступны
+        """
+        if not SKLEARN_AVAILABLE:
+            return None
+        
+        messages = [msg["content"] for msg in chat_history[-TOPIC_HISTORY_MESSAGES:] if msg.get("content")]
+        if not messages:
+            return []
+        
+        label_embs = self._get_topic_label_embs()
+        embs = self.llm_cache.embed(messages)
+        if label_embs is None or embs is None:
+            return None
+        
+        kmeans = MiniBatchKMeans(n_clusters=min(TOPIC_CLUSTERS, len(embs)), n_init=3, random_state=0)
+        labels = kmeans.fit_predict(embs)
+        
+        # Косинус центров с метками словаря (эмбеддинги меток нормализованы)
+        centroids = kmeans.cluster_centers_
+        centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        nearest = (centroids @ label_embs.T).argmax(axis=1)
+        
+        topics = []
+        for cluster in np.argsort(-np.bincount(labels, minlength=len(centroids)), kind="stable"):
+            topic = _TOPIC_LABELS[nearest[cluster]]
+            if topic not in topics:
+                topics.append(topic)
+        return topics
+
+    def _get_topic_label_embs(self) -> Optional[np.ndarray]:
+        """Возвращает эмбеддинги словаря тем (кодируются один раз)"""
+        if self._topic_label_embs is None:
+            self._topic_label_embs = self.llm_cache.embed(list(_TOPIC_LABELS))
+        return self._topic_label_embs
+
+    def _rolling_summary(self, user_id: str, earlier_text: str, turns: int) -> Optional[str]:
+        """
+        Возвращает сохраненную сводку ранней истории и при устаревании
+        пересчитывает ее в фоне
+        :param user_id: ID пользователя
+        :param earlier_text: Часть истории, не вошедшая в промпт
+        :param turns: Текущее число реплик в истории
+        :return: Сводка или None, если она еще не готова
+        """
+        memory = self.context_memory[user_id]
+        if turns - memory.get("summary_turns", -SUMMARY_REFRESH_TURNS) >= SUMMARY_REFRESH_TURNS:
+            # Отмечаем сразу, чтобы не запускать пересчет повторно
+            memory["summary_turns"] = turns
+            self._summary_executor.submit(self._refresh_summary, memory, earlier_text, user_id)
+        return memory.get("rolling_summary")
+
+    def _refresh_summary(self, memory: Dict, earlier_text: str, user_id: str = None):
+        """Пересчитывает сводку ранней истории (выполняется в фоне)"""
+        try:
+            source_text, _ = _tail_tokens(earlier_text, MAX_HISTORY_TOKENS)
+            previous = memory.get("rolling_summary")
+            previous_block = f"Предыдущая сводка: {previous}\n\n" if previous else ""
+            prompt = f"""{_SUMMARY_SYSTEM_PROMPT}
+
+{previous_block}Реплики:
+{source_text}
+"""
+            memory["rolling_summary"] = self._generate_for_user(prompt, "summary", user_id).strip()
+        except Exception as e:
+            self.logger.warning(f"History summary failed: {str(e)}")
+
     def _format_chat_history(self, history: List[Dict]) -> str:
         """Форматирует историю диалога для промпта"""
-        return "\n".join([
-            f"{msg['role'].capitalize()}: {msg['content']}" 
+        return "\n".join(
+            f"{_ROLE_LABELS.get(msg['role']) or msg['role'].capitalize()}: {msg['content']}"
             for msg in history
-        ])
+        )
 
     def _format_complex_response(self, response: str) -> str:
         """Улучшает форматирование сложных ответов"""
-        # Добавление маркированных списков
-        response = re.sub(r"\n\d+\.\s", "\n• ", response)
-        
-        # Выделение ключевых терминов
-        key_terms = ["Важно:", "Ключевое:", "Рекомендация:"]
-        for term in key_terms:
-            response = response.replace(term, f"**{term}**")
+        # Маркированные списки и выделение ключевых терминов
+        response = COMPLEX_FORMAT_RE.sub(self._format_marker, response)
         
         # Упрощение длинных абзацев
-        sentences = response.split(". ")
-        if len(sentences) > 5:
-            response = ". ".join(sentences[:5]) + ".\n\n[Ответ сокращен для удобства]"
+        first_sentences = FIRST_SENTENCES_RE.match(response)
+        if first_sentences:
+            response = first_sentences.group(0).rstrip(" ") + "\n\n[Ответ сокращен для удобства]"
             
         return response
 
+    @staticmethod
+    def _format_marker(match: re.Match) -> str:
+        """Замена для COMPLEX_FORMAT_RE"""
+        if match.group(1):
+            return "\n• "
+        return f"**{match.group(2)}**"
+
     def _get_weather(self) -> Dict:
         """Получает текущую погоду (заглушка с реальной интеграцией)"""
         try:
-            # Реальная интеграция с OpenWeatherMap
-            response = requests.get(
-                f"http://api.openweathermap.org/data/2.5/weather?q=Moscow&appid={config.WEATHER_API_KEY}&units=metric&lang=ru"
-            )
-            data = response.json()
-            return {
-                "temp": data["main"]["temp"],
-                "description": data["weather"][0]["description"]
-            }
+            return self._cached_external("weather:Moscow", self._fetch_weather)
         except:
+            # Заглушка не кешируется, чтобы следующий запрос снова обратился к API
             return {"temp": 20, "description": "ясно"}
 
+    def _fetch_weather(self) -> Dict:
+        """Запрашивает погоду в OpenWeatherMap"""
+        response = self.http.get(
+            "http://api.openweathermap.org/data/2.5/weather",
+            params={"q": "Moscow", "appid": config.WEATHER_API_KEY, "units": "metric", "lang": "ru"}
+        )
+        data = response.json()
+        return {
+            "temp": data["main"]["temp"],
+            "description": data["weather"][0]["description"]
+        }
+
     def _get_company_news(self) -> str:
-        """Получает последние новости компании (заглушка)"""
+        """Получает последние новости компании (кешируется на EXTERNAL_DATA_TTL)"""
+        return self._cached_external("company_news", self._fetch_company_news)
+
+    def _fetch_company_news(self) -> str:
+        """Загружает новости компании (заглушка)"""
         return "1. Запущена новая система аналитики\n2. Компания получила награду 'Лучший работодатель года'\n3. Запланировано обновление на следующей неделе"
 
-    def _fallback_response(self, query: str) -> Dict:
-        """Ответ по умолчанию для неизвестных запросов"""
-        prompt = f"""Пользователь спросил: "{query}"
-        
-        Ты не знаешь точного ответа, но хочешь помочь. Предложи:
-        1. Альтернативные формулировки вопроса
-        2. Связанные темы, которые ты знаешь
-        3. Возможность перенаправить запрос специалисту
-        
-        Ответ должен быть вежливым и полезным.
+    def _cached_external(self, key: str, loader) -> any:
+        """
+        Возвращает данные внешнего источника из кеша или загружает их
+        :param key: Ключ кеша
+        :param loader: Функция загрузки, вызывается при промахе
+        :return: Данные источника
+        """
+        now = time.monotonic()
+        entry = self._external_cache.get(key)
+        if entry is not None and now < entry[0]:
+            return entry[1]
+        
+        value = loader()
+        self._external_cache[key] = (now + EXTERNAL_DATA_TTL, value)
+        return value
+
+    def _generate_for_user(self, prompt: str, kind: str, user_id: str = None) -> str:
+        """
+        Вызывает LLM через семантический кеш в пространстве имен пользователя:
+        промпты содержат имя и историю диалога, чужой персональный ответ недопустим
+        :param prompt: Промпт для LLM
+        :param kind: Тип запроса (contextual, complex, ...)
+        :param user_id: ID пользователя; без него ответ не кешируется
+        :return: Ответ LLM
         """
+        if user_id is None:
+            return self.llm.generate(prompt)
+        return self.llm_cache.generate(prompt, namespace=f"assistant|{kind}|{user_id}")
+
+    def _fallback_response(self, query: str, user_id: str = None) -> Dict:
+        """Ответ по умолчанию для неизвестных запросов"""
+        prompt = f"""{_FALLBACK_SYSTEM_PROMPT}
+
+Пользователь спросил: "{query}"
+"""
         
-        response = self.llm.generate(prompt)
+        response = self._generate_for_user(prompt, "fallback", user_id)
         return {
             "type": "text",
             "content": response,
@@ -343,11 +584,11 @@ class GeneralAssistant:
         }
 
     def update_context(self, user_id: str, key: str, value: any):
-        """Обновляет контекст пользователя"""
-        if user_id not in self.context_memory:
-            self.context_memory[user_id] = {}
+        """Обновляет контекст пользователя (без user_id контекст не сохраняется)"""
+        if not user_id:
+            return
         self.context_memory[user_id][key] = value
 
     def get_context(self, user_id: str) -> Dict:
         """Возвращает сохраненный контекст пользователя"""
-        return self.context_memory.get(user_id, {})
\ No newline at end of file
+        return self.context_memory.get(user_id, {})
@@ -1,21 +1,108 @@
 from langsmith import traceable
-from gigachain import GigaChatModel
 import re
 import logging
 import config
 import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from typing import Dict, List
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from services.fast_json import json_dumps, json_loads
+from services.llm_client import get_llm
+
+# Категории классификатора
+CATEGORIES = ("analytics", "documentation", "explanation", "small_talk", "greeting", "help", "other")
+
+# Категория -> (обработчик, уверенность правила, подкатегория)
+_CAT_INFO = {
+    "analytics": ("analytics_pipeline", 0.95, "data_report"),
+    "documentation": ("documentation_search", 0.92, "general_docs"),
+    "explanation": ("general_assistant", 0.85, "concept_explanation"),
+    "small_talk": ("small_talk_agent", 0.98, "casual_conversation"),
+    "greeting": ("small_talk_agent", 0.99, "greeting"),
+    "help": ("help_system", 0.97, "system_help"),
+}
+_DEFAULT_CAT_INFO = ("general_assistant", 0.8, "other")
+
+# Готовые результаты классификации по правилам (копируются при выдаче)
+_RULE_RESULTS = {
+    category: {
+        "category": category,
+        "handler": handler,
+        "confidence": confidence,
+        "subcategory": subcategory,
+        "classification_method": "rule_based"
+    }
+    for category, (handler, confidence, subcategory) in _CAT_INFO.items()
+}
+
+# Максимум запросов в кеше LLM-классификаций
+CLASS_CACHE_SIZE = 10_000
+
+# Объединение одновременных запросов в один пакетный вызов LLM:
+# пакет уходит при наборе COALESCE_MAX_BATCH запросов или через COALESCE_WINDOW секунд
+COALESCE_MAX_BATCH = 32
+COALESCE_WINDOW = 0.01
+
+# Пакет длиннее BATCH_BIN_MIN запросов делится на BATCH_BINS корзин по длине
+# запроса: в каждом вызове LLM запросы близкой длины
+BATCH_BINS = 3
+BATCH_BIN_MIN = 8
+
+# Правила быстрой классификации в порядке приоритета. Только литералы
+# (основы слов): выражение без квантификаторов не может уйти в перебор
+FAST_RULES = (
+    ("help", ("помощь", "команды", "что ты умеешь")),
+    ("greeting", ("привет", "здравствуй", "добрый день", "хай")),
+    ("analytics", ("отчет", "анализ", "график", "диаграмма", "тренд", "сравни")),
+    ("documentation", ("документ", "инструкция", "как сделать", "пример", "api", "интеграц")),
+    ("explanation", ("объясни", "что такое", "в чем разница", "как работает")),
+    ("small_talk", ("как дел", "как жизнь", "что новог", "как погод", "как настроени")),
+)
+FAST_RULES_PRIORITY = tuple(category for category, _ in FAST_RULES)
+
+# Все правила одним выражением - один проход по запросу вместо десятков.
+# Ключевые слова - основы, поэтому граница слова только в начале:
+# "например" не совпадает с "пример", "шанхай" - с "хай"
+FAST_RULES_RE = re.compile(
+    "|".join(
+        f"(?P<{category}>\\b(?:{'|'.join(map(re.escape, keywords))}))"
+        for category, keywords in FAST_RULES
+    ),
+    re.IGNORECASE
+)
+
+def _normalize_query(query: str) -> str:
+    """Ключ кеша: без лишних пробелов и регистра"""
+    return " ".join(query.split()).casefold()
+
+@lru_cache(maxsize=4096)
+def _fast_classify(query: str) -> Optional[str]:
+    """Категория по правилам FAST_RULES или None (кешируется)"""
+    found = {m.lastgroup for m in FAST_RULES_RE.finditer(query)}
+    for category in FAST_RULES_PRIORITY:
+        if category in found:
+            return category
+    return None
 
 class QueryClassifierAgent:
     def __init__(self):
-        self.llm = GigaChatModel(
-            model="GigaChat-Pro",
-            temperature=0.2,
-            api_key=config.GIGACHAT_API_KEY
-        )
+        # Общий клиент: соединение и TLS-сессия переиспользуются, даже если агент создается на каждый запрос
+        self.llm = get_llm(temperature=0.2)
         self.logger = logging.getLogger("query_classifier")
-        self.class_cache = {}
+        # LRU классификаций по нормализованному запросу
+        self.class_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        # LRU меняет порядок даже при чтении, а пишут в него потоки пакетной классификации
+        self._cache_lock = threading.Lock()
+        
+        # Очередь асинхронных запросов и задача, собирающая их в пакеты
+        self._pending: Optional[asyncio.Queue] = None
+        self._coalescer: Optional[asyncio.Task] = None
+        # Корзины одного пакета отправляются в LLM параллельно
+        self._bin_executor = ThreadPoolExecutor(max_workers=BATCH_BINS, thread_name_prefix="classifier_bin")
         
         # Загружаем правила классификации из файла
         self.rules = self._load_classification_rules()
@@ -30,12 +117,14 @@ class QueryClassifierAgent:
         """
         try:
             # Проверка кеша
-            if query in self.class_cache:
+            key = _normalize_query(query)
+            cached = self._cache_get(key)
+            if cached is not None:
                 self.logger.debug(f"Cache hit for query: {query[:30]}...")
-                return self.class_cache[query]
+                return cached
             
             # Быстрая классификация по правилам
-            fast_class = self._fast_classification(query)
+            fast_class = _fast_classify(key)
             if fast_class:
                 return self._prepare_result(fast_class, method="rule_based")
             
@@ -43,46 +132,90 @@ class QueryClassifierAgent:
             classification = self._full_classification(query, user_context)
             
             # Кеширование результата
-            self.class_cache[query] = classification
+            self._cache_put(key, classification)
             return classification
             
         except Exception as e:
             self.logger.error(f"Classification error: {str(e)}")
             return self._fallback_classification(query)
 
-    def _fast_classification(self, query: str) -> str:
-        """Быстрая классификация на основе правил"""
-        query_lower = query.lower()
-        
-        # Приоритетные правила
-        if any(cmd in query_lower for cmd in ["помощь", "команды", "что ты умеешь"]):
-            return "help"
-            
-        if any(cmd in query_lower for cmd in ["привет", "здравствуй", "добрый день", "хай"]):
-            return "greeting"
+    async def aclassify_query(self, query: str, user_context: Dict = None) -> Dict:
+        """
+        Асинхронный вариант classify_query: одновременные запросы, не решенные
+        кешем и правилами, классифицируются одним пакетным вызовом LLM
+        :param query: Запрос пользователя
+        :param user_context: Контекст пользователя (роль, история и т.д.)
+        :return: Результат классификации
+        """
+        try:
+            key = _normalize_query(query)
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
             
-        if any(cmd in query_lower for cmd in ["отчет", "анализ", "график", "диаграмма", "тренд", "сравни"]):
-            return "analytics"
+            fast_class = _fast_classify(key)
+            if fast_class:
+                return self._prepare_result(fast_class, method="rule_based")
             
-        if any(cmd in query_lower for cmd in ["документ", "инструкция", "как сделать", "пример", "api", "интеграц"]):
-            return "documentation"
+            if self._pending is None:
+                self._pending = asyncio.Queue()
+            future = asyncio.get_running_loop().create_future()
+            await self._pending.put((query, future))
+            if self._coalescer is None or self._coalescer.done():
+                self._coalescer = asyncio.create_task(self._coalesce_requests())
+            return await future
             
-        if any(cmd in query_lower for cmd in ["объясни", "что такое", "в чем разница", "как работает"]):
-            return "explanation"
+        except Exception as e:
+            self.logger.error(f"Classification error: {str(e)}")
+            return self._fallback_classification(query)
+
+    async def _coalesce_requests(self):
+        """Собирает ожидающие запросы в пакеты и классифицирует их, пока очередь не опустеет"""
+        loop = asyncio.get_running_loop()
+        while not self._pending.empty():
+            batch = [self._pending.get_nowait()]
+            deadline = loop.time() + COALESCE_WINDOW
+            while len(batch) < COALESCE_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
             
-        # Паттерны для small talk
-        small_talk_patterns = [
-            r"как дел[аи]?",
-            r"как жизнь",
-            r"что новог[оа]?",
-            r"как погод[а]?",
-            r"как настроени[е]?"
-        ]
-        
-        if any(re.search(pattern, query_lower) for pattern in small_talk_patterns):
-            return "small_talk"
+            queries = list(dict.fromkeys(query for query, _ in batch))
+            try:
+                results = await self._abatch_classification(queries)
+            except Exception as e:
+                self.logger.error(f"Coalesced classification failed: {str(e)}")
+                results = {}
             
-        return None
+            for query, future in batch:
+                if future.done():
+                    continue
+                result = results.get(query) or self._cache_get(_normalize_query(query))
+                future.set_result(result or self._fallback_classification(query))
+
+    def _fast_classification(self, query: str) -> Optional[str]:
+        """Быстрая классификация на основе правил"""
+        return _fast_classify(_normalize_query(query))
+
+    def _cache_get(self, key: str) -> Optional[Dict]:
+        """Возвращает классификацию из LRU-кеша или None"""
+        with self._cache_lock:
+            result = self.class_cache.get(key)
+            if result is not None:
+                self.class_cache.move_to_end(key)
+            return result
+
+    def _cache_put(self, key: str, result: Dict):
+        """Сохраняет классификацию, вытесняя самую давнюю"""
+        with self._cache_lock:
+            self.class_cache[key] = result
+            self.class_cache.move_to_end(key)
+            if len(self.class_cache) > CLASS_CACHE_SIZE:
+                self.class_cache.popitem(last=False)
 
     def _full_classification(self, query: str, user_context: Dict) -> Dict:
         """Полная классификация с использованием LLM"""
@@ -124,21 +257,11 @@ class QueryClassifierAgent:
         
         try:
             # Парсинг JSON
-            result = json.loads(response)
-            
-            # Маппинг обработчиков
-            handler_map = {
-                "analytics": "analytics_pipeline",
-                "documentation": "documentation_search",
-                "explanation": "general_assistant",
-                "small_talk": "small_talk_agent",
-                "help": "help_system",
-                "other": "general_assistant"
-            }
+            result = json_loads(response)
             
             # Убедимся, что handler корректен
             if "handler" not in result:
-                result["handler"] = handler_map.get(result.get("category", "other"), "general_assistant")
+                result["handler"] = _CAT_INFO.get(result.get("category", "other"), _DEFAULT_CAT_INFO)[0]
             
             return result
         except json.JSONDecodeError:
@@ -147,38 +270,15 @@ class QueryClassifierAgent:
 
     def _prepare_result(self, category: str, method: str = "rule_based") -> Dict:
         """Подготавливает результат классификации"""
-        handler_map = {
-            "analytics": "analytics_pipeline",
-            "documentation": "documentation_search",
-            "explanation": "general_assistant",
-            "small_talk": "small_talk_agent",
-            "greeting": "small_talk_agent",
-            "help": "help_system"
-        }
-        
-        confidence_map = {
-            "analytics": 0.95,
-            "documentation": 0.92,
-            "explanation": 0.85,
-            "small_talk": 0.98,
-            "greeting": 0.99,
-            "help": 0.97
-        }
-        
-        subcategory_map = {
-            "analytics": "data_report",
-            "documentation": "general_docs",
-            "explanation": "concept_explanation",
-            "small_talk": "casual_conversation",
-            "greeting": "greeting",
-            "help": "system_help"
-        }
+        if method == "rule_based" and category in _RULE_RESULTS:
+            return _RULE_RESULTS[category].copy()
         
+        handler, confidence, subcategory = _CAT_INFO.get(category, _DEFAULT_CAT_INFO)
         return {
             "category": category,
-            "handler": handler_map.get(category, "general_assistant"),
-            "confidence": confidence_map.get(category, 0.8),
-            "subcategory": subcategory_map.get(category, "other"),
+            "handler": handler,
+            "confidence": confidence,
+            "subcategory": subcategory,
             "classification_method": method
         }
 
@@ -235,28 +335,101 @@ class QueryClassifierAgent:
 
     def batch_classify(self, queries: List[str]) -> Dict[str, Dict]:
         """Классифицирует несколько запросов за один вызов"""
-        # Группируем запросы для пакетной обработки
-        results = {}
-        fast_classified = []
+        results, unique, misses = self._resolve_known(queries)
+        
+        # Пакетная обработка оставшихся запросов: повторы отправляются один раз
+        if unique:
+            batch_results = self._batch_classification(list(unique.values()))
+            self._fan_out(results, batch_results, unique, misses)
         
-        # Сначала быстрая классификация
+        return results
+
+    async def abatch_classify(self, queries: List[str]) -> Dict[str, Dict]:
+        """Асинхронный вариант batch_classify: корзины пакета классифицируются конкурентно"""
+        results, unique, misses = self._resolve_known(queries)
+        if unique:
+            batch_results = await self._abatch_classification(list(unique.values()))
+            self._fan_out(results, batch_results, unique, misses)
+        return results
+
+    def _resolve_known(self, queries: List[str]) -> Tuple[Dict[str, Dict], Dict[str, str], List[Tuple[str, str]]]:
+        """
+        Классифицирует запросы по кешу и правилам
+        :param queries: Запросы пользователя
+        :return: Готовые результаты; нормализованный ключ -> первый запрос
+            с этим ключом (он уходит в LLM); пары (запрос, ключ) для LLM
+        """
+        results = {}
+        unique = {}
+        misses = []
         for query in queries:
-            fast_class = self._fast_classification(query)
+            key = _normalize_query(query)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[query] = cached
+                continue
+            fast_class = _fast_classify(key)
             if fast_class:
                 results[query] = self._prepare_result(fast_class, "rule_based")
             else:
-                fast_classified.append(query)
-        
-        # Пакетная обработка оставшихся запросов
-        if fast_classified:
-            batch_results = self._batch_classification(fast_classified)
-            results.update(batch_results)
-        
-        return results
+                unique.setdefault(key, query)
+                misses.append((query, key))
+        return results, unique, misses
+
+    def _fan_out(self, results: Dict[str, Dict], batch_results: Dict[str, Dict],
+                 unique: Dict[str, str], misses: List[Tuple[str, str]]):
+        """Раздает ответы LLM всем запросам с тем же нормализованным ключом"""
+        for query, key in misses:
+            results[query] = (
+                batch_results.get(unique[key])
+                or self._cache_get(key)
+                or self._fallback_classification(query)
+            )
 
     def _batch_classification(self, queries: List[str]) -> Dict[str, Dict]:
         """Пакетная классификация с помощью LLM"""
-        prompt = f"""Ты эксперт по классификации запросов. Определи тип для каждого запроса:
+        bins = self._length_bins(queries)
+        if len(bins) == 1:
+            return self._classify_bin(bins[0])
+        
+        results = {}
+        for bin_results in self._bin_executor.map(self._classify_bin, bins):
+            results.update(bin_results)
+        return results
+
+    async def _abatch_classification(self, queries: List[str]) -> Dict[str, Dict]:
+        """Пакетная классификация: корзины уходят в LLM одновременно, не блокируя event loop"""
+        bins = self._length_bins(queries)
+        results = {}
+        for bin_results in await asyncio.gather(*(self._aclassify_bin(b) for b in bins)):
+            results.update(bin_results)
+        return results
+
+    def _length_bins(self, queries: List[str]) -> List[List[str]]:
+        """Делит пакет на корзины запросов близкой длины (равные по числу запросов)"""
+        if len(queries) < BATCH_BIN_MIN:
+            return [queries]
+        ordered = sorted(queries, key=len)
+        size = -(-len(ordered) // BATCH_BINS)
+        return [ordered[i:i + size] for i in range(0, len(ordered), size)]
+
+    def _classify_bin(self, queries: List[str]) -> Dict[str, Dict]:
+        """Классифицирует один пакет запросов одним вызовом LLM"""
+        response = self.llm.generate(self._batch_prompt(queries), response_format="json")
+        return self._parse_batch(response, queries)
+
+    async def _aclassify_bin(self, queries: List[str]) -> Dict[str, Dict]:
+        """Асинхронно классифицирует один пакет запросов"""
+        prompt = self._batch_prompt(queries)
+        if hasattr(self.llm, "agenerate"):
+            response = await self.llm.agenerate(prompt, response_format="json")
+        else:
+            response = await asyncio.to_thread(self.llm.generate, prompt, response_format="json")
+        return self._parse_batch(response, queries)
+
+    def _batch_prompt(self, queries: List[str]) -> str:
+        """Формирует промпт пакетной классификации"""
+        return f"""Ты эксперт по классификации запросов. Определи тип для каждого запроса:
 
 Категории:
 1. analytics - запросы данных, отчеты, графики
@@ -276,15 +449,14 @@ class QueryClassifierAgent:
 }}
 
 Запросы:
-{json.dumps(queries, ensure_ascii=False)}
+{json_dumps(queries)}
 """
-        
-        # Генерация ответа
-        response = self.llm.generate(prompt, response_format="json")
-        
+
+    def _parse_batch(self, response: str, queries: List[str]) -> Dict[str, Dict]:
+        """Разбирает и кеширует ответ пакетной классификации"""
         try:
             # Парсинг JSON
-            batch_result = json.loads(response)
+            batch_result = json_loads(response)
             
             # Форматирование результатов
             formatted_results = {}
@@ -293,7 +465,7 @@ class QueryClassifierAgent:
             
             # Кеширование результатов
             for query, result in formatted_results.items():
-                self.class_cache[query] = result
+                self._cache_put(_normalize_query(query), result)
                 
             return formatted_results
         except (json.JSONDecodeError, TypeError) as e:
@@ -314,26 +486,36 @@ class QueryClassifierAgent:
 
     def evaluate_classification(self, test_data: List[Dict]) -> Dict:
         """Оценивает точность классификации на тестовых данных"""
-        correct = 0
         total = len(test_data)
-        confusion_matrix = {}
+        if not total:
+            return {"accuracy": 0.0, "total": 0, "correct": 0, "confusion_matrix": {}}
         
-        for item in test_data:
-            result = self.classify_query(item["query"])
-            predicted = result["category"]
-            actual = item["category"]
-            
-            # Обновляем матрицу ошибок
-            key = f"{actual}->{predicted}"
-            confusion_matrix[key] = confusion_matrix.get(key, 0) + 1
-            
-            if predicted == actual:
-                correct += 1
+        # Все запросы классифицируются одним пакетом, а не по одному
+        queries = [item["query"] for item in test_data]
+        results = self.batch_classify(queries)
+        actual = [item["category"] for item in test_data]
+        predicted = [
+            (results.get(query) or self._fallback_classification(query))["category"]
+            for query in queries
+        ]
+        
+        # Категории -> индексы, матрица ошибок считается в numpy
+        categories = list(dict.fromkeys(CATEGORIES + tuple(actual) + tuple(predicted)))
+        cat_to_idx = {category: i for i, category in enumerate(categories)}
+        actual_idx = np.fromiter((cat_to_idx[c] for c in actual), dtype=np.int32, count=total)
+        predicted_idx = np.fromiter((cat_to_idx[c] for c in predicted), dtype=np.int32, count=total)
         
-        accuracy = correct / total
+        matrix = np.zeros((len(categories), len(categories)), dtype=np.int32)
+        np.add.at(matrix, (actual_idx, predicted_idx), 1)
+        correct = int(np.trace(matrix))
+        
+        confusion_matrix = {
+            f"{categories[a]}->{categories[p]}": int(matrix[a, p])
+            for a, p in zip(*np.nonzero(matrix))
+        }
         
         return {
-            "accuracy": accuracy,
+            "accuracy": correct / total,
             "total": total,
             "correct": correct,
             "confusion_matrix": confusion_matrix
@@ -341,5 +523,6 @@ class QueryClassifierAgent:
 
     def clear_cache(self):
         """Очищает кеш классификации"""
-        self.class_cache = {}
+        with self._cache_lock:
+            self.class_cache.clear()
         self.logger.info("Classification cache cleared")
\ No newline at end of file
@@ -2,15 +2,61 @@ from langsmith import traceable
 import logging
 import config
 import re
+import reprlib
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from io import BytesIO
 import base64
 
+# Markdown-выделение -> разметка Telegram за один проход: **жирный** и __подчеркнутый__
+TELEGRAM_MARKUP_RE = re.compile(r"\*\*(.*?)\*\*|__(.*?)__")
+
+def _telegram_markup(match: re.Match) -> str:
+    """Замена для TELEGRAM_MARKUP_RE (вложенное выделение тоже преобразуется)"""
+    bold, underline = match.groups()
+    if bold is not None:
+        return f"*{TELEGRAM_MARKUP_RE.sub(_telegram_markup, bold)}*"
+    return f"_{TELEGRAM_MARKUP_RE.sub(_telegram_markup, underline)}_"
+
+TRUNCATION_SUFFIX = "..."
+
+# Префикс data URI перед base64-картинкой (проверяется только начало строки)
+DATA_URI_PREFIX_RE = re.compile(r"data:image/[\w.+-]+;base64,")
+
+def _truncate(text: str, limit: int, reserve: int) -> str:
+    """
+    Обрезает текст, если он длиннее limit
+    :param text: Исходный текст
+    :param limit: Максимальная длина без обрезки
+    :param reserve: Сколько символов отрезать от лимита при обрезке
+    :return: Исходный текст или его начало с TRUNCATION_SUFFIX
+    """
+    if len(text) <= limit:
+        return text
+    return text[:limit - reserve] + TRUNCATION_SUFFIX
+
+def _decode_image(data) -> BytesIO:
+    """
+    Декодирует картинку из base64 (с префиксом data URI или без) в байты для Telegram
+    :param data: base64-строка или уже готовые байты
+    :return: Буфер с PNG/JPEG
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return BytesIO(data)
+    prefix = DATA_URI_PREFIX_RE.match(data)
+    body = data[prefix.end():] if prefix else data
+    return BytesIO(base64.b64decode(body))
+
 class ResponseSynthesizer:
     def __init__(self):
         self.logger = logging.getLogger("response_synthesizer")
         self.max_text_length = 4000  # Лимит Telegram для текста
         self.max_caption_length = 1000  # Лимит подписей к медиа
+        # Ограниченное представление ответов неизвестного формата: большие
+        # вложенные значения обрезаются при построении строки, а не после
+        self._fallback_repr = reprlib.Repr()
+        self._fallback_repr.maxstring = self.max_text_length
+        self._fallback_repr.maxother = self.max_text_length
+        self._fallback_repr.maxdict = self._fallback_repr.maxlist = 100
 
     @traceable
     def synthesize(self, agent_response: dict, user_context: dict) -> dict:
@@ -49,11 +95,8 @@ class ResponseSynthesizer:
 
     def _format_text(self, response: dict, context: dict) -> dict:
         """Форматирует текстовый ответ с учетом лимитов Telegram"""
-        text = response["content"]
-        
         # Обрезаем длинные сообщения
-        if len(text) > self.max_text_length:
-            text = text[:self.max_text_length - 100] + "..." 
+        text = _truncate(response["content"], self.max_text_length, 100)
         
         # Добавляем разметку
         formatted_text = self._apply_telegram_formatting(text, context)
@@ -66,16 +109,12 @@ class ResponseSynthesizer:
 
     def _format_image(self, response: dict, context: dict) -> dict:
         """Форматирует ответ с изображением"""
-        # Проверка base64 данных
-        if not response["content"]["data"].startswith("data:image/png;base64,"):
-            image_data = f"data:image/png;base64,{response['content']['data']}"
-        else:
-            image_data = response["content"]["data"]
+        # Telegram принимает байты напрямую: base64 декодируется один раз,
+        # data URI не собирается
+        image_data = _decode_image(response["content"]["data"])
         
         # Форматирование подписи
-        caption = response.get("caption", "Результат анализа")
-        if len(caption) > self.max_caption_length:
-            caption = caption[:self.max_caption_length - 50] + "..."
+        caption = _truncate(response.get("caption", "Результат анализа"), self.max_caption_length, 50)
 
         formatted_caption = self._apply_telegram_formatting(caption, context)
         
@@ -113,11 +152,19 @@ class ResponseSynthesizer:
 
     def _generate_buttons(self, response: dict, context: dict) -> list:
         """Генерирует интерактивные кнопки для Telegram"""
-        buttons = []
+        # Ряды по 2 кнопки собираются сразу, без последующей нарезки списка
+        rows, row = [], []
+        
+        def add(button: InlineKeyboardButton):
+            nonlocal row
+            row.append(button)
+            if len(row) == 2:
+                rows.append(row)
+                row = []
         
         # 1. Кнопки действий из ответа агента
         for action in response.get("actions", []):
-            buttons.append(
+            add(
                 InlineKeyboardButton(
                     action["title"], 
                     callback_data=f"action:{action['command']}"
@@ -125,28 +172,25 @@ class ResponseSynthesizer:
             )
         
         # 2. Быстрые ответы (suggestions)
-        if "suggestions" in response:
-            for suggestion in response["suggestions"]:
-                buttons.append(
-                    InlineKeyboardButton(
-                        f"🔍 {suggestion}", 
-                        callback_data=f"quick:{suggestion[:30]}"
-                    )
+        for suggestion in response.get("suggestions", ()):
+            add(
+                InlineKeyboardButton(
+                    f"🔍 {suggestion}", 
+                    callback_data=f"quick:{suggestion[:30]}"
                 )
+            )
         
         # 3. Навигационные кнопки
-        buttons.append(
-            InlineKeyboardButton("📊 Новый запрос", callback_data="new_query")
-        )
+        add(InlineKeyboardButton("📊 Новый запрос", callback_data="new_query"))
         
-        # Группировка по 2 кнопки в ряд
-        return [buttons[i:i+2] for i in range(0, len(buttons), 2)]
+        if row:
+            rows.append(row)
+        return rows
 
     def _apply_telegram_formatting(self, text: str, context: dict) -> str:
         """Применяет Telegram-разметку к тексту"""
         # Автоматическое форматирование
-        formatted = re.sub(r'\*\*(.*?)\*\*', r'*\1*', text)  # Жирный -> Курсив
-        formatted = re.sub(r'__(.*?)__', r'_\1_', formatted)  # Подчеркивание
+        formatted = TELEGRAM_MARKUP_RE.sub(_telegram_markup, text)  # Жирный -> Курсив, подчеркивание
         
         # Добавление эмодзи по контексту
         if "analytics" in context.get("response_type", ""):
@@ -170,6 +214,6 @@ class ResponseSynthesizer:
         """Фолбэк для неизвестных форматов"""
         return {
             "type": "text",
-            "content": str(response)[:self.max_text_length],
+            "content": self._fallback_repr.repr(response)[:self.max_text_length],
             "buttons": []
         }
\ No newline at end of file
@@ -1,29 +1,146 @@
 from langsmith import traceable
-from gigachain import GigaChatModel
 import json
 import logging
 import config
-import time
+from config import Config
+import asyncio
+import threading
 from typing import Dict, List, Optional
+from services.fast_json import json_loads
+from services.llm_cache import ExactCache, SemanticCache
+from services.llm_client import get_llm
+from services.query_normalizer import normalize_query
+
+# Веса критериев углубленной маршрутизации: LLM вызывается, когда набран порог
+# или классификатор почти не уверен
+ENHANCE_WEIGHTS = {
+    "low_confidence": 2,
+    "long_history": 1,
+    "ambiguous_category": 1,
+    "require_flag": 3,
+}
+ENHANCE_SCORE_THRESHOLD = 3
+ENHANCE_FORCE_CONFIDENCE = 0.5
+AMBIGUOUS_CATEGORIES = frozenset({"other", "explanation", "mixed"})
+ROUTING_STATS_LOG_INTERVAL = 1000
+
+class HandlerHealthRegistry:
+    """
+    Реестр доступности и нагрузки обработчиков, общий для всех RouterAgent процесса:
+    один фоновый поток опрашивает монитор, route() читает готовые снимки
+    """
+    def __init__(self, system_monitor):
+        self.system_monitor = system_monitor
+        self.logger = logging.getLogger("router_agent")
+        self.status: Dict[str, bool] = {}
+        self.load: Dict[str, float] = {}
+        # Набор неизменяемый: изменения заменяют его целиком, фоновый поток читает снимок
+        self._watched = frozenset()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, *handlers: str):
+        """Добавляет обработчики в фоновый опрос"""
+        with self._lock:
+            if not self._watched.issuperset(handlers):
+                self._watched = self._watched.union(handlers)
+
+    def start(self):
+        """Запускает фоновый опрос, если он еще не запущен"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="router_health", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Останавливает фоновый опрос"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=Config.HEALTH_CHECK_INTERVAL)
+
+    def is_up(self, handler_name: str) -> bool:
+        """Статус обработчика из снимка; неизвестный опрашивается напрямую один раз"""
+        status = self.status.get(handler_name)
+        if status is None:
+            # Дальше обработчик обновляет фоновый поток
+            self.watch(handler_name)
+            status = bool(self.system_monitor.is_service_up(handler_name))
+            self.status = {**self.status, handler_name: status}
+        return status
+
+    def _run(self):
+        """Фоновая задача: периодически обновляет статус и нагрузку до вызова close()"""
+        while not self._stop.is_set():
+            try:
+                self._refresh()
+            except Exception as e:
+                self.logger.error(f"Handler health refresh failed: {str(e)}")
+            self._stop.wait(Config.HEALTH_CHECK_INTERVAL)
+
+    def _refresh(self):
+        """Опрашивает монитор и атомарно заменяет снимки статуса и нагрузки"""
+        monitor = self.system_monitor
+        monitor.check_all_services()
+        handlers = list(self._watched)
+        self.status = {handler: bool(monitor.is_service_up(handler)) for handler in handlers}
+        
+        # Нагрузка (p95 латентности / глубина очереди), если монитор ее предоставляет
+        get_load = getattr(monitor, "get_service_load", None)
+        if get_load is not None:
+            self.load = {handler: float(get_load(handler) or 0.0) for handler in handlers}
+
+# Общий реестр: агенты создаются на каждый запрос, поток опроса - один на процесс
+_health_registry: Optional[HandlerHealthRegistry] = None
+_health_registry_lock = threading.Lock()
+
+def get_health_registry(system_monitor) -> HandlerHealthRegistry:
+    """Возвращает общий реестр доступности обработчиков (запускает опрос при первом вызове)"""
+    global _health_registry
+    with _health_registry_lock:
+        if _health_registry is None:
+            _health_registry = HandlerHealthRegistry(system_monitor)
+        elif system_monitor is not None:
+            _health_registry.system_monitor = system_monitor
+    _health_registry.start()
+    return _health_registry
 
 class RouterAgent:
+    # Неизменные части ответов фолбэка: на запрос копируются и дополняются
+    _PRIORITY_FALLBACK_BASE = {"confidence": 0.3, "fallback_used": True}
+    _EMERGENCY_BASE = {"handler": "fallback_agent", "confidence": 0.1, "fallback_used": True, "llm_enhanced": False}
+    _EMERGENCY_PARAMS_BASE = {"error_details": "complete_system_failure"}
+
     def __init__(self, query_classifier, system_monitor):
         self.query_classifier = query_classifier
         self.system_monitor = system_monitor
         self.logger = logging.getLogger("router_agent")
         
-        # Инициализация GigaChain для улучшенной маршрутизации
-        self.llm = GigaChatModel(
-            model="GigaChat-Pro",
-            temperature=0.3,
-            api_key=config.GIGACHAT_API_KEY,
-            max_tokens=500
-        )
+        # Общий клиент GigaChain для улучшенной маршрутизации
+        self.llm = get_llm(temperature=0.3, max_tokens=500)
         
         self.routing_rules = self._load_routing_rules()
         self.fallback_priority = ["general_assistant", "fallback_agent"]
-        self.last_health_check = 0
-        self.context_analysis_cache = {}
+        # Реестр доступности обработчиков: обновляется фоновым потоком, route() монитор не опрашивает
+        self.health = get_health_registry(system_monitor)
+        self.health.watch(*self.fallback_priority)
+        for source, targets in self.routing_rules.items():
+            self.health.watch(source, *targets)
+        self.context_analysis_cache = ExactCache(
+            maxsize=Config.ROUTER_CACHE_SIZE, ttl=Config.ROUTER_CACHE_TTL, name="router_context"
+        )
+        # Близкие по смыслу формулировки получают ту же уточненную классификацию;
+        # точные совпадения проверяются в context_analysis_cache до вычисления эмбеддинга
+        self.enhancement_cache = SemanticCache(
+            self.llm, ttl=Config.ROUTER_CACHE_TTL, exact_cache=self.context_analysis_cache
+        )
+        self._router_prefix = self._build_router_prefix()
+        self._enhance_stats = {"enhanced": 0, "skipped": 0}
+        # Семафор async-вызовов LLM, создается при первом использовании
+        self._llm_slots = None
         
     @traceable
     def route(self, user_query: str, user_context: Dict, chat_history: List[Dict] = None) -> Dict:
@@ -42,9 +159,6 @@ class RouterAgent:
         }
         """
         try:
-            # Проверка системного статуса (с кешированием)
-            self._check_system_health()
-            
             # Базовая классификация запроса
             classification = self.query_classifier.classify_query(user_query, user_context)
             llm_enhanced = False
@@ -54,71 +168,117 @@ class RouterAgent:
                 classification = self._enhance_with_llm(
                     user_query, 
                     classification, 
-                    chat_history or [],
+                    (chat_history or [])[-3:],
                     user_context
                 )
                 llm_enhanced = True
                 self.logger.debug("Used LLM for enhanced routing")
             
-            # Определение основного обработчика
-            primary_handler = classification["handler"]
+            return self._dispatch(user_query, user_context, chat_history, classification, llm_enhanced)
             
-            # Проверка доступности обработчика
-            if self._is_handler_available(primary_handler):
-                return {
-                    "handler": primary_handler,
-                    "params": self._prepare_handler_params(
-                        primary_handler, 
-                        user_query, 
-                        user_context,
-                        chat_history,
-                        classification
-                    ),
-                    "confidence": classification["confidence"],
-                    "fallback_used": False,
-                    "llm_enhanced": llm_enhanced
-                }
-                
-            # Поиск альтернативы
-            return self._find_fallback(
-                primary_handler, 
-                user_query, 
-                user_context,
-                chat_history,
-                classification,
-                llm_enhanced
-            )
+        except Exception as e:
+            self.logger.error(f"Routing failed: {str(e)}")
+            return self._emergency_fallback(user_query, user_context, chat_history)
+
+    async def aroute(self, user_query: str, user_context: Dict, chat_history: List[Dict] = None) -> Dict:
+        """
+        Асинхронный вариант route: вызовы классификатора и LLM не блокируют event loop
+        :param user_query: Текст запроса пользователя
+        :param user_context: Контекст пользователя (роль, настройки)
+        :param chat_history: История диалога
+        :return: Решение о маршрутизации (как у route)
+        """
+        try:
+            if hasattr(self.query_classifier, "aclassify_query"):
+                classification = await self.query_classifier.aclassify_query(user_query, user_context)
+            else:
+                classification = await asyncio.to_thread(self.query_classifier.classify_query, user_query, user_context)
+            llm_enhanced = False
+            
+            if self._needs_enhanced_routing(classification, user_context, chat_history):
+                classification = await self._aenhance_with_llm(
+                    user_query,
+                    classification,
+                    (chat_history or [])[-3:],
+                    user_context
+                )
+                llm_enhanced = True
+                self.logger.debug("Used LLM for enhanced routing")
+            
+            return self._dispatch(user_query, user_context, chat_history, classification, llm_enhanced)
             
         except Exception as e:
             self.logger.error(f"Routing failed: {str(e)}")
             return self._emergency_fallback(user_query, user_context, chat_history)
 
+    def _dispatch(
+        self,
+        user_query: str,
+        user_context: Dict,
+        chat_history: List[Dict],
+        classification: Dict,
+        llm_enhanced: bool
+    ) -> Dict:
+        """Выбирает обработчик по итоговой классификации"""
+        # Определение основного обработчика
+        primary_handler = classification["handler"]
+        # Общие параметры собираются один раз и для основного обработчика, и для альтернатив
+        base_params = {
+            "query": user_query,
+            "user_context": user_context,
+            "chat_history": chat_history,
+            "classification": classification
+        }
+        
+        # Проверка доступности обработчика
+        if self._is_handler_available(primary_handler):
+            return {
+                "handler": primary_handler,
+                "params": self._prepare_handler_params(primary_handler, base_params),
+                "confidence": classification["confidence"],
+                "fallback_used": False,
+                "llm_enhanced": llm_enhanced
+            }
+            
+        # Поиск альтернативы
+        return self._find_fallback(primary_handler, base_params, llm_enhanced)
+
     def _needs_enhanced_routing(
         self, 
         classification: Dict, 
         context: Dict, 
         history: List[Dict]
     ) -> bool:
-        """Определяет, нужен ли углубленный LLM-анализ"""
-        # Критерии для улучшенной маршрутизации:
+        """Определяет, нужен ли углубленный LLM-анализ (критерии накапливаются в балл)"""
+        confidence = classification["confidence"]
+        score = 0
+        
         # 1. Низкая уверенность классификации
-        if classification["confidence"] < 0.7:
-            return True
+        if confidence < 0.7:
+            score += ENHANCE_WEIGHTS["low_confidence"]
             
         # 2. Сложный контекст (длинная история диалога)
         if history and len(history) > 3:
-            return True
+            score += ENHANCE_WEIGHTS["long_history"]
             
         # 3. Специальный флаг в контексте
         if context.get("require_llm_routing", False):
-            return True
+            score += ENHANCE_WEIGHTS["require_flag"]
             
         # 4. Неоднозначные категории
-        ambiguous_categories = ["other", "explanation", "mixed"]
-        if classification["category"] in ambiguous_categories:
-            return True
-            
-        return False
+        if classification["category"] in AMBIGUOUS_CATEGORIES:
+            score += ENHANCE_WEIGHTS["ambiguous_category"]
+        
+        needed = score >= ENHANCE_SCORE_THRESHOLD or confidence < ENHANCE_FORCE_CONFIDENCE
+        self._count_enhancement(needed)
+        return needed
+
+    def _count_enhancement(self, enhanced: bool):
+        """Учитывает решение об LLM-уточнении и периодически пишет долю пропусков в лог"""
+        self._enhance_stats["enhanced" if enhanced else "skipped"] += 1
+        total = self._enhance_stats["enhanced"] + self._enhance_stats["skipped"]
+        if total % ROUTING_STATS_LOG_INTERVAL == 0:
+            self.logger.info(f"LLM enhancement skipped for {self._enhance_stats['skipped'] / total:.1%} of {total} routed queries")
 
     def _enhance_with_llm(
         self, 
@@ -127,27 +287,75 @@ class RouterAgent:
         history: List[Dict],
         context: Dict
     ) -> Dict:
-        """Уточняет классификацию с помощью LLM"""
-        # Проверка кеша
-        cache_key = f"{query[:50]}-{context.get('user_id', '')}"
-        if cache_key in self.context_analysis_cache:
-            return self.context_analysis_cache[cache_key]
+        """Уточняет классификацию с помощью LLM (history - последние реплики диалога)"""
+        # Проверка кеша: эмбеддинг только нормализованного запроса (не промпта - его длинный
+        # статический префикс делает эмбеддинги разных запросов почти одинаковыми),
+        # пространство имен - роль и пользователь
+        normalized = normalize_query(query)
+        namespace = self._enhancement_namespace(context)
+        cached = self.enhancement_cache.lookup(normalized, namespace)
+        if cached is not None:
+            return cached
         
-        prompt = f"""Ты эксперт по маршрутизации запросов в аналитической системе. 
+        prompt = self._enhancement_prompt(query, classification, history, context)
+        response = self.llm.generate(prompt, response_format="json")
+        return self._apply_enhancement(response, classification, normalized, namespace)
+
+    async def _aenhance_with_llm(
+        self,
+        query: str,
+        classification: Dict,
+        history: List[Dict],
+        context: Dict
+    ) -> Dict:
+        """Асинхронно уточняет классификацию с помощью LLM"""
+        normalized = normalize_query(query)
+        namespace = self._enhancement_namespace(context)
+        cached = await asyncio.to_thread(self.enhancement_cache.lookup, normalized, namespace)
+        if cached is not None:
+            return cached
         
-### Запрос пользователя:
-{query}
+        prompt = self._enhancement_prompt(query, classification, history, context)
+        async with self._get_llm_slots():
+            if hasattr(self.llm, "agenerate"):
+                response = await self.llm.agenerate(prompt, response_format="json")
+            else:
+                response = await asyncio.to_thread(self.llm.generate, prompt, response_format="json")
+        return self._apply_enhancement(response, classification, normalized, namespace)
+
+    def _get_llm_slots(self) -> asyncio.Semaphore:
+        """Ограничитель одновременных async-вызовов LLM (создается в работающем event loop)"""
+        if self._llm_slots is None:
+            self._llm_slots = asyncio.Semaphore(Config.LLM_MAX_CONCURRENCY)
+        return self._llm_slots
+
+    def _enhancement_namespace(self, context: Dict) -> str:
+        """Пространство имен кеша уточненной классификации: роль и пользователь"""
+        return f"router|{context.get('role', 'неизвестно')}|{context.get('user_id', '')}"
+
+    def _enhancement_prompt(self, query: str, classification: Dict, history: List[Dict], context: Dict) -> str:
+        """Формирует промпт уточнения классификации: статический префикс, затем данные запроса"""
+        return self._router_prefix + f"""### Первоначальная классификация:
+- Категория: {classification['category']}
+- Уверенность: {classification['confidence']}
+- Обработчик: {classification['handler']}
 
 ### Контекст:
 - Роль: {context.get('role', 'неизвестно')}
 - Текущая задача: {context.get('current_task', 'не определена')}
 - История диалога (последние 3 реплики):
-{self._format_history(history[-3:])}
+{self._format_history(history)}
 
-### Первоначальная классификация:
-- Категория: {classification['category']}
-- Уверенность: {classification['confidence']}
-- Обработчик: {classification['handler']}
+### Запрос пользователя:
+{query}
+"""
+
+    def _build_router_prefix(self) -> str:
+        """
+        Неизменная часть промпта уточнения. Идет первой, чтобы провайдер
+        переиспользовал закешированный префикс между запросами
+        """
+        return """Ты эксперт по маршрутизации запросов в аналитической системе.
 
 ### Анализ:
 1. Соответствует ли категория сути запроса с учетом контекста?
@@ -155,15 +363,16 @@ class RouterAgent:
 3. Предложи оптимальный обработчик (analytics_pipeline, documentation_search, general_assistant, small_talk_agent, help_system)
 
 ### Требования к ответу:
-- Верни JSON формата {{"final_category": "...", "final_handler": "...", "confidence": 0.0-1.0, "reason": "..."}}
+- Верни JSON формата {"final_category": "...", "final_handler": "...", "confidence": 0.0-1.0, "reason": "..."}
 - Будь лаконичным в объяснении
 - Учитывай системные ограничения
+
 """
-        
-        response = self.llm.generate(prompt, response_format="json")
-        
+
+    def _apply_enhancement(self, response: str, classification: Dict, normalized_query: str, namespace: str) -> Dict:
+        """Разбирает ответ LLM и кеширует уточненную классификацию"""
         try:
-            enhanced = json.loads(response)
+            enhanced = json_loads(response)
             # Валидация ответа
             if "final_handler" not in enhanced or "confidence" not in enhanced:
                 raise ValueError("Invalid LLM response format")
@@ -176,7 +385,7 @@ class RouterAgent:
             }
             
             # Кеширование результата
-            self.context_analysis_cache[cache_key] = result
+            self.enhancement_cache.remember(normalized_query, result, namespace)
             return result
             
         except (json.JSONDecodeError, ValueError) as e:
@@ -188,43 +397,20 @@ class RouterAgent:
         if not history:
             return "История отсутствует"
             
-        return "\n".join([
-            f"{msg['role'].capitalize()}: {msg['content']}" 
-            for msg in history
-        ])
-
-    def _check_system_health(self):
-        """Проверяет статус систем с кешированием"""
-        current_time = time.time()
-        if current_time - self.last_health_check < 30:  # Кеш на 30 секунд
-            return
-            
-        self.last_health_check = current_time
-        self.system_monitor.check_all_services()
+        return "\n".join(f"{msg['role'].capitalize()}: {msg['content']}" for msg in history)
 
     def _is_handler_available(self, handler_name: str) -> bool:
         """Проверяет доступность обработчика"""
         # Всегда доступные обработчики
         if handler_name in ["fallback_agent", "general_assistant"]:
             return True
-            
-        return self.system_monitor.is_service_up(handler_name)
+        
+        return self.health.is_up(handler_name)
 
-    def _prepare_handler_params(
-        self, 
-        handler: str, 
-        query: str, 
-        context: Dict,
-        history: List[Dict],
-        classification: Dict
-    ) -> Dict:
-        """Формирует параметры для обработчика"""
-        base_params = {
-            "query": query,
-            "user_context": context,
-            "chat_history": history,
-            "classification": classification
-        }
+    def _prepare_handler_params(self, handler: str, base_params: Dict) -> Dict:
+        """Формирует параметры для обработчика: общие параметры плюс специфичные для него"""
+        query = base_params["query"]
+        context = base_params["user_context"]
         
         # Специфичные параметры
         if handler == "analytics_pipeline":
@@ -245,36 +431,27 @@ class RouterAgent:
         if handler == "general_assistant":
             return {
                 **base_params,
-                "require_full_explanation": classification["category"] == "explanation"
+                "require_full_explanation": base_params["classification"]["category"] == "explanation"
             }
             
         return base_params
 
-    def _find_fallback(
-        self, 
-        primary_handler: str, 
-        query: str, 
-        context: Dict,
-        history: List[Dict],
-        classification: Dict,
-        llm_enhanced: bool
-    ) -> Dict:
+    def _find_fallback(self, primary_handler: str, base_params: Dict, llm_enhanced: bool) -> Dict:
         """Поиск альтернативного обработчика"""
-        # 1. Поиск по правилам маршрутизации
+        query = base_params["query"]
+        context = base_params["user_context"]
+        history = base_params["chat_history"]
+        
+        # 1. Поиск по правилам маршрутизации (при равной нагрузке - в порядке правил)
         if primary_handler in self.routing_rules:
-            for alternative in self.routing_rules[primary_handler]:
+            alternatives = sorted(self.routing_rules[primary_handler], key=lambda h: self.health.load.get(h, 0.0))
+            for alternative in alternatives:
                 if self._is_handler_available(alternative):
                     self.logger.warning(f"Using alternative {alternative} for {primary_handler}")
                     return {
                         "handler": alternative,
-                        "params": self._prepare_handler_params(
-                            alternative, 
-                            query, 
-                            context,
-                            history,
-                            classification
-                        ),
-                        "confidence": max(0.1, classification["confidence"] - 0.2),
+                        "params": self._prepare_handler_params(alternative, base_params),
+                        "confidence": max(0.1, base_params["classification"]["confidence"] - 0.2),
                         "fallback_used": True,
                         "llm_enhanced": llm_enhanced
                     }
@@ -283,17 +460,11 @@ class RouterAgent:
         for handler in self.fallback_priority:
             if self._is_handler_available(handler):
                 self.logger.warning(f"Using priority fallback {handler}")
-                return {
-                    "handler": handler,
-                    "params": {
-                        "query": query,
-                        "user_context": context,
-                        "chat_history": history
-                    },
-                    "confidence": 0.3,
-                    "fallback_used": True,
-                    "llm_enhanced": llm_enhanced
-                }
+                result = self._PRIORITY_FALLBACK_BASE.copy()
+                result["handler"] = handler
+                result["params"] = {"query": query, "user_context": context, "chat_history": history}
+                result["llm_enhanced"] = llm_enhanced
+                return result
                 
         # 3. Аварийный фолбэк
         return self._emergency_fallback(query, context, history)
@@ -301,18 +472,9 @@ class RouterAgent:
     def _emergency_fallback(self, query: str, context: Dict, history: List[Dict]) -> Dict:
         """Аварийный фолбэк при полном сбое системы"""
         self.logger.critical("All systems down! Using emergency fallback")
-        return {
-            "handler": "fallback_agent",
-            "params": {
-                "query": query,
-                "user_context": context,
-                "chat_history": history,
-                "error_details": "complete_system_failure"
-            },
-            "confidence": 0.1,
-            "fallback_used": True,
-            "llm_enhanced": False
-        }
+        result = self._EMERGENCY_BASE.copy()
+        result["params"] = {"query": query, "user_context": context, "chat_history": history, **self._EMERGENCY_PARAMS_BASE}
+        return result
 
     def _load_routing_rules(self) -> Dict[str, List[str]]:
         """Загружает правила маршрутизации из конфигурации"""
@@ -325,14 +487,17 @@ class RouterAgent:
             
         if target_handler not in self.routing_rules[source_handler]:
             self.routing_rules[source_handler].append(target_handler)
+            self.health.watch(source_handler, target_handler)
             self.logger.info(f"Added dynamic route: {source_handler} -> {target_handler}")
 
     def update_fallback_priority(self, new_priority: List[str]):
         """Обновляет приоритет фолбэк-обработчиков"""
         self.fallback_priority = new_priority
+        self.health.watch(*new_priority)
         self.logger.info(f"Fallback priority updated: {new_priority}")
 
     def clear_cache(self):
         """Очищает кеш контекстного анализа"""
-        self.context_analysis_cache = {}
+        self.context_analysis_cache.clear()
+        self.enhancement_cache.clear()
         self.logger.info("Router context cache cleared")
\ No newline at end of file
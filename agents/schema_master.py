@@ -1,24 +1,71 @@
 from langsmith import traceable
-from gigachain import GigaChatModel
 import logging
-import config
+from config import Config
 import re
-import json
+import asyncio
+from collections import defaultdict
 from typing import Dict, List, Optional, Tuple
+from services.fast_json import json_dumps, json_loads
+from services.llm_cache import ExactCache, SemanticCache, astream_llm
+from services.llm_client import get_llm
+from services.query_normalizer import normalize_query
+
+try:
+    import sqlglot
+    from sqlglot.optimizer import optimize as sqlglot_optimize
+    from sqlglot import exp
+    from sqlglot.optimizer.simplify import simplify
+    from sqlglot.optimizer.scope import Scope, traverse_scope
+    SQLGLOT_AVAILABLE = True
+    # Узлы AST, недопустимые в аналитическом запросе (имена классов различаются между версиями sqlglot)
+    FORBIDDEN_SQL_NODES = tuple(
+        getattr(exp, name)
+        for name in ("Insert", "Update", "Delete", "Merge", "Drop", "Create", "Alter", "AlterTable",
+                     "TruncateTable", "Grant", "Command", "Into")
+        if hasattr(exp, name)
+    )
+except ImportError:
+    SQLGLOT_AVAILABLE = False
+
+# Ниже этой уверенности модели (и без совпадений по схеме) SQL перегенерируется по сущностям
+SQL_CONFIDENCE_THRESHOLD = 0.6
+# Минимальная длина слова запроса для поиска таблиц по имени/описанию
+SCHEMA_MATCH_MIN_WORD = 4
+# Слова имен и описаний таблиц (подчеркивание разделяет слова) и длина их основы в индексе:
+# совпадение по началу слова заменяет поиск подстроки и терпимо к окончаниям
+SCHEMA_TOKEN_RE = re.compile(r"[^\W_]+")
+SCHEMA_TOKEN_PREFIX = 5
+# Значение поля sql в потоке ответа - совпадает, как только строка закрыта
+SQL_FIELD_RE = re.compile(r'"sql"\s*:\s*"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
+# Политики безопасности SQL - компилируются один раз, каждая проверка за одно сканирование
+FORBIDDEN_SQL_RE = re.compile(
+    r"\b(?:INSERT|UPDATE|DELETE|DROP|TRUNCATE|GRANT|ALTER)\b"
+    r"|;\s*--"
+    r"|\b(?:1=1|TRUE)\b",
+    re.IGNORECASE
+)
+SQL_TABLE_RE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)", re.IGNORECASE)
+SENSITIVE_COLUMNS = ("password", "token", "credit_card")
+SENSITIVE_COLUMN_RE = re.compile(rf"\b({'|'.join(SENSITIVE_COLUMNS)})\b", re.IGNORECASE)
 
 class SchemaMaster:
     def __init__(self, db_schema: Dict):
         self.logger = logging.getLogger("schema_master")
-        self.llm = GigaChatModel(
-            model="GigaChat-Pro",
-            temperature=0.1,  # Минимум случайности для точности
-            api_key=config.GIGACHAT_API_KEY,
-            max_tokens=500
-        )
+        self.llm = get_llm(temperature=0.1, max_tokens=500)  # Минимум случайности для точности
         self.schema_version = "1.2"
         self.schema = self._validate_schema(db_schema)
-        self.schema_cache = {}
-        self.query_cache = {}
+        self.query_cache = ExactCache(maxsize=Config.SQL_CACHE_SIZE, ttl=Config.SQL_CACHE_TTL, name="sql")
+        # Проверенные результаты по смыслу запроса; точные совпадения - в query_cache
+        self.answer_cache = SemanticCache(
+            self.llm,
+            threshold=Config.SQL_SEMANTIC_CACHE_THRESHOLD,
+            ttl=Config.SQL_CACHE_TTL,
+            exact_cache=self.query_cache
+        )
+        self._sql_prefix = self._build_sql_prefix()
+        # Семафор async-вызовов LLM, создается при первом использовании
+        self._llm_slots = None
         
     def _validate_schema(self, schema: Dict) -> Dict:
         """Проверяет и нормализует схему БД"""
@@ -26,11 +73,26 @@ class SchemaMaster:
         if not all(key in schema for key in required_keys):
             raise ValueError("Invalid schema format")
             
-        # Нормализация названий таблиц/колонок
-        for table in schema["tables"]:
-            table["name"] = table["name"].lower()
+        # Нормализация названий таблиц/колонок и индексы для поиска без линейных проходов
+        self._tables_by_name = {}
+        self._columns_by_name = {}
+        self._table_position = {}
+        self._desc_index = defaultdict(set)
+        self._sqlglot_schema = {}
+        for position, table in enumerate(schema["tables"]):
+            name = table["name"] = table["name"].lower()
+            self._tables_by_name[name] = table
+            self._table_position[name] = position
             for column in table["columns"]:
                 column["name"] = column["name"].lower()
+                self._columns_by_name[(name, column["name"])] = column
+            self._sqlglot_schema[name] = {column["name"]: column["type"] for column in table["columns"]}
+            for token in SCHEMA_TOKEN_RE.findall(f"{name} {table.get('description', '')}".lower()):
+                self._desc_index[token[:SCHEMA_TOKEN_PREFIX]].add(name)
+        
+        # Производные представления схемы считаются один раз при загрузке
+        self._full_schema_summary = self._build_schema_summary(schema)
+        self._schema_json = self._dump_schema(schema)
                 
         return schema
 
@@ -49,48 +111,149 @@ class SchemaMaster:
             "security_checked": bool
         }
         """
-        # Проверка кеша
-        cache_key = f"{nl_query[:50]}-{user_context.get('role','')}"
-        if cache_key in self.query_cache:
+        # Проверка кеша: тот же или близкий по смыслу запрос при той же схеме, роли и доступных таблицах
+        normalized, namespace = normalize_query(nl_query), self._answer_namespace(user_context)
+        cached = self.answer_cache.lookup(normalized, namespace)
+        if cached is not None:
             self.logger.debug("Using cached SQL query")
-            return self.query_cache[cache_key]
+            return cached
         
         try:
-            # Генерация SQL через LLM
-            raw_sql = self._generate_with_llm(nl_query, user_context)
+            # Генерация, проверка синтаксиса и оптимизация одним вызовом LLM
+            generation = self._generate_with_llm(nl_query, user_context)
             
-            # Валидация и оптимизация
-            result = self._validate_and_optimize(raw_sql, user_context)
+            # Локальная проверка безопасности и разбор полей ответа
+            result = self._validate_generation(generation, user_context)
             
             # Кеширование
-            self.query_cache[cache_key] = result
+            self.answer_cache.remember(normalized, result, namespace)
             return result
             
         except Exception as e:
             self.logger.error(f"SQL generation failed: {str(e)}")
-            return {
-                "sql": "",
-                "validated": False,
-                "explanation": f"Ошибка генерации: {str(e)}",
-                "optimized": False,
-                "security_checked": False
-            }
+            return self._failed_result(e)
+
+    async def agenerate_sql(self, nl_query: str, user_context: Dict) -> Dict:
+        """
+        Асинхронный вариант generate_sql (число одновременных вызовов LLM ограничено)
+        :param nl_query: Запрос на естественном языке
+        :param user_context: Контекст пользователя (роль, доступ)
+        :return: Результат в формате generate_sql
+        """
+        normalized, namespace = normalize_query(nl_query), self._answer_namespace(user_context)
+        cached = await asyncio.to_thread(self.answer_cache.lookup, normalized, namespace)
+        if cached is not None:
+            self.logger.debug("Using cached SQL query")
+            return cached
+        
+        try:
+            generation = await self._agenerate_with_llm(nl_query, user_context)
+            result = self._validate_generation(generation, user_context)
+            await asyncio.to_thread(self.answer_cache.remember, normalized, result, namespace)
+            return result
+            
+        except Exception as e:
+            self.logger.error(f"SQL generation failed: {str(e)}")
+            return self._failed_result(e)
+
+    def _answer_namespace(self, context: Dict) -> str:
+        """Пространство имен кеша SQL: версия схемы, роль и доступные таблицы"""
+        allowed_tables = ",".join(sorted(context.get("allowed_tables", [])))
+        return f"sql|{self.schema_version}|{context.get('role', '')}|{allowed_tables}"
+
+    async def _acall_llm(self, prompt: str, **kwargs) -> str:
+        """Async-вызов LLM с ограничением числа одновременных запросов"""
+        async with self._get_llm_slots():
+            if hasattr(self.llm, "agenerate"):
+                return await self.llm.agenerate(prompt, **kwargs)
+            return await asyncio.to_thread(self.llm.generate, prompt, **kwargs)
+
+    def _get_llm_slots(self) -> asyncio.Semaphore:
+        """Ограничитель одновременных async-вызовов LLM (создается в работающем event loop)"""
+        if self._llm_slots is None:
+            self._llm_slots = asyncio.Semaphore(Config.LLM_MAX_CONCURRENCY)
+        return self._llm_slots
+
+    async def _astream_generation(self, prompt: str, context: Dict) -> Dict:
+        """
+        Потоковая генерация SQL: поле sql проверяется на безопасность, как только оно
+        закрыто в потоке; при нарушении генерация остальных полей прерывается
+        """
+        response = ""
+        sql_checked = False
+        async with self._get_llm_slots():
+            async for chunk in astream_llm(self.llm, prompt, response_format="json"):
+                response += chunk
+                if sql_checked:
+                    continue
+                match = SQL_FIELD_RE.search(response)
+                if match:
+                    sql_checked = True
+                    sql = json_loads(f'"{match.group(1)}"')
+                    statements, _ = self._parse_sql(sql)
+                    if not self._security_validation(sql, context, statements)["valid"]:
+                        self.logger.warning("Generated SQL failed security check, response stream aborted")
+                        return self._generation_fields({"sql": sql})
+        return self._parse_generation(response)
 
-    def _generate_with_llm(self, nl_query: str, context: Dict) -> str:
-        """Генерация SQL через LLM с учетом схемы"""
-        schema_context = self._get_relevant_schema(nl_query)
+    def _generate_with_llm(self, nl_query: str, context: Dict) -> Dict:
+        """Генерация SQL через LLM: запрос, проверка синтаксиса и оптимизация в одном ответе"""
+        schema_context, matched = self._select_schema(nl_query)
+        response = self.llm.generate(self._sql_prompt(nl_query, context, schema_context), response_format="json")
+        generation = self._parse_generation(response)
         
-        prompt = f"""Ты senior SQL разработчик. Сгенерируй PostgreSQL запрос для аналитической системы.
+        # Схема не сузилась по словам запроса, и модель не уверена - повторяем по сущностям
+        if not matched and generation["confidence"] < SQL_CONFIDENCE_THRESHOLD:
+            entities = generation["entities"] or self._extract_entities(nl_query)
+            if entities:
+                prompt = self._sql_prompt(nl_query, context, self._schema_for_entities(entities))
+                generation = self._parse_generation(self.llm.generate(prompt, response_format="json"))
+        return generation
 
-### Схема БД (версия {self.schema_version}):
+    async def _agenerate_with_llm(self, nl_query: str, context: Dict) -> Dict:
+        """Асинхронная генерация SQL через LLM (один потоковый вызов, как в _generate_with_llm)"""
+        schema_context, matched = self._select_schema(nl_query)
+        generation = await self._astream_generation(self._sql_prompt(nl_query, context, schema_context), context)
+        
+        if not matched and generation["confidence"] < SQL_CONFIDENCE_THRESHOLD:
+            entities = generation["entities"] or await self._aextract_entities(nl_query)
+            if entities:
+                prompt = self._sql_prompt(nl_query, context, self._schema_for_entities(entities))
+                generation = await self._astream_generation(prompt, context)
+        return generation
+
+    def _sql_prompt(self, nl_query: str, context: Dict, schema_context: str) -> str:
+        """Формирует промпт генерации SQL: статический префикс, затем схема и данные запроса"""
+        return self._sql_prefix + f"""### Схема БД (версия {self.schema_version}):
 {schema_context}
 
 ### Контекст пользователя:
 - Роль: {context.get('role', 'analyst')}
-- Доступные таблицы: {', '.join(context.get('allowed_tables', list(self.schema['tables'].keys())))}
+- Доступные таблицы: {', '.join(context.get('allowed_tables') or self._tables_by_name)}
 
 ### Запрос:
 {nl_query}
+"""
+
+    def _build_sql_prefix(self) -> str:
+        """
+        Неизменная часть промпта генерации SQL (инструкции и формат ответа).
+        Идет первой, чтобы провайдер переиспользовал закешированный префикс
+        """
+        if SQLGLOT_AVAILABLE:
+            # Синтаксис и оптимизация выполняются локально - модель их не генерирует
+            task, checks, check_fields = "", "", ""
+        else:
+            task = ", проверь его синтаксис и оптимизируй"
+            checks = """6. Проверь синтаксис запроса; если есть ошибки - перечисли их
+7. Оптимизируй запрос, сохранив функциональность
+"""
+            check_fields = """  "syntax_ok": true/false,
+  "syntax_errors": ["ошибка1"],
+  "optimized_sql": "ОПТИМИЗИРОВАННЫЙ_SQL",
+  "optimizations": ["список изменений"],
+"""
+        return f"""Ты senior SQL разработчик. Сгенерируй PostgreSQL запрос для аналитической системы{task}.
 
 ### Требования:
 1. Только SELECT запросы
@@ -98,20 +261,47 @@ class SchemaMaster:
 3. Всегда указывай таблицы для колонок (table.column)
 4. Никаких DML/DDL операций
 5. Учитывай ограничения ролей
+{checks}
+### Ответ (JSON):
+{{
+  "sql": "SQL_QUERY",
+  "entities": ["сущность1", "сущность2"],
+{check_fields}  "explanation": "Краткое объяснение",
+  "confidence": 0.0-1.0
+}}
 
-### Ответ:
-{{"sql": "SQL_QUERY", "explanation": "Краткое объяснение"}}
 """
-        
-        response = self.llm.generate(prompt, response_format="json")
-        result = json.loads(response)
-        return result["sql"]
-
-    def _get_relevant_schema(self, nl_query: str) -> str:
-        """Извлекает релевантные части схемы для запроса"""
-        # Определение ключевых сущностей
-        entities = self._extract_entities(nl_query)
-        
+
+    def _parse_generation(self, response: str) -> Dict:
+        """Разбирает структурированный ответ LLM один раз"""
+        return self._generation_fields(json_loads(response))
+
+    def _generation_fields(self, result: Dict) -> Dict:
+        """Приводит поля ответа LLM к полному набору со значениями по умолчанию"""
+        return {
+            "sql": result["sql"],
+            "entities": result.get("entities") or [],
+            "syntax_ok": bool(result.get("syntax_ok", True)),
+            "syntax_errors": result.get("syntax_errors") or [],
+            "optimized_sql": result.get("optimized_sql") or result["sql"],
+            "optimizations": result.get("optimizations") or [],
+            "explanation": result.get("explanation", ""),
+            "confidence": float(result.get("confidence", 1.0))
+        }
+
+    def _select_schema(self, nl_query: str) -> Tuple[str, bool]:
+        """
+        Локальный выбор релевантной схемы по словам запроса (без LLM)
+        :return: Описание схемы и признак того, что найдены конкретные таблицы
+        """
+        words = [word for word in normalize_query(nl_query).split() if len(word) >= SCHEMA_MATCH_MIN_WORD]
+        descriptions = self._related_table_descriptions(words)
+        if descriptions:
+            return "\n\n".join(descriptions), True
+        return self._get_full_schema_summary(), False
+
+    def _schema_for_entities(self, entities: List[str]) -> str:
+        """Описание схемы для найденных сущностей"""
         # Если найдены сущности - возвращаем связанные таблицы
         if entities:
             return self._describe_related_tables(entities)
@@ -121,83 +311,159 @@ class SchemaMaster:
 
     def _extract_entities(self, text: str) -> List[str]:
         """Извлекает ключевые сущности из запроса"""
-        prompt = f"""Извлеки ключевые бизнес-сущности из запроса:
+        response = self.llm.generate(self._entities_prompt(text), response_format="json")
+        return json_loads(response)
+
+    async def _aextract_entities(self, text: str) -> List[str]:
+        """Асинхронно извлекает ключевые сущности из запроса"""
+        response = await self._acall_llm(self._entities_prompt(text), response_format="json")
+        return json_loads(response)
+
+    def _entities_prompt(self, text: str) -> str:
+        """Формирует промпт извлечения сущностей"""
+        return f"""Извлеки ключевые бизнес-сущности из запроса:
         
 Запрос: "{text}"
 
 Выведи JSON-список: ["сущность1", "сущность2"]"""
-        
-        response = self.llm.generate(prompt, response_format="json")
-        return json.loads(response)
 
     def _describe_related_tables(self, entities: List[str]) -> str:
         """Описание таблиц, связанных с сущностями"""
+        return "\n\n".join(self._related_table_descriptions(entities)) or self._get_full_schema_summary()
+
+    def _related_table_descriptions(self, entities: List[str]) -> List[str]:
+        """Описания таблиц, в имени или описании которых есть слова сущности (без повторов)"""
         schema_description = []
+        seen = set()
         
         for entity in entities:
-            entity_lower = entity.lower()
-            # Поиск таблиц по имени или описанию
-            for table in self.schema["tables"]:
-                if (entity_lower in table["name"] or 
-                    entity_lower in table.get("description", "").lower()):
-                    
-                    # Форматирование описания таблицы
-                    desc = f"Таблица: {table['name']}\n"
-                    desc += f"Описание: {table.get('description', 'нет описания')}\n"
-                    desc += "Колонки:\n"
-                    
-                    for col in table["columns"]:
-                        desc += f"- {col['name']}: {col['type']}"
-                        if "description" in col:
-                            desc += f" ({col['description']})"
-                        desc += "\n"
-                    
-                    schema_description.append(desc)
+            # Поиск таблиц по индексу слов имени и описания
+            matched = set()
+            for token in SCHEMA_TOKEN_RE.findall(entity.lower()):
+                matched |= self._desc_index.get(token[:SCHEMA_TOKEN_PREFIX], set())
+            
+            # Таблицы выводятся в порядке схемы
+            for name in sorted(matched - seen, key=self._table_position.__getitem__):
+                seen.add(name)
+                schema_description.append(self._format_table(self._tables_by_name[name]))
         
-        return "\n\n".join(schema_description) or self._get_full_schema_summary()
+        return schema_description
 
-    def _get_full_schema_summary(self) -> str:
-        """Возвращает сжатое описание всей схемы"""
-        if "full_summary" in self.schema_cache:
-            return self.schema_cache["full_summary"]
-            
-        summary = f"База: {self.schema['metadata']['db_name']}\n"
-        summary += f"Таблицы ({len(self.schema['tables'])}):\n"
+    def _format_table(self, table: Dict) -> str:
+        """Форматирование описания таблицы для промпта"""
+        desc = f"Таблица: {table['name']}\n"
+        desc += f"Описание: {table.get('description', 'нет описания')}\n"
+        desc += "Колонки:\n"
         
-        for table in self.schema["tables"]:
-            summary += f"- {table['name']}: {table.get('description', '')} "
-            summary += f"({len(table['columns'])} колонок)\n"
+        for col in table["columns"]:
+            desc += f"- {col['name']}: {col['type']}"
+            if "description" in col:
+                desc += f" ({col['description']})"
+            desc += "\n"
         
-        self.schema_cache["full_summary"] = summary
-        return summary
+        return desc
+
+    def _get_full_schema_summary(self) -> str:
+        """Возвращает сжатое описание всей схемы"""
+        return self._full_schema_summary
+
+    def _build_schema_summary(self, schema: Dict) -> str:
+        """Строит сжатое описание всей схемы"""
+        lines = [
+            f"База: {schema['metadata']['db_name']}",
+            f"Таблицы ({len(schema['tables'])}):"
+        ]
+        for table in schema["tables"]:
+            lines.append(f"- {table['name']}: {table.get('description', '')} ({len(table['columns'])} колонок)")
+        return "\n".join(lines) + "\n"
 
-    def _validate_and_optimize(self, sql: str, context: Dict) -> Dict:
-        """Проверка и оптимизация SQL-запроса"""
+    def _dump_schema(self, schema: Dict) -> str:
+        """Компактная JSON-сериализация схемы для промпта"""
+        return json_dumps(schema)
+
+    def _validate_generation(self, generation: Dict, context: Dict) -> Dict:
+        """Проверка результата генерации: безопасность локально, синтаксис и оптимизация - через sqlglot или из ответа LLM"""
+        sql = generation["sql"]
+        # Один разбор на все проверки
+        statements, parse_error = self._parse_sql(sql)
+        
         # 1. Проверка безопасности
-        security_check = self._security_validation(sql, context)
+        security_check = self._security_validation(sql, context, statements)
         if not security_check["valid"]:
-            return {
-                "sql": sql,
-                "validated": False,
-                "explanation": security_check["reason"],
-                "optimized": False,
-                "security_checked": False
-            }
+            return self._rejected_result(sql, security_check["reason"], security_checked=False)
         
         # 2. Синтаксическая проверка
-        syntax_check = self._syntax_validation(sql)
+        syntax_check = self._syntax_validation(generation, parse_error)
         if not syntax_check["valid"]:
-            return {
-                "sql": sql,
-                "validated": False,
-                "explanation": syntax_check["reason"],
-                "optimized": False,
-                "security_checked": True
-            }
+            return self._rejected_result(sql, syntax_check["reason"], security_checked=True)
         
         # 3. Оптимизация
-        optimized_sql, optimization_report = self._optimize_query(sql)
+        return self._optimized_result(*self._optimize_query(sql, generation, context, statements))
+
+    def _parse_sql(self, sql: str) -> Tuple[Optional[List], Optional[str]]:
+        """
+        Разбирает SQL через sqlglot
+        :return: Список выражений (None без sqlglot или при ошибке) и описание ошибки разбора
+        """
+        if not SQLGLOT_AVAILABLE:
+            return None, None
+        try:
+            statements = [statement for statement in sqlglot.parse(sql, read="postgres") if statement is not None]
+        except sqlglot.errors.ParseError as e:
+            errors = ", ".join(
+                f"{error['description']} (строка {error['line']}, позиция {error['col']})" for error in e.errors
+            ) or str(e)
+            return None, errors
+        return statements, None
+
+    def _syntax_validation(self, generation: Dict, parse_error: Optional[str]) -> Dict:
+        """Проверка синтаксиса: результат разбора sqlglot, без него - поля ответа LLM"""
+        if not SQLGLOT_AVAILABLE:
+            if generation["syntax_ok"]:
+                return {"valid": True, "reason": "Синтаксис корректен"}
+            errors = ", ".join(generation["syntax_errors"]) or "не указаны"
+            return {"valid": False, "reason": f"Ошибки: {errors}"}
+        
+        if parse_error:
+            return {"valid": False, "reason": f"Ошибки: {parse_error}"}
+        return {"valid": True, "reason": "Синтаксис корректен"}
+
+    def _optimize_query(self, sql: str, generation: Dict, context: Dict, statements: Optional[List]) -> Tuple[str, str]:
+        """Оптимизация SQL: локальные AST-преобразования sqlglot, без него - вариант из ответа LLM"""
+        if statements:
+            return self._optimize_locally(statements[0])
+        
+        # Вариант оптимизатора тоже проверяется, иначе остается исходный запрос
+        optimized_sql = generation["optimized_sql"]
+        if optimized_sql != sql and not self._security_validation(optimized_sql, context)["valid"]:
+            self.logger.warning("Optimized SQL failed security check, keeping original query")
+            optimized_sql = sql
+        return optimized_sql, "; ".join(generation["optimizations"]) or generation["explanation"]
+
+    def _optimize_locally(self, tree) -> Tuple[str, str]:
+        """Оптимизация дерева запроса через sqlglot (новых таблиц и операций не добавляет)"""
+        # Полный оптимизатор переименовывает безымянные выражения (_col_N), для них - только упрощение
+        if all(select.alias_or_name for select in tree.selects):
+            try:
+                optimized = sqlglot_optimize(tree, schema=self._sqlglot_schema, dialect="postgres", identify=False)
+                return optimized.sql(dialect="postgres"), "Локальная оптимизация: квалификация колонок, проталкивание предикатов, упрощение выражений"
+            except Exception as e:
+                self.logger.debug(f"sqlglot optimizer failed, using simplify only: {str(e)}")
         
+        return simplify(tree.copy()).sql(dialect="postgres"), "Локальная оптимизация: упрощение выражений"
+
+    def _rejected_result(self, sql: str, reason: str, security_checked: bool) -> Dict:
+        """Результат для запроса, не прошедшего проверку"""
+        return {
+            "sql": sql,
+            "validated": False,
+            "explanation": reason,
+            "optimized": False,
+            "security_checked": security_checked
+        }
+
+    def _optimized_result(self, optimized_sql: str, optimization_report: str) -> Dict:
+        """Результат для проверенного и оптимизированного запроса"""
         return {
             "sql": optimized_sql,
             "validated": True,
@@ -206,125 +472,131 @@ class SchemaMaster:
             "security_checked": True
         }
 
-    def _security_validation(self, sql: str, context: Dict) -> Dict:
-        """Проверка на соответствие политикам безопасности"""
-        # 1. Проверка запрещенных операций
-        forbidden_patterns = [
-            r"\b(INSERT|UPDATE|DELETE|DROP|TRUNCATE|GRANT|ALTER)\b",
-            r";\s*--",
-            r"\b(1=1|TRUE)\b"
-        ]
+    def _failed_result(self, error: Exception) -> Dict:
+        """Результат при ошибке генерации"""
+        return {
+            "sql": "",
+            "validated": False,
+            "explanation": f"Ошибка генерации: {str(error)}",
+            "optimized": False,
+            "security_checked": False
+        }
+
+    def _security_validation(self, sql: str, context: Dict, statements: Optional[List] = None) -> Dict:
+        """Проверка на соответствие политикам безопасности (по AST, если запрос разобран, иначе по шаблонам)"""
+        if statements is not None:
+            return self._ast_security_validation(statements, context)
         
-        for pattern in forbidden_patterns:
-            if re.search(pattern, sql, re.IGNORECASE):
-                return {
-                    "valid": False,
-                    "reason": f"Обнаружена запрещенная операция: {pattern}"
-                }
+        # 1. Проверка запрещенных операций (одно сканирование)
+        match = FORBIDDEN_SQL_RE.search(sql)
+        if match:
+            return {
+                "valid": False,
+                "reason": f"Обнаружена запрещенная операция: {match.group(0)}"
+            }
         
         # 2. Проверка доступности таблиц
         allowed_tables = context.get("allowed_tables", [])
         if allowed_tables:
-            table_pattern = r"\b(FROM|JOIN)\s+(\w+)"
-            used_tables = set()
-            
-            for match in re.finditer(table_pattern, sql, re.IGNORECASE):
-                table_name = match.group(2).lower()
+            for match in SQL_TABLE_RE.finditer(sql):
+                table_name = match.group(1).lower()
                 if table_name not in allowed_tables:
                     return {
                         "valid": False,
                         "reason": f"Нет доступа к таблице: {table_name}"
                     }
-                used_tables.add(table_name)
         
         # 3. Проверка чувствительных колонок
-        sensitive_columns = ["password", "token", "credit_card"]
-        for col in sensitive_columns:
-            if re.search(rf"\b{col}\b", sql, re.IGNORECASE):
-                return {
-                    "valid": False,
-                    "reason": f"Попытка доступа к чувствительной колонке: {col}"
-                }
+        match = SENSITIVE_COLUMN_RE.search(sql)
+        if match:
+            return {
+                "valid": False,
+                "reason": f"Попытка доступа к чувствительной колонке: {match.group(1).lower()}"
+            }
         
         return {"valid": True, "reason": "Проверка пройдена"}
 
-    def _syntax_validation(self, sql: str) -> Dict:
-        """Проверка синтаксиса через LLM"""
-        prompt = f"""Проверь SQL запрос на синтаксические ошибки (PostgreSQL):
-
-Запрос:
-{sql}
-
-Если есть ошибки - исправь их и объясни. Ответ в формате:
-{{
-  "valid": true/false,
-  "corrected_sql": "ИСПРАВЛЕННЫЙ_SQL",
-  "errors": ["ошибка1", "ошибка2"]
-}}"""
+    def _ast_security_validation(self, statements: List, context: Dict) -> Dict:
+        """Проверка политик безопасности по дереву запроса sqlglot"""
+        # 1. Ровно один запрос на чтение без DML/DDL в подзапросах и CTE
+        if len(statements) != 1:
+            return {"valid": False, "reason": "Допускается ровно один SQL-запрос"}
+        tree = statements[0]
+        forbidden = tree if not isinstance(tree, exp.Query) else tree.find(*FORBIDDEN_SQL_NODES)
+        if forbidden is not None:
+            return {
+                "valid": False,
+                "reason": f"Обнаружена запрещенная операция: {type(forbidden).__name__.upper()}"
+            }
         
-        response = self.llm.generate(prompt, response_format="json")
-        result = json.loads(response)
+        # Тавтологии в условиях (1=1, TRUE)
+        for where in tree.find_all(exp.Where):
+            for node in where.find_all(exp.EQ, exp.Boolean):
+                if (isinstance(node, exp.Boolean) and node.this) or (
+                    isinstance(node, exp.EQ) and isinstance(node.left, exp.Literal) and node.left == node.right
+                ):
+                    return {"valid": False, "reason": f"Обнаружена запрещенная операция: {node.sql()}"}
         
-        if result["valid"]:
-            return {"valid": True, "reason": "Синтаксис корректен"}
-            
-        return {
-            "valid": False,
-            "reason": f"Ошибки: {', '.join(result['errors'])}. Исправленный запрос: {result['corrected_sql']}"
-        }
-
-    def _optimize_query(self, sql: str) -> Tuple[str, str]:
-        """Оптимизация SQL-запроса"""
-        prompt = f"""Оптимизируй SQL запрос для аналитической БД (PostgreSQL):
-
-Исходный запрос:
-{sql}
-
-Учти:
-- Используй современные методы оптимизации
-- Добавь комментарии с объяснением изменений
-- Сохрани функциональность
-
-Ответ в формате:
-{{
-  "optimized_sql": "ОПТИМИЗИРОВАННЫЙ_SQL",
-  "optimizations": ["список изменений"]
-}}"""
+        # 2. Проверка доступности таблиц (ссылки на CTE, видимые в своей области, таблицами не считаются)
+        allowed_tables = context.get("allowed_tables", [])
+        if allowed_tables:
+            cte_refs = self._cte_references(tree)
+            for table in tree.find_all(exp.Table):
+                if id(table) in cte_refs or not table.name:
+                    continue
+                # Схема и каталог сравниваются вместе с именем: other_schema.orders - не orders
+                table_name = ".".join(part for part in (table.catalog, table.db, table.name) if part).lower()
+                if table_name not in allowed_tables:
+                    return {
+                        "valid": False,
+                        "reason": f"Нет доступа к таблице: {table_name}"
+                    }
         
-        response = self.llm.generate(prompt, response_format="json")
-        result = json.loads(response)
+        # 3. Проверка чувствительных колонок
+        for column in tree.find_all(exp.Column):
+            if column.name.lower() in SENSITIVE_COLUMNS:
+                return {
+                    "valid": False,
+                    "reason": f"Попытка доступа к чувствительной колонке: {column.name.lower()}"
+                }
         
-        return result["optimized_sql"], "; ".join(result["optimizations"])
+        return {"valid": True, "reason": "Проверка пройдена"}
+
+    def _cte_references(self, tree) -> set:
+        """
+        id узлов Table, которые в своей области видимости разрешаются в CTE
+        (или производную таблицу), а не в реальную таблицу БД.
+        Нерекурсивный CTE не видит сам себя: WITH t AS (SELECT * FROM t) читает таблицу t
+        """
+        try:
+            return {
+                id(table)
+                for scope in traverse_scope(tree)
+                for table in scope.tables
+                if isinstance(scope.sources.get(table.alias_or_name), Scope)
+            }
+        except Exception as e:
+            # Без разрешения областей проверяется каждая ссылка как реальная таблица
+            self.logger.warning(f"Scope resolution failed: {str(e)}")
+            return set()
 
     def get_table_description(self, table_name: str) -> Optional[Dict]:
         """Возвращает описание таблицы по имени"""
-        table_name = table_name.lower()
-        for table in self.schema["tables"]:
-            if table["name"] == table_name:
-                return table
-        return None
+        return self._tables_by_name.get(table_name.lower())
 
     def get_column_info(self, table_name: str, column_name: str) -> Optional[Dict]:
         """Возвращает информацию о колонке"""
-        table = self.get_table_description(table_name)
-        if not table:
-            return None
-            
-        column_name = column_name.lower()
-        for col in table["columns"]:
-            if col["name"] == column_name:
-                return col
-        return None
+        return self._columns_by_name.get((table_name.lower(), column_name.lower()))
 
     def explain_schema_changes(self, old_schema: Dict, new_schema: Dict) -> str:
         """Генерирует объяснение изменений схемы"""
         prompt = f"""Сравни две версии схемы БД и объясни изменения:
 
 ### Старая схема (v{old_schema.get('version', '1.0')}):
-{json.dumps(old_schema, indent=2)}
+{self._schema_json if old_schema is self.schema else self._dump_schema(old_schema)}
 
 ### Новая схема (v{new_schema.get('version', '2.0')}):
-{json.dumps(new_schema, indent=2)}
+{self._schema_json if new_schema is self.schema else self._dump_schema(new_schema)}
 
 Сформулируй краткий отчет:
 - Добавленные таблицы/колонки
@@ -334,8 +606,18 @@ class SchemaMaster:
         
         return self.llm.generate(prompt)
 
+    def update_schema(self, db_schema: Dict, schema_version: str):
+        """
+        Загружает новую версию схемы; закешированные SQL для старой схемы сбрасываются
+        :param db_schema: Новая схема БД
+        :param schema_version: Версия схемы
+        """
+        self.schema = self._validate_schema(db_schema)
+        self.schema_version = schema_version
+        self.clear_cache()
+
     def clear_cache(self):
         """Очищает кеши"""
-        self.schema_cache = {}
-        self.query_cache = {}
+        self.query_cache.clear()
+        self.answer_cache.clear()
         self.logger.info("SchemaMaster caches cleared")
\ No newline at end of file
@@ -1,12 +1,65 @@
 from langsmith import traceable
 from gigachain import GigaChatModel
 import requests
+import httpx
 import logging
 import config
+from config import Config
 import random
 import datetime
+import time
 import json
+import re
+import asyncio
 from typing import Dict, List, Optional
+from services.http_session import build_session
+from services.llm_cache import ExactCache, SemanticCache
+
+# Ключевые слова типов small talk в порядке приоритета: первая совпавшая категория побеждает
+_TALK_KEYWORDS = (
+    ("greeting", ("привет", "здравствуй", "добрый", "хай", "здорово")),
+    ("mood", ("как дела", "как жизнь", "настроение", "чувствуешь")),
+    ("weather", ("погода", "дождь", "снег", "солнце", "температура")),
+    ("news", ("новости", "события", "происшествия", "обновления")),
+    ("personal", ("ты", "твое имя", "твои интересы", "кто тебя создал")),
+    ("about_ai", ("ии", "искусственный интеллект", "нейросеть", "чатбот")),
+)
+# Один скомпилированный паттерн на категорию - одно сканирование строки вместо цикла по словам
+_CLASSIFIER_PATTERNS = tuple(
+    (label, re.compile("|".join(map(re.escape, words))))
+    for label, words in _TALK_KEYWORDS
+)
+
+# Частые города: основа слова -> название для API погоды (без LLM-извлечения локации)
+_KNOWN_CITIES = {
+    "москв": "Москва",
+    "петербург": "Санкт-Петербург",
+    "питер": "Санкт-Петербург",
+    "новосибирск": "Новосибирск",
+    "екатеринбург": "Екатеринбург",
+    "казан": "Казань",
+}
+_CITY_RE = re.compile("|".join(map(re.escape, _KNOWN_CITIES)))
+
+WEATHER_API_URL = "http://api.openweathermap.org/data/2.5/weather"
+NEWS_API_URL = "https://newsapi.org/v2/top-headlines"
+HTTP_TIMEOUT = (2, 5)  # (соединение, чтение), секунд
+NEWS_COUNTRY = "ru"
+
+# Время жизни погоды и новостей в кеше (секунд)
+WEATHER_CACHE_TTL = 300
+NEWS_CACHE_TTL = 600
+# Город, извлеченный LLM из запроса, - по точному совпадению запроса (секунд)
+LOCATION_CACHE_TTL = 3600
+
+# Заглушки для демо при недоступности внешних API
+_WEATHER_STUB = {
+    "Москва": {"temp": 18, "description": "легкий дождь", "humidity": 75},
+    "Санкт-Петербург": {"temp": 15, "description": "облачно", "humidity": 80},
+    "Новосибирск": {"temp": 22, "description": "ясно", "humidity": 45}
+}
+_WEATHER_STUB_DEFAULT = {"temp": 20, "description": "ясно", "humidity": 60}
+_NEWS_STUB = "1. ИИ научился предсказывать погоду с точностью 95%\n2. Компания ТехноКорп запустила новый аналитический модуль\n3. Учёные создали нейросеть для диагностики заболеваний"
 
 class SmallTalkAgent:
     def __init__(self):
@@ -23,8 +76,34 @@ class SmallTalkAgent:
             "interests": ["технологии", "аналитика данных", "искусственный интеллект"],
             "response_style": "неформальный с юмором"
         }
-        self.user_profiles = {}
-        self.response_cache = {}
+        # Профили в памяти ограничены LRU + TTL: неактивные пользователи вытесняются
+        self.user_profiles = ExactCache(Config.PROFILE_CACHE_SIZE, Config.PROFILE_CACHE_TTL, name="small_talk_profiles")
+        # Точные и семантически близкие повторы не доходят до GigaChat
+        self.llm_cache = SemanticCache(self.llm)
+        # Тип small talk -> обработчик; async-версии только у обработчиков с сетевым I/O
+        self._handlers = {
+            "greeting": self._handle_greeting,
+            "mood": self._handle_mood,
+            "weather": self._handle_weather,
+            "news": self._handle_news,
+            "personal": self._handle_personal,
+            "about_ai": self._handle_ai_questions,
+        }
+        self._async_handlers = {
+            "weather": self._ahandle_weather,
+            "news": self._ahandle_news,
+            "about_ai": self._ahandle_ai_questions,
+            "general": self._ahandle_general,
+        }
+        # Пул соединений к API погоды и новостей с повтором временных ошибок
+        self.http = build_session(Config.MAX_RETRIES)
+        self._async_http = None
+        # Погода по городу и новости по стране - одно обращение к API на окно TTL
+        self.weather_cache = ExactCache(512, WEATHER_CACHE_TTL, name="small_talk_weather")
+        self.news_cache = ExactCache(16, NEWS_CACHE_TTL, name="small_talk_news")
+        # Семантически близкие запросы могут называть разные города - только точное совпадение
+        self.location_cache = ExactCache(1024, LOCATION_CACHE_TTL, name="small_talk_location")
+        self._llm_slots = None
         
     @traceable
     def respond(self, user_query: str, user_context: Dict) -> Dict:
@@ -42,72 +121,112 @@ class SmallTalkAgent:
             talk_type = self._classify_talk_type(user_query)
             
             # Генерация ответа
-            if talk_type == "greeting":
-                return self._handle_greeting(user_query, user_context)
-            elif talk_type == "mood":
-                return self._handle_mood(user_query, user_context)
-            elif talk_type == "weather":
-                return self._handle_weather(user_query, user_context)
-            elif talk_type == "news":
-                return self._handle_news(user_query, user_context)
-            elif talk_type == "personal":
-                return self._handle_personal(user_query, user_context)
-            elif talk_type == "about_ai":
-                return self._handle_ai_questions(user_query, user_context)
-            else:
-                return self._handle_general(user_query, user_context)
+            handler = self._handlers.get(talk_type, self._handle_general)
+            return handler(user_query, user_context)
+                
+        except Exception as e:
+            self.logger.error(f"Small talk error: {str(e)}")
+            return self._fallback_response(user_query)
+
+    async def arespond(self, user_query: str, user_context: Dict) -> Dict:
+        """
+        Асинхронный вариант respond: запросы к LLM и внешним API не блокируют event loop
+        :param user_query: Текст запроса пользователя
+        :param user_context: Контекст пользователя (имя, история, предпочтения)
+        :return: Ответ в формате {"response": текст, "suggestions": [варианты], "mood": настроение}
+        """
+        try:
+            self._update_user_profile(user_context)
+            talk_type = self._classify_talk_type(user_query)
+            
+            handler = self._async_handlers.get(talk_type)
+            if handler is not None:
+                return await handler(user_query, user_context)
+            # Шаблонные ответы без I/O
+            return self._handlers[talk_type](user_query, user_context)
                 
         except Exception as e:
             self.logger.error(f"Small talk error: {str(e)}")
             return self._fallback_response(user_query)
 
+    def _generate(self, prompt: str, namespace: Optional[str], **kwargs) -> str:
+        """Вызов LLM через семантический кеш; без пространства имен - напрямую"""
+        if namespace is None:
+            return self.llm.generate(prompt, **kwargs)
+        return self.llm_cache.generate(prompt, namespace=namespace, **kwargs)
+
+    async def _agenerate(self, prompt: str, namespace: Optional[str], **kwargs) -> str:
+        """
+        Асинхронный вызов LLM с ограничением числа одновременных запросов
+        :param namespace: Пространство имен семантического кеша; None - без кеша
+        """
+        async with self._get_llm_slots():
+            if namespace is not None:
+                return await self.llm_cache.agenerate(prompt, namespace=namespace, **kwargs)
+            if hasattr(self.llm, "agenerate"):
+                return await self.llm.agenerate(prompt, **kwargs)
+            return await asyncio.to_thread(self.llm.generate, prompt, **kwargs)
+
+    def _get_llm_slots(self) -> asyncio.Semaphore:
+        """Лениво создает семафор (в контексте работающего event loop)"""
+        if self._llm_slots is None:
+            self._llm_slots = asyncio.Semaphore(Config.LLM_MAX_CONCURRENCY)
+        return self._llm_slots
+
+    def _get_http(self) -> httpx.AsyncClient:
+        """Лениво создает общий async HTTP-клиент для погоды и новостей"""
+        if self._async_http is None or self._async_http.is_closed:
+            self._async_http = httpx.AsyncClient(
+                timeout=httpx.Timeout(HTTP_TIMEOUT[1], connect=HTTP_TIMEOUT[0]),
+                transport=httpx.AsyncHTTPTransport(
+                    retries=Config.MAX_RETRIES,
+                    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+                )
+            )
+        return self._async_http
+
+    async def aclose(self):
+        """Закрывает async HTTP-клиент"""
+        if self._async_http is not None and not self._async_http.is_closed:
+            await self._async_http.aclose()
+
     def _update_user_profile(self, context: Dict):
         """Обновляет профиль пользователя в памяти"""
         user_id = context.get("user_id")
         if not user_id:
             return
-            
-        if user_id not in self.user_profiles:
-            self.user_profiles[user_id] = {
+        
+        # Время храним числом (нс), в ISO форматируем только при чтении профиля
+        now_ns = time.time_ns()
+        profile = self.user_profiles.get(user_id)
+        if profile is None:
+            profile = {
                 "name": context.get("name", "друг"),
                 "interaction_count": 0,
                 "preferred_topics": [],
-                "last_interaction": datetime.datetime.now().isoformat()
             }
         
-        self.user_profiles[user_id]["interaction_count"] += 1
-        self.user_profiles[user_id]["last_interaction"] = datetime.datetime.now().isoformat()
+        profile["interaction_count"] += 1
+        profile["last_interaction_ns"] = now_ns
+        # Повторная запись продлевает TTL активного пользователя
+        self.user_profiles.set(user_id, profile)
+
+    def _user_name(self, context: Dict) -> str:
+        """Имя пользователя из профиля"""
+        profile = self.user_profiles.get(context.get("user_id"))
+        return profile["name"] if profile else "друг"
 
     def _classify_talk_type(self, query: str) -> str:
         """Классифицирует тип разговорного запроса"""
         query_lower = query.lower()
-        
-        greeting_words = ["привет", "здравствуй", "добрый", "хай", "здорово"]
-        mood_words = ["как дела", "как жизнь", "настроение", "чувствуешь"]
-        weather_words = ["погода", "дождь", "снег", "солнце", "температура"]
-        news_words = ["новости", "события", "происшествия", "обновления"]
-        personal_words = ["ты", "твое имя", "твои интересы", "кто тебя создал"]
-        ai_words = ["ии", "искусственный интеллект", "нейросеть", "чатбот"]
-        
-        if any(word in query_lower for word in greeting_words):
-            return "greeting"
-        if any(word in query_lower for word in mood_words):
-            return "mood"
-        if any(word in query_lower for word in weather_words):
-            return "weather"
-        if any(word in query_lower for word in news_words):
-            return "news"
-        if any(word in query_lower for word in personal_words):
-            return "personal"
-        if any(word in query_lower for word in ai_words):
-            return "about_ai"
-            
+        for label, pattern in _CLASSIFIER_PATTERNS:
+            if pattern.search(query_lower):
+                return label
         return "general"
 
     def _handle_greeting(self, query: str, context: Dict) -> Dict:
         """Обработка приветствий"""
-        user_id = context.get("user_id")
-        user_name = self.user_profiles.get(user_id, {}).get("name", "друг")
+        user_name = self._user_name(context)
         
         greetings = [
             f"Привет, {user_name}! Рад тебя видеть!",
@@ -161,9 +280,16 @@ class SmallTalkAgent:
     def _handle_weather(self, query: str, context: Dict) -> Dict:
         """Обработка запросов о погоде"""
         # Получение погоды по умолчанию для Москвы
-        location = self._extract_location(query) or "Москва"
-        weather = self._get_weather(location)
-        
+        location = self._known_city(query) or self._extract_location(query) or "Москва"
+        return self._weather_response(location, self._get_weather(location))
+
+    async def _ahandle_weather(self, query: str, context: Dict) -> Dict:
+        """Асинхронная обработка запросов о погоде"""
+        location = self._known_city(query) or await self._aextract_location(query) or "Москва"
+        return self._weather_response(location, await self._aget_weather(location))
+
+    def _weather_response(self, location: str, weather: Optional[Dict]) -> Dict:
+        """Формирует ответ о погоде"""
         if weather:
             response = (f"Сейчас в {location}: {weather['description']}, "
                        f"температура {weather['temp']}°C. "
@@ -177,66 +303,149 @@ class SmallTalkAgent:
             "mood": "neutral"
         }
 
+    def _known_city(self, query: str) -> Optional[str]:
+        """Находит известный город в запросе без обращения к LLM"""
+        match = _CITY_RE.search(query.lower())
+        return _KNOWN_CITIES[match.group()] if match else None
+
     def _extract_location(self, query: str) -> Optional[str]:
         """Извлекает локацию из запроса"""
-        prompt = f"""Извлеки название города из запроса:
+        key = query.strip().casefold()
+        city = self.location_cache.get(key)
+        if city is None:
+            response = self._generate(self._location_prompt(query), None, response_format="json")
+            city = json.loads(response).get("city") or ""
+            self.location_cache.set(key, city)
+        return city or None
+
+    async def _aextract_location(self, query: str) -> Optional[str]:
+        """Асинхронно извлекает локацию из запроса"""
+        key = query.strip().casefold()
+        city = self.location_cache.get(key)
+        if city is None:
+            response = await self._agenerate(self._location_prompt(query), None, response_format="json")
+            city = json.loads(response).get("city") or ""
+            self.location_cache.set(key, city)
+        return city or None
+
+    def _location_prompt(self, query: str) -> str:
+        """Промпт извлечения города из запроса"""
+        return f"""Извлеки название города из запроса:
         
 Запрос: "{query}"
 
 Если город не указан - верни null. Ответ в JSON формате: {{"city": "название"}}"""
-        
-        response = self.llm.generate(prompt, response_format="json")
-        data = json.loads(response)
-        return data.get("city")
+
+    def _weather_params(self, city: str) -> Dict:
+        """Параметры запроса к OpenWeatherMap"""
+        return {"q": city, "appid": config.WEATHER_API_KEY, "units": "metric", "lang": "ru"}
 
     def _get_weather(self, city: str) -> Optional[Dict]:
-        """Получает текущую погоду через API (заглушка)"""
+        """Получает текущую погоду через API (кешируется на WEATHER_CACHE_TTL)"""
+        key = city.casefold()
+        weather = self.weather_cache.get(key)
+        if weather is not None:
+            return weather
+        
         try:
             # Реальная интеграция с OpenWeatherMap
-            response = requests.get(
-                f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={config.WEATHER_API_KEY}&units=metric&lang=ru"
-            )
-            data = response.json()
-            return {
-                "temp": data["main"]["temp"],
-                "description": data["weather"][0]["description"],
-                "humidity": data["main"]["humidity"]
-            }
-        except:
-            # Заглушка для демо
-            weather_data = {
-                "Москва": {"temp": 18, "description": "легкий дождь", "humidity": 75},
-                "Санкт-Петербург": {"temp": 15, "description": "облачно", "humidity": 80},
-                "Новосибирск": {"temp": 22, "description": "ясно", "humidity": 45}
-            }
-            return weather_data.get(city, {"temp": 20, "description": "ясно", "humidity": 60})
+            response = self.http.get(WEATHER_API_URL, params=self._weather_params(city), timeout=HTTP_TIMEOUT)
+            weather = self._parse_weather(response.json())
+        except (requests.RequestException, KeyError, IndexError, ValueError) as e:
+            self.logger.warning(f"Weather API error: {str(e)}")
+            # Заглушка для демо; не кешируется, чтобы следующий запрос снова обратился к API
+            return _WEATHER_STUB.get(city, _WEATHER_STUB_DEFAULT)
+        
+        self.weather_cache.set(key, weather)
+        return weather
+
+    async def _aget_weather(self, city: str) -> Optional[Dict]:
+        """Асинхронно получает текущую погоду через API (кешируется на WEATHER_CACHE_TTL)"""
+        key = city.casefold()
+        weather = self.weather_cache.get(key)
+        if weather is not None:
+            return weather
+        
+        try:
+            response = await self._get_http().get(WEATHER_API_URL, params=self._weather_params(city))
+            weather = self._parse_weather(response.json())
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            self.logger.warning(f"Weather API error: {str(e)}")
+            return _WEATHER_STUB.get(city, _WEATHER_STUB_DEFAULT)
+        
+        self.weather_cache.set(key, weather)
+        return weather
+
+    def _parse_weather(self, data: Dict) -> Dict:
+        """Извлекает нужные поля из ответа OpenWeatherMap"""
+        return {
+            "temp": data["main"]["temp"],
+            "description": data["weather"][0]["description"],
+            "humidity": data["main"]["humidity"]
+        }
 
     def _handle_news(self, query: str, context: Dict) -> Dict:
         """Обработка запросов о новостях"""
-        news = self._get_news()
+        return self._news_response(self._get_news())
+
+    async def _ahandle_news(self, query: str, context: Dict) -> Dict:
+        """Асинхронная обработка запросов о новостях"""
+        return self._news_response(await self._aget_news())
+
+    def _news_response(self, news: str) -> Dict:
+        """Формирует ответ с новостями"""
         return {
             "response": f"Вот последние новости:\n\n{news}",
             "suggestions": ["Технологии", "Бизнес", "Наука"],
             "mood": "informative"
         }
 
+    def _news_params(self) -> Dict:
+        """Параметры запроса к newsapi"""
+        return {"country": NEWS_COUNTRY, "apiKey": config.NEWS_API_KEY}
+
     def _get_news(self) -> str:
-        """Получает последние новости (заглушка)"""
+        """Получает последние новости (кешируется на NEWS_CACHE_TTL)"""
+        news = self.news_cache.get(NEWS_COUNTRY)
+        if news is not None:
+            return news
+        
         try:
             # Реальная интеграция с newsapi
-            response = requests.get(
-                f"https://newsapi.org/v2/top-headlines?country=ru&apiKey={config.NEWS_API_KEY}"
-            )
-            articles = response.json().get("articles", [])[:3]
-            return "\n".join([f"- {art['title']}" for art in articles])
-        except:
-            # Заглушка для демо
-            return "1. ИИ научился предсказывать погоду с точностью 95%\n2. Компания ТехноКорп запустила новый аналитический модуль\n3. Учёные создали нейросеть для диагностики заболеваний"
+            response = self.http.get(NEWS_API_URL, params=self._news_params(), timeout=HTTP_TIMEOUT)
+            news = self._format_news(response.json())
+        except (requests.RequestException, KeyError, ValueError) as e:
+            self.logger.warning(f"News API error: {str(e)}")
+            # Заглушка для демо; не кешируется
+            return _NEWS_STUB
+        
+        self.news_cache.set(NEWS_COUNTRY, news)
+        return news
+
+    async def _aget_news(self) -> str:
+        """Асинхронно получает последние новости (кешируется на NEWS_CACHE_TTL)"""
+        news = self.news_cache.get(NEWS_COUNTRY)
+        if news is not None:
+            return news
+        
+        try:
+            response = await self._get_http().get(NEWS_API_URL, params=self._news_params())
+            news = self._format_news(response.json())
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            self.logger.warning(f"News API error: {str(e)}")
+            return _NEWS_STUB
+        
+        self.news_cache.set(NEWS_COUNTRY, news)
+        return news
+
+    def _format_news(self, data: Dict) -> str:
+        """Форматирует три первых заголовка"""
+        articles = data.get("articles", [])[:3]
+        return "\n".join([f"- {art['title']}" for art in articles])
 
     def _handle_personal(self, query: str, context: Dict) -> Dict:
         """Ответы на личные вопросы о боте"""
-        user_id = context.get("user_id")
-        user_name = self.user_profiles.get(user_id, {}).get("name", "друг")
+        user_name = self._user_name(context)
         
         if "имя" in query.lower():
             response = f"Меня зовут {self.personality['name']}! А тебя?"
@@ -256,7 +465,15 @@ class SmallTalkAgent:
 
     def _handle_ai_questions(self, query: str, context: Dict) -> Dict:
         """Ответы на вопросы про ИИ"""
-        prompt = f"""Ты эксперт по ИИ. Ответь на вопрос пользователя простым языком:
+        return self._ai_response(self.llm_cache.generate(self._ai_prompt(query), namespace="small_talk|about_ai"))
+
+    async def _ahandle_ai_questions(self, query: str, context: Dict) -> Dict:
+        """Асинхронные ответы на вопросы про ИИ"""
+        return self._ai_response(await self._agenerate(self._ai_prompt(query), "small_talk|about_ai"))
+
+    def _ai_prompt(self, query: str) -> str:
+        """Промпт ответа на вопрос про ИИ"""
+        return f"""Ты эксперт по ИИ. Ответь на вопрос пользователя простым языком:
         
 Вопрос: "{query}"
 
@@ -265,7 +482,9 @@ class SmallTalkAgent:
 - Не длиннее 3 предложений
 - С примерами, если уместно
 """
-        response = self.llm.generate(prompt)
+
+    def _ai_response(self, response: str) -> Dict:
+        """Формирует ответ на вопрос про ИИ"""
         return {
             "response": response,
             "suggestions": ["Как это работает?", "Примеры использования", "Ограничения ИИ"],
@@ -274,10 +493,31 @@ class SmallTalkAgent:
 
     def _handle_general(self, query: str, context: Dict) -> Dict:
         """Обработка общих разговорных запросов"""
+        return self._general_response(
+            self._generate(self._general_prompt(query, context), self._general_namespace(context))
+        )
+
+    async def _ahandle_general(self, query: str, context: Dict) -> Dict:
+        """Асинхронная обработка общих разговорных запросов"""
+        return self._general_response(
+            await self._agenerate(self._general_prompt(query, context), self._general_namespace(context))
+        )
+
+    def _general_namespace(self, context: Dict) -> Optional[str]:
+        """
+        Ответ обращается к пользователю по имени - кеш общих реплик раздельный по пользователям.
+        Имя не уникально, поэтому ключом служит user_id; без него ответ не кешируется
+        """
         user_id = context.get("user_id")
-        user_name = self.user_profiles.get(user_id, {}).get("name", "друг")
+        if not user_id:
+            return None
+        return f"small_talk|general|{user_id}"
+
+    def _general_prompt(self, query: str, context: Dict) -> str:
+        """Промпт ответа на общую реплику"""
+        user_name = self._user_name(context)
         
-        prompt = f"""Ты дружелюбный ИИ-ассистент. Ответь на реплику пользователя:
+        return f"""Ты дружелюбный ИИ-ассистент. Ответь на реплику пользователя:
         
 Пользователь ({user_name}): "{query}"
 
@@ -291,7 +531,9 @@ class SmallTalkAgent:
 - Дружелюбным
 - С элементом лёгкого юмора (если уместно)
 """
-        response = self.llm.generate(prompt)
+
+    def _general_response(self, response: str) -> Dict:
+        """Формирует ответ на общую реплику"""
         return {
             "response": response,
             "suggestions": ["Расскажи шутку", "Что нового?", "Помоги с аналитикой"],
@@ -317,5 +559,11 @@ class SmallTalkAgent:
         self.logger.info(f"Learning from feedback: user={user_id}, feedback={feedback}")
 
     def get_user_profile(self, user_id: str) -> Dict:
-        """Возвращает профиль пользователя"""
-        return self.user_profiles.get(user_id, {})
\ No newline at end of file
+        """Возвращает профиль пользователя (время последнего обращения - в ISO)"""
+        profile = self.user_profiles.get(user_id)
+        if profile is None:
+            return {}
+        
+        result = {key: value for key, value in profile.items() if key != "last_interaction_ns"}
+        result["last_interaction"] = datetime.datetime.fromtimestamp(profile["last_interaction_ns"] / 1e9).isoformat()
+        return result
\ No newline at end of file
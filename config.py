@@ -31,4 +31,40 @@ class Config:
     # Настройки системы
     MAX_RETRIES = int(os.getenv("MAX_RETRIES", 3))
     CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))  # 1 час
-    SQL_EXECUTION_TIMEOUT = int(os.getenv("SQL_EXECUTION_TIMEOUT", 30))
\ No newline at end of file
+    SQL_EXECUTION_TIMEOUT = int(os.getenv("SQL_EXECUTION_TIMEOUT", 30))
+    ERROR_DB_PATH = os.getenv("ERROR_DB_PATH", "errors.db")  # SQLite-журнал ошибок FallbackAgent
+    ERROR_RETENTION = int(os.getenv("ERROR_RETENTION", 3600))  # сколько секунд хранить записи журнала ошибок
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))  # одновременных async-вызовов GigaChat на агента
+    LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 5.0))  # секунд на попытку до перехода к резервной модели
+    GIGACHAT_FALLBACK_MODELS = [m for m in os.getenv("GIGACHAT_FALLBACK_MODELS", "GigaChat").split(",") if m]
+    
+    # Семантический кеш ответов LLM
+    EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+    EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx2.onnx")  # пусто - без ONNX
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 1024))
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+    SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", 3600))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 512))
+    # Нормализация запросов для ключей кеша: сокращение -> полная форма
+    QUERY_ABBREVIATIONS = {
+        "кв": "квартал",
+        "мес": "месяц",
+        "тыс": "тысяч",
+        "млн": "миллионов",
+        "руб": "рублей",
+        "ср": "средний",
+        "кол-во": "количество",
+    }
+    
+    # Кеши агентов (LRU + TTL)
+    ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", 10000))
+    ROUTER_CACHE_TTL = int(os.getenv("ROUTER_CACHE_TTL", 3600))
+    SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", 10000))
+    SQL_CACHE_TTL = int(os.getenv("SQL_CACHE_TTL", 3600))
+    SQL_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SQL_SEMANTIC_CACHE_THRESHOLD", 0.95))  # строже общего: другой SQL дороже промаха
+    CACHE_STATS_LOG_INTERVAL = int(os.getenv("CACHE_STATS_LOG_INTERVAL", 1000))  # обращений между записями hit ratio в лог
+    PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 100000))  # профилей small talk в памяти процесса
+    PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 7 * 24 * 3600))  # неактивный профиль живет неделю
+    
+    # Реестр доступности обработчиков маршрутизатора
+    HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", 5))  # секунд между фоновыми опросами
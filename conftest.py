@@ -0,0 +1 @@
+# Корень репозитория в sys.path для тестов (импорты вида functions.x, services.x)
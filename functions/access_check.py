@@ -1,17 +1,134 @@
 import requests
+import httpx
 import sqlparse
 import re
 import logging
+import asyncio
 from typing import List, Dict, Tuple, Optional
 from config import Config
 from services.monitoring import tracer
+from services.http_session import RETRY_STATUSES, build_session
+from services.llm_cache import ExactCache
 import json
-import time
 from functools import lru_cache
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
 
+# Одновременных запросов к сервису аутентификации при пакетной проверке
+MAX_CONCURRENT_ROLE_LOOKUPS = 32
+ROLES_CACHE_SIZE = 10000
+
+# Имя таблицы: возможно со схемой и в кавычках (schema."Table")
+_TABLE_NAME = r'(?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))*'
+_TABLE_RE = re.compile(rf'\b(?:from|join)\s+({_TABLE_NAME})', re.IGNORECASE)
+
+# Быстрый путь допустим только для "плоского" SQL: скобки (подзапросы, функции, USING),
+# кавычки, комментарии и несколько выражений могут спрятать таблицу от регулярки
+_NOT_FLAT_SQL_RE = re.compile(r"""[()'"`$;]|--|/\*""")
+# Секция FROM - до следующего ключевого слова предложения или конца запроса
+_FROM_CLAUSE_RE = re.compile(
+    r'\bfrom\b(.*?)(?=\b(?:from|select|where|group|having|order|limit|offset|fetch|for|window|union|intersect|except)\b|$)',
+    re.IGNORECASE | re.DOTALL
+)
+# Идентификатор, не совпадающий с ключевым словом (FROM ONLY users, LATERAL и т.п. - не имя таблицы)
+_PLAIN_IDENT = (
+    r'(?!(?:only|lateral|join|inner|left|right|full|cross|natural|outer|on|using|as|tablesample'
+    r'|from|select|where|group|having|order|limit|offset|fetch|for|window|union|intersect|except)\b)\w+'
+)
+_PLAIN_TABLE = rf'{_PLAIN_IDENT}(?:\.{_PLAIN_IDENT})*(?:\s+(?:as\s+)?{_PLAIN_IDENT})?'
+_JOIN_KEYWORD = r'(?:natural\s+)?(?:(?:inner|cross|(?:left|right|full)(?:\s+outer)?)\s+)?join'
+# Секция FROM из одиночных таблиц (с алиасом), соединенных JOIN ... ON без запятых
+_SIMPLE_FROM_RE = re.compile(
+    rf'{_PLAIN_TABLE}(?:\s+{_JOIN_KEYWORD}\s+{_PLAIN_TABLE}(?:\s+on\s+(?:(?!\bjoin\b)[^,])+)?)*',
+    re.IGNORECASE
+)
+
+@lru_cache(maxsize=4096)
+def _extract_tables(sql: str) -> Tuple[str, ...]:
+    """
+    Извлекает таблицы из SQL (кешируется: шаблонные запросы дашбордов повторяются)
+    Простые запросы разбираются одной регуляркой, остальные - через sqlparse
+    """
+    if _is_simple_sql(sql):
+        return tuple(dict.fromkeys(_table_name(name) for name in _TABLE_RE.findall(sql)))
+    return _extract_tables_sqlparse(sql)
+
+def _is_simple_sql(sql: str) -> bool:
+    """
+    Проверяет, что каждая таблица запроса стоит сразу после FROM/JOIN:
+    каждая секция FROM - одиночные таблицы с алиасами, соединенные JOIN
+    """
+    if _NOT_FLAT_SQL_RE.search(sql):
+        return False
+    return all(_SIMPLE_FROM_RE.fullmatch(clause.strip()) for clause in _FROM_CLAUSE_RE.findall(sql))
+
+def _table_name(qualified: str) -> str:
+    """Имя таблицы без схемы и кавычек, в нижнем регистре"""
+    return qualified.rsplit('.', 1)[-1].strip('"').lower()
+
+def _extract_tables_sqlparse(sql: str) -> Tuple[str, ...]:
+    """Извлекает таблицы обходом дерева sqlparse (включая подзапросы и списки через запятую)"""
+    try:
+        parsed = sqlparse.parse(sql)
+        tables = set()
+        
+        if not parsed:
+            return ()
+        
+        def scan(tokens):
+            """Таблицы после FROM; до FROM - только вложенные подзапросы"""
+            from_seen = False
+            for token in tokens:
+                if token.ttype is sqlparse.tokens.Keyword and token.value.lower() == 'from':
+                    from_seen = True
+                elif from_seen:
+                    if token.ttype is sqlparse.tokens.Keyword and token.value.lower().startswith('join'):
+                        # Пропускаем ключевое слово JOIN
+                        continue
+                    find_tables(token)
+                else:
+                    find_subqueries(token)
+        
+        def find_subqueries(token):
+            """Рекурсивно разбирает подзапросы в скобках"""
+            if isinstance(token, sqlparse.sql.Parenthesis):
+                scan(token.tokens)
+            elif token.is_group:
+                for t in token.tokens:
+                    find_subqueries(t)
+        
+        # Функция для рекурсивного поиска таблиц
+        def find_tables(token):
+            if isinstance(token, sqlparse.sql.Identifier):
+                if any(isinstance(t, sqlparse.sql.Parenthesis) for t in token.tokens):
+                    # Подзапрос с алиасом: таблицы внутри скобок, алиас - не таблица
+                    find_subqueries(token)
+                    return
+                # Получаем реальное имя таблицы (без алиасов)
+                name = token.get_real_name()
+                if name:
+                    tables.add(name.lower())
+            elif isinstance(token, sqlparse.sql.IdentifierList):
+                for ident in token.get_identifiers():
+                    find_tables(ident)
+            elif isinstance(token, sqlparse.sql.Parenthesis):
+                scan(token.tokens)
+            elif token.is_group:
+                for t in token.tokens:
+                    find_tables(t)
+        
+        # Ищем в каждом выражении
+        for statement in parsed:
+            scan(statement.tokens)
+        
+        return tuple(tables)
+    
+    except Exception as e:
+        # Неполный список таблиц опаснее пустого: пустой список запрещает доступ
+        logger.warning(f"Ошибка извлечения таблиц: {str(e)}")
+        return ()
+
 class AccessChecker:
     def __init__(self):
         # Настройки сервиса аутентификации
@@ -21,12 +138,21 @@ class AccessChecker:
         
         # Настройки RBAC
         self.access_matrix = self.load_access_matrix()
+        self._index_access_matrix()
         self.max_retries = Config.AUTH_MAX_RETRIES
         self.retry_delay = Config.AUTH_RETRY_DELAY
         
+        # Пул keep-alive соединений к сервису аутентификации; повторы (с экспоненциальной
+        # паузой) только для сетевых сбоев и временных ошибок сервера
+        self.http = build_session(max(self.max_retries - 1, 0), backoff_factor=self.retry_delay)
+        self.http.headers["Authorization"] = f"Bearer {self.auth_token}"
+        self._async_http = None
+        
         # Кеш разрешений
         self.permission_cache = {}
         self.cache_ttl = Config.ACCESS_CACHE_TTL
+        # Роли пользователей живут не дольше ACCESS_CACHE_TTL: отозванные права вступают в силу без перезапуска
+        self._roles_cache = ExactCache(ROLES_CACHE_SIZE, self.cache_ttl, name="access_roles")
 
     def check_access(self, user_id: str, sql_query: str) -> Tuple[bool, Dict]:
         """
@@ -70,13 +196,15 @@ class AccessChecker:
                 # Шаг 3: Проверка доступа для каждой таблицы
                 required_roles = {}
                 has_access = True
+                # Множество ролей один раз на запрос: проверка таблицы - хешированное пересечение
+                user_role_set = frozenset(user_roles)
                 
                 for table in tables:
                     table_roles = self.get_required_roles(table)
                     required_roles[table] = table_roles
                     
                     # Проверяем, есть ли у пользователя хотя бы одна из требуемых ролей
-                    if not any(role in user_roles for role in table_roles):
+                    if user_role_set.isdisjoint(table_roles):
                         result["errors"].append(f"Доступ к таблице '{table}' запрещен")
                         has_access = False
                 
@@ -93,111 +221,127 @@ class AccessChecker:
 
     def extract_tables(self, sql: str) -> List[str]:
         """Извлекает список таблиц из SQL-запроса"""
-        try:
-            # Используем sqlparse для точного парсинга
-            parsed = sqlparse.parse(sql)
-            tables = set()
-            
-            if not parsed:
-                return []
-            
-            # Функция для рекурсивного поиска таблиц
-            def find_tables(token):
-                if isinstance(token, sqlparse.sql.Identifier):
-                    # Получаем реальное имя таблицы (без алиасов)
-                    tables.add(token.get_real_name().lower())
-                elif isinstance(token, sqlparse.sql.IdentifierList):
-                    for ident in token.get_identifiers():
-                        tables.add(ident.get_real_name().lower())
-                elif hasattr(token, 'tokens'):
-                    for t in token.tokens:
-                        find_tables(t)
-            
-            # Ищем в каждом выражении
-            for statement in parsed:
-                # Ищем секции FROM и JOIN
-                from_seen = False
-                for token in statement.tokens:
-                    if token.ttype is sqlparse.tokens.Keyword and token.value.lower() == 'from':
-                        from_seen = True
-                    elif from_seen:
-                        if token.ttype is sqlparse.tokens.Keyword and token.value.lower().startswith('join'):
-                            # Пропускаем ключевое слово JOIN
-                            continue
-                        find_tables(token)
-            
-            return list(tables)
-        
-        except Exception as e:
-            logger.warning(f"Ошибка извлечения таблиц: {str(e)}")
-            # Фолбэк: простая регулярка
-            tables = re.findall(r'\b(?:from|join)\s+([\w\.]+)', sql, re.IGNORECASE)
-            return list(set(table.lower().split('.')[-1] for table in tables))
+        return list(_extract_tables(sql))
 
-    @lru_cache(maxsize=1024)
     def get_user_roles(self, user_id: str) -> List[str]:
-        """Получает роли пользователя из сервиса аутентификации"""
+        """Получает роли пользователя из сервиса аутентификации (кешируется на ACCESS_CACHE_TTL)"""
+        roles = self._roles_cache.get(user_id)
+        if roles is not None:
+            return roles
+        
+        try:
+            response = self.http.get(f"{self.auth_service_url}/users/{user_id}/roles", timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ошибка подключения к сервису прав доступа: {str(e)}")
+            return []
+        return self._roles_from_response(user_id, response)
+
+    async def aget_user_roles(self, user_id: str) -> List[str]:
+        """
+        Асинхронно получает роли пользователя; временные ошибки сервиса
+        повторяются с экспоненциальной паузой, не блокируя event loop
+        """
+        roles = self._roles_cache.get(user_id)
+        if roles is not None:
+            return roles
+        
+        client = self._get_async_http()
         for attempt in range(self.max_retries):
             try:
-                response = requests.get(
-                    f"{self.auth_service_url}/users/{user_id}/roles",
-                    headers={"Authorization": f"Bearer {self.auth_token}"},
-                    timeout=self.timeout
-                )
-                
-                if response.status_code == 200:
-                    return response.json().get("roles", [])
-                
-                # Обработка ошибок HTTP
-                if response.status_code == 404:
-                    logger.warning(f"Пользователь {user_id} не найден")
-                    return []
-                
-                if response.status_code == 401:
-                    logger.error("Ошибка аутентификации в сервисе прав доступа")
-                    return []
-                
+                response = await client.get(f"/users/{user_id}/roles")
+                if response.status_code not in RETRY_STATUSES:
+                    return self._roles_from_response(user_id, response)
                 logger.warning(f"Сервис прав доступа вернул статус {response.status_code}")
-                
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
                 logger.error(f"Ошибка подключения к сервису прав доступа: {str(e)}")
             
             # Повторная попытка после задержки
             if attempt < self.max_retries - 1:
-                time.sleep(self.retry_delay)
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        
+        return []
+
+    async def get_user_roles_many(self, user_ids: List[str]) -> Dict[str, List[str]]:
+        """
+        Получает роли нескольких пользователей конкурентно (для аудита)
+        :param user_ids: Идентификаторы пользователей
+        :return: Словарь user_id -> роли
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROLE_LOOKUPS)
+        
+        async def lookup(user_id: str) -> List[str]:
+            async with semaphore:
+                return await self.aget_user_roles(user_id)
+        
+        unique_ids = list(dict.fromkeys(user_ids))
+        roles = await asyncio.gather(*(lookup(user_id) for user_id in unique_ids))
+        return dict(zip(unique_ids, roles))
+
+    def _get_async_http(self) -> httpx.AsyncClient:
+        """Лениво создает общий async HTTP-клиент сервиса аутентификации"""
+        if self._async_http is None or self._async_http.is_closed:
+            self._async_http = httpx.AsyncClient(
+                base_url=self.auth_service_url,
+                headers={"Authorization": f"Bearer {self.auth_token}"},
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            )
+        return self._async_http
+
+    async def aclose(self):
+        """Закрывает async HTTP-клиент"""
+        if self._async_http is not None and not self._async_http.is_closed:
+            await self._async_http.aclose()
+
+    def _roles_from_response(self, user_id: str, response) -> List[str]:
+        """Извлекает роли из ответа сервиса аутентификации; кешируются только успешные ответы"""
+        if response.status_code == 200:
+            roles = response.json().get("roles", [])
+            self._roles_cache.set(user_id, roles)
+            return roles
         
+        # Обработка ошибок HTTP
+        if response.status_code == 404:
+            logger.warning(f"Пользователь {user_id} не найден")
+        elif response.status_code == 401:
+            logger.error("Ошибка аутентификации в сервисе прав доступа")
+        else:
+            logger.warning(f"Сервис прав доступа вернул статус {response.status_code}")
         return []
 
     def get_required_roles(self, table: str) -> List[str]:
         """Возвращает роли, необходимые для доступа к таблице"""
         # Проверка кеша
-        if table in self.permission_cache:
-            return self.permission_cache[table]
+        roles = self.permission_cache.get(table)
+        if roles is not None:
+            return roles
         
-        # Поиск в матрице доступа
+        # Точное совпадение таблицы - поиск по словарю, затем шаблоны (например, "sales_*")
         table_lower = table.lower()
-        roles = []
-        
-        # Ищем точное совпадение таблицы
-        if table_lower in self.access_matrix:
-            roles = self.access_matrix[table_lower]
-        else:
-            # Ищем по шаблонам (например, "sales_*")
-            for pattern, pattern_roles in self.access_matrix.items():
-                if '*' in pattern:
-                    regex = pattern.replace('*', '.*')
-                    if re.match(regex, table_lower):
-                        roles = pattern_roles
-                        break
+        roles = self._exact_roles.get(table_lower)
+        if not roles:
+            roles = next((pattern_roles for regex, pattern_roles in self._pattern_roles if regex.match(table_lower)), None)
         
         # Если не найдено, используем политику по умолчанию
         if not roles:
-            roles = self.access_matrix.get('default', ['admin'])
+            roles = self._default_roles
         
         # Кешируем результат
         self.permission_cache[table] = roles
         return roles
 
+    def _index_access_matrix(self):
+        """Разделяет матрицу доступа на точные имена и заранее скомпилированные шаблоны"""
+        self._exact_roles = {
+            name: roles for name, roles in self.access_matrix.items()
+            if '*' not in name and name != 'default'
+        }
+        self._pattern_roles = [
+            (re.compile(re.escape(name).replace(r'\*', '.*') + '$'), roles)
+            for name, roles in self.access_matrix.items() if '*' in name
+        ]
+        self._default_roles = self.access_matrix.get('default', ['admin'])
+
     def load_access_matrix(self) -> Dict[str, List[str]]:
         """Загружает матрицу доступа из конфигурации или внешнего источника"""
         # В реальной системе это может загружаться из БД или файла конфигурации
@@ -222,7 +366,8 @@ class AccessChecker:
     def clear_cache(self):
         """Очищает кеш разрешений"""
         self.permission_cache = {}
-        self.get_user_roles.cache_clear()
+        self._roles_cache.clear()
+        _extract_tables.cache_clear()
 
 # Пример использования
 if __name__ == "__main__":
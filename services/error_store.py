@@ -0,0 +1,107 @@
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional
+from config import Config
+
+# Настройка логгера
+logger = logging.getLogger(__name__)
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS errors(
+        id TEXT,
+        pattern TEXT,
+        ts INTEGER,
+        type TEXT,
+        component TEXT,
+        strategy TEXT,
+        resolved INTEGER DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_errors_pattern_ts ON errors(pattern, ts)",
+    "CREATE INDEX IF NOT EXISTS idx_errors_ts ON errors(ts)",
+)
+
+# Устаревшие записи удаляются раз в PRUNE_EVERY вставок
+PRUNE_EVERY = 256
+
+class ErrorStore:
+    def __init__(self, path: str = None, retention: int = None):
+        """
+        Журнал обработанных ошибок в SQLite (WAL): переживает перезапуск
+        и общий для процессов на одной машине
+        :param path: Путь к файлу БД
+        :param retention: Сколько секунд хранить записи (не меньше окна, по которому считаются повторы)
+        """
+        self.path = path or Config.ERROR_DB_PATH
+        self.retention = retention or Config.ERROR_RETENTION
+        self._inserts = 0
+        # Соединение общее для потоков, запись сериализуется блокировкой
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def record(self, error_id: str, pattern: str, ts: int, error_type: str, component: str, strategy: str):
+        """
+        Сохраняет обработанную ошибку
+        :param error_id: ID ошибки
+        :param pattern: Паттерн ошибки (тип и компонент, без времени)
+        :param ts: Время ошибки (unix, секунды)
+        :param error_type: Тип ошибки
+        :param component: Компонент системы
+        :param strategy: Выбранная стратегия восстановления
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO errors(id, pattern, ts, type, component, strategy) VALUES (?, ?, ?, ?, ?, ?)",
+                (error_id, pattern, ts, error_type, component, strategy)
+            )
+            self._inserts += 1
+            if self._inserts % PRUNE_EVERY == 0:
+                self._prune()
+
+    def _prune(self):
+        """Удаляет записи старше окна хранения (вызывается под блокировкой)"""
+        cur = self._db.execute("DELETE FROM errors WHERE ts < ?", (int(time.time()) - self.retention,))
+        if cur.rowcount:
+            logger.info(f"Error store: pruned {cur.rowcount} records older than {self.retention}s")
+
+    def count_since(self, pattern: str, since: int) -> int:
+        """
+        Считает ошибки паттерна начиная с момента since (по индексу)
+        :param pattern: Паттерн ошибки
+        :param since: Начало окна (unix, секунды)
+        :return: Число ошибок
+        """
+        with self._lock:
+            cur = self._db.execute("SELECT COUNT(*) FROM errors WHERE pattern = ? AND ts > ?", (pattern, since))
+            return cur.fetchone()[0]
+
+    def close(self):
+        """Закрывает соединение с БД"""
+        with self._lock:
+            self._db.close()
+
+# Общий журнал процесса: одно соединение с БД на все экземпляры FallbackAgent
+_error_store: Optional[ErrorStore] = None
+_error_store_lock = threading.Lock()
+
+def get_error_store(retention: int = None) -> ErrorStore:
+    """
+    Возвращает общий журнал ошибок (закрывается при завершении процесса)
+    :param retention: Минимальное время хранения записей, нужное вызывающему (секунд)
+    :return: Журнал ошибок
+    """
+    global _error_store
+    with _error_store_lock:
+        if _error_store is None:
+            _error_store = ErrorStore(retention=retention)
+            atexit.register(_error_store.close)
+        elif retention and retention > _error_store.retention:
+            _error_store.retention = retention
+    return _error_store
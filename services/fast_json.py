@@ -0,0 +1,20 @@
+import json
+
+# orjson быстрее stdlib json в разы; без него - совместимый фолбэк.
+# Ошибки разбора в обоих случаях - подклассы json.JSONDecodeError
+try:
+    import orjson
+
+    def json_loads(data):
+        """Разбирает JSON (str или bytes)"""
+        return orjson.loads(data)
+
+    def json_dumps(obj) -> str:
+        """Компактная сериализация в JSON без экранирования не-ASCII символов"""
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> str:
+        """Компактная сериализация в JSON без экранирования не-ASCII символов"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,59 @@
+import atexit
+import logging
+import threading
+from typing import Optional
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Настройка логгера
+logger = logging.getLogger(__name__)
+
+# Временные ошибки сервера, которые имеет смысл повторить
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Общий httpx-клиент процесса: агенты создаются на каждый запрос, пул соединений - один
+_http_client: Optional[httpx.Client] = None
+_http_client_lock = threading.Lock()
+
+def build_session(retries: int, backoff_factor: float = 0.2, pool_size: int = 32) -> requests.Session:
+    """
+    Создает HTTP-сессию с пулом keep-alive соединений и повторами временных ошибок
+    :param retries: Число повторов после первой попытки
+    :param backoff_factor: Базовая задержка экспоненциальной паузы между повторами (сек)
+    :param pool_size: Размер пула соединений на хост
+    :return: Сессия requests
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_http_client() -> httpx.Client:
+    """
+    Возвращает общий синхронный httpx-клиент с пулом keep-alive соединений
+    (Jira, Slack, погода); закрывается при завершении процесса
+    :return: Клиент httpx
+    """
+    global _http_client
+    client = _http_client
+    if client is None or client.is_closed:
+        with _http_client_lock:
+            client = _http_client
+            if client is None or client.is_closed:
+                client = _http_client = httpx.Client(
+                    timeout=5.0,
+                    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+                )
+                atexit.register(client.close)
+                logger.info("Created shared HTTP client")
+    return client
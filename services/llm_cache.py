@@ -0,0 +1,388 @@
+import logging
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from config import Config
+
+# Настройка логгера
+logger = logging.getLogger(__name__)
+
+class ExactCache:
+    """LRU-кеш ответов по точному совпадению ключа (с TTL и счетчиками попаданий)"""
+    def __init__(self, maxsize: int = 1024, ttl: int = None, name: str = "exact"):
+        self.maxsize = maxsize
+        self.ttl = ttl or Config.SEMANTIC_CACHE_TTL
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Кеш общий для потоков (sync-агенты, to_thread, executor) - операции с OrderedDict под блокировкой
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(namespace: str, prompt: str) -> str:
+        """Формирует ключ кеша"""
+        return hashlib.blake2b(f"{namespace}\0{prompt}".encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str):
+        """Возвращает значение или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(False)
+                return None
+            expire, response = entry
+            if expire <= time.time():
+                del self._entries[key]
+                self._count(False)
+                return None
+            self._entries.move_to_end(key)
+            self._count(True)
+            return response
+
+    def _count(self, hit: bool):
+        """Учитывает обращение и периодически пишет долю попаданий в лог (вызывается под блокировкой)"""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if (self.hits + self.misses) % Config.CACHE_STATS_LOG_INTERVAL == 0:
+            logger.info(f"{self.name} cache: hit ratio {self.hit_ratio:.2%} ({self.hits}/{self.hits + self.misses}), size {len(self._entries)}")
+
+    @property
+    def hit_ratio(self) -> float:
+        """Доля попаданий"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set(self, key: str, response):
+        """Сохраняет значение"""
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, response)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Очищает кеш и счетчики"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+# Общий экземпляр для всех агентов
+_exact_cache: Optional[ExactCache] = None
+
+def get_exact_cache() -> ExactCache:
+    """Возвращает общий LRU-кеш точных совпадений"""
+    global _exact_cache
+    if _exact_cache is None:
+        _exact_cache = ExactCache()
+    return _exact_cache
+
+async def astream_llm(llm, prompt: str, **kwargs) -> AsyncIterator[str]:
+    """Потоковый вызов LLM с фолбэком на синхронный stream и обычный generate"""
+    if hasattr(llm, "astream"):
+        async for chunk in llm.astream(prompt, **kwargs):
+            yield _chunk_text(chunk)
+    elif hasattr(llm, "stream"):
+        # Синхронный генератор читаем в отдельном потоке, не блокируя event loop
+        chunks = await asyncio.to_thread(llm.stream, prompt, **kwargs)
+        done = object()
+        while (chunk := await asyncio.to_thread(next, chunks, done)) is not done:
+            yield _chunk_text(chunk)
+    elif hasattr(llm, "agenerate"):
+        yield await llm.agenerate(prompt, **kwargs)
+    else:
+        yield await asyncio.to_thread(llm.generate, prompt, **kwargs)
+
+def _chunk_text(chunk) -> str:
+    """Извлекает текст из фрагмента потока (строка или сообщение с content)"""
+    return chunk if isinstance(chunk, str) else getattr(chunk, "content", str(chunk))
+
+class _OnnxEncoder:
+    """int8-квантованная модель эмбеддингов на ONNX Runtime с интерфейсом SentenceTransformer.encode"""
+    def __init__(self, model_name: str, onnx_file: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        subfolder, file_name = os.path.split(onnx_file)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_name,
+            subfolder=subfolder,
+            file_name=file_name,
+            provider="CPUExecutionProvider"
+        )
+
+    def encode(self, texts, normalize_embeddings: bool = True) -> np.ndarray:
+        """Вычисляет эмбеддинги строки или списка строк (mean pooling)"""
+        single = isinstance(texts, str)
+        batch = self.tokenizer([texts] if single else list(texts), padding=True, truncation=True, return_tensors="np")
+        hidden = np.asarray(self.model(**batch).last_hidden_state, dtype=np.float32)
+
+        # Усредняем токены без учета паддинга
+        mask = batch["attention_mask"][..., None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors[0] if single else vectors
+
+class _CacheBucket:
+    """Хранилище векторов и ответов одного пространства имен"""
+    def __init__(self, dim: int):
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.expires = np.empty(0, dtype=np.float64)
+        self.responses: List[str] = []
+
+    def purge(self, now: float, max_entries: int):
+        """Удаляет просроченные записи и ограничивает размер"""
+        keep = self.expires > now
+        if not keep.all():
+            self.vectors = self.vectors[keep]
+            self.expires = self.expires[keep]
+            self.responses = [r for r, k in zip(self.responses, keep) if k]
+
+        # Вытесняем самые старые записи
+        overflow = len(self.responses) - max_entries
+        if overflow > 0:
+            self.vectors = self.vectors[overflow:]
+            self.expires = self.expires[overflow:]
+            self.responses = self.responses[overflow:]
+
+class SemanticCache:
+    def __init__(
+        self,
+        llm,
+        threshold: float = None,
+        ttl: int = None,
+        max_entries: int = None,
+        model_name: str = None,
+        exact_cache: ExactCache = None
+    ):
+        """
+        Обертка над LLM, переиспользующая ответы на семантически близкие промпты
+        :param llm: Модель с методом generate(prompt, **kwargs)
+        :param threshold: Минимальное косинусное сходство для попадания в кеш
+        :param ttl: Время жизни записи в секундах
+        :param max_entries: Максимум записей в одном пространстве имен
+        :param model_name: Модель sentence-transformers для эмбеддингов
+        :param exact_cache: LRU-кеш точных совпадений (по умолчанию общий)
+        """
+        self.llm = llm
+        self.threshold = threshold if threshold is not None else Config.SEMANTIC_CACHE_THRESHOLD
+        self.ttl = ttl or Config.SEMANTIC_CACHE_TTL
+        self.max_entries = max_entries or Config.SEMANTIC_CACHE_MAX_ENTRIES
+        self.model_name = model_name or Config.EMBEDDING_MODEL
+        self.exact_cache = exact_cache or get_exact_cache()
+        self._encoder = None
+        self._encoder_failed = False
+        # LRU эмбеддингов: одинаковые промпты не кодируются повторно
+        self._embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._buckets: Dict[str, _CacheBucket] = {}
+        # Защищает LRU эмбеддингов и корзины: agenerate работает через to_thread
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def generate(self, prompt: str, namespace: str = "default", **kwargs) -> str:
+        """
+        Возвращает ответ из кеша или вызывает LLM
+        :param prompt: Промпт для LLM
+        :param namespace: Пространство имен (тип анализа, сигнатура данных),
+            промпты из разных пространств не сопоставляются
+        :param kwargs: Дополнительные параметры для llm.generate
+        :return: Ответ LLM
+        """
+        namespace = self._full_namespace(namespace, kwargs)
+        cached, exact_key, vector = self._find(prompt, namespace)
+        if cached is not None:
+            return cached
+
+        response = self.llm.generate(prompt, **kwargs)
+        self._store(namespace, exact_key, vector, response)
+        return response
+
+    async def agenerate(self, prompt: str, namespace: str = "default", **kwargs) -> str:
+        """
+        Асинхронный вариант generate
+        Использует llm.agenerate, если модель его поддерживает, иначе
+        выполняет синхронный вызов в отдельном потоке
+        """
+        namespace = self._full_namespace(namespace, kwargs)
+        cached, exact_key, vector = await asyncio.to_thread(self._find, prompt, namespace)
+        if cached is not None:
+            return cached
+
+        if hasattr(self.llm, "agenerate"):
+            response = await self.llm.agenerate(prompt, **kwargs)
+        else:
+            response = await asyncio.to_thread(self.llm.generate, prompt, **kwargs)
+        self._store(namespace, exact_key, vector, response)
+        return response
+
+    async def astream(self, prompt: str, namespace: str = "default", **kwargs) -> AsyncIterator[str]:
+        """
+        Потоковый вариант agenerate: отдает фрагменты ответа по мере генерации
+        При попадании в кеш ответ отдается одним фрагментом, после завершения
+        потока полный ответ сохраняется в кеш
+        """
+        namespace = self._full_namespace(namespace, kwargs)
+        cached, exact_key, vector = await asyncio.to_thread(self._find, prompt, namespace)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        async for chunk in astream_llm(self.llm, prompt, **kwargs):
+            parts.append(chunk)
+            yield chunk
+        self._store(namespace, exact_key, vector, "".join(parts))
+
+    def lookup(self, text: str, namespace: str = "default"):
+        """
+        Ищет значение, сохраненное для того же или семантически близкого текста, без вызова LLM
+        :param text: Текст-ключ (например, нормализованный запрос)
+        :param namespace: Пространство имен
+        :return: Сохраненное значение или None
+        """
+        cached, _, _ = self._find(text, namespace)
+        return cached
+
+    def remember(self, text: str, value, namespace: str = "default"):
+        """
+        Сохраняет произвольное значение для текста (например, проверенный результат, а не сырой ответ LLM)
+        :param text: Текст-ключ
+        :param value: Значение
+        :param namespace: Пространство имен
+        """
+        self._store(namespace, self.exact_cache.make_key(namespace, text), self._embed(text), value)
+
+    def _full_namespace(self, namespace: str, kwargs: dict) -> str:
+        """Добавляет параметры вызова LLM к пространству имен"""
+        if kwargs:
+            return f"{namespace}|{sorted(kwargs.items())}"
+        return namespace
+
+    def _find(self, prompt: str, namespace: str) -> Tuple[Optional[str], str, Optional[np.ndarray]]:
+        """Ищет ответ в кеше: сначала точное совпадение, затем семантическое"""
+        # Точное совпадение проверяется до вычисления эмбеддинга
+        exact_key = self.exact_cache.make_key(namespace, prompt)
+        cached = self.exact_cache.get(exact_key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached, exact_key, None
+
+        vector = self._embed(prompt)
+        if vector is not None:
+            cached = self._lookup(namespace, vector)
+            if cached is not None:
+                self.stats["hits"] += 1
+                return cached, exact_key, vector
+
+        self.stats["misses"] += 1
+        return None, exact_key, vector
+
+    def _store(self, namespace: str, exact_key: str, vector: Optional[np.ndarray], response: str):
+        """Сохраняет ответ LLM во все уровни кеша"""
+        self.exact_cache.set(exact_key, response)
+        if vector is not None:
+            self._insert(namespace, vector, response)
+
+    def _get_encoder(self):
+        """Лениво загружает модель эмбеддингов: сначала квантованную ONNX, затем PyTorch"""
+        if self._encoder is None and not self._encoder_failed and Config.EMBEDDING_ONNX_FILE:
+            try:
+                self._encoder = _OnnxEncoder(self.model_name, Config.EMBEDDING_ONNX_FILE)
+            except Exception as e:
+                logger.info(f"ONNX encoder unavailable, using sentence-transformers: {str(e)}")
+
+        if self._encoder is None and not self._encoder_failed:
+            try:
+                from sentence_transformers import SentenceTransformer
+                self._encoder = SentenceTransformer(self.model_name)
+            except Exception as e:
+                # Без модели кеш работает как прозрачная обертка
+                logger.warning(f"Semantic cache disabled: {str(e)}")
+                self._encoder_failed = True
+        return self._encoder
+
+    def embed(self, texts: List[str]) -> Optional[np.ndarray]:
+        """
+        Вычисляет L2-нормализованные эмбеддинги той же моделью, что и кеш
+        :param texts: Тексты для кодирования
+        :return: Матрица (len(texts), dim) или None, если модель недоступна
+        """
+        vectors = self._embed_many(texts)
+        return None if vectors is None else np.vstack(vectors)
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Вычисляет L2-нормализованный эмбеддинг текста"""
+        vectors = self._embed_many([text])
+        return None if vectors is None else vectors[0]
+
+    def _embed_many(self, texts: List[str]) -> Optional[List[np.ndarray]]:
+        """Вычисляет эмбеддинги пачки текстов одним вызовом модели, переиспользуя LRU"""
+        encoder = self._get_encoder()
+        if encoder is None:
+            return None
+
+        keys = [hashlib.blake2b(text.encode(), digest_size=16).hexdigest() for text in texts]
+        with self._lock:
+            found = {key: self._embeddings[key] for key in keys if key in self._embeddings}
+
+        # Модель вызывается вне блокировки, чтобы не сериализовать кодирование
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            encoded = encoder.encode(list(missing.values()), normalize_embeddings=True)
+            for key, vector in zip(missing, encoded):
+                found[key] = np.asarray(vector, dtype=np.float32)
+
+        with self._lock:
+            for key in keys:
+                self._embeddings[key] = found[key]
+                self._embeddings.move_to_end(key)
+            while len(self._embeddings) > Config.EMBEDDING_CACHE_SIZE:
+                self._embeddings.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def _lookup(self, namespace: str, vector: np.ndarray) -> Optional[str]:
+        """Ищет ближайший сохраненный промпт"""
+        with self._lock:
+            bucket = self._buckets.get(namespace)
+            if bucket is None or not bucket.responses:
+                return None
+
+            # Векторы нормализованы - скалярное произведение равно косинусу
+            scores = bucket.vectors @ vector
+            scores[bucket.expires <= time.time()] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return bucket.responses[best]
+            return None
+
+    def _insert(self, namespace: str, vector: np.ndarray, response: str):
+        """Сохраняет ответ в кеш"""
+        with self._lock:
+            bucket = self._buckets.get(namespace)
+            if bucket is None:
+                bucket = self._buckets[namespace] = _CacheBucket(vector.shape[0])
+
+            now = time.time()
+            bucket.vectors = np.vstack([bucket.vectors, vector[None, :]])
+            bucket.expires = np.append(bucket.expires, now + self.ttl)
+            bucket.responses.append(response)
+            bucket.purge(now, self.max_entries)
+
+    def clear(self):
+        """Очищает кеш"""
+        with self._lock:
+            self._buckets = {}
+        self.stats = {"hits": 0, "misses": 0}
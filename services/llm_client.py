@@ -0,0 +1,37 @@
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+from gigachain import GigaChatModel
+from config import Config
+
+# Настройка логгера
+logger = logging.getLogger(__name__)
+
+# Общие клиенты GigaChat по набору параметров (модель, температура, max_tokens)
+_clients: Dict[Tuple[str, float, Optional[int]], GigaChatModel] = {}
+_clients_lock = threading.Lock()
+
+def get_llm(temperature: float = 0.3, model: str = "GigaChat-Pro", max_tokens: int = None) -> GigaChatModel:
+    """
+    Возвращает общий клиент GigaChat: агенты с одинаковыми параметрами
+    используют одно подключение и одну авторизацию
+    :param temperature: Температура генерации
+    :param model: Название модели
+    :param max_tokens: Ограничение длины ответа (None - по умолчанию модели)
+    :return: Клиент GigaChat
+    """
+    key = (model, temperature, max_tokens)
+    llm = _clients.get(key)
+    if llm is None:
+        with _clients_lock:
+            llm = _clients.get(key)
+            if llm is None:
+                kwargs = {"max_tokens": max_tokens} if max_tokens else {}
+                llm = _clients[key] = GigaChatModel(
+                    model=model,
+                    temperature=temperature,
+                    api_key=Config.GIGACHAT_API_KEY,
+                    **kwargs
+                )
+                logger.info(f"Created shared GigaChat client: {model}, temperature={temperature}, max_tokens={max_tokens}")
+    return llm
@@ -0,0 +1,80 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List
+from gigachain import GigaChatModel
+from config import Config
+
+# Настройка логгера
+logger = logging.getLogger(__name__)
+
+class FallbackLLM:
+    def __init__(self, models: List, timeout: float = None, monitoring=None):
+        """
+        Цепочка моделей с ограничением времени ответа: при таймауте или
+        ошибке запрос уходит следующей модели
+        :param models: Модели с методом generate(prompt, **kwargs), основная - первая
+        :param timeout: Время ожидания одной модели в секундах
+        :param monitoring: MonitoringService для метрик переключений (опционально)
+        """
+        self.models = models
+        self.timeout = timeout or Config.LLM_TIMEOUT
+        self.monitoring = monitoring
+        self.primary_healthy = True
+        self.stats = {"fallbacks": 0, "timeouts": 0}
+        # Зависший вызов продолжает занимать поток, поэтому пул с запасом
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(models), thread_name_prefix="fallback_llm")
+
+    def generate(self, prompt: str, **kwargs) -> str:
+        """
+        Генерирует ответ первой моделью, уложившейся в таймаут
+        :param prompt: Промпт для LLM
+        :param kwargs: Дополнительные параметры для generate
+        :return: Ответ LLM
+        """
+        last_error = None
+        for position, model in enumerate(self.models):
+            try:
+                response = self._executor.submit(model.generate, prompt, **kwargs).result(timeout=self.timeout)
+            except FutureTimeoutError:
+                self.stats["timeouts"] += 1
+                last_error = TimeoutError(f"{self._model_name(model)} did not respond in {self.timeout}s")
+            except Exception as e:
+                last_error = e
+            else:
+                if position == 0:
+                    self.primary_healthy = True
+                return response
+            
+            if position == 0:
+                self.primary_healthy = False
+            self._record_fallback(model, last_error)
+        
+        raise last_error
+
+    def _record_fallback(self, model, error: Exception):
+        """Логирует переход к следующей модели"""
+        self.stats["fallbacks"] += 1
+        logger.warning(f"LLM fallback from {self._model_name(model)}: {str(error)}")
+        if self.monitoring is not None:
+            self.monitoring.record_metric("llm", "fallback", 1, tags={"model": self._model_name(model)})
+
+    @staticmethod
+    def _model_name(model) -> str:
+        """Название модели для логов"""
+        return getattr(model, "model", type(model).__name__)
+
+def build_fallback_llm(model: str, temperature: float, **kwargs) -> FallbackLLM:
+    """
+    Создает основную модель GigaChat и резервные из Config.GIGACHAT_FALLBACK_MODELS
+    с теми же параметрами
+    :param model: Основная модель
+    :param temperature: Температура генерации
+    :param kwargs: Дополнительные параметры GigaChatModel
+    :return: FallbackLLM
+    """
+    names = [model] + [name for name in Config.GIGACHAT_FALLBACK_MODELS if name != model]
+    models = [
+        GigaChatModel(model=name, temperature=temperature, api_key=Config.GIGACHAT_API_KEY, **kwargs)
+        for name in names
+    ]
+    return FallbackLLM(models)
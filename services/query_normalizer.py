@@ -0,0 +1,18 @@
+import re
+from config import Config
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Сокращения как отдельные слова (с точкой или без): "за 1 кв." -> "за 1 квартал"
+_ABBREVIATION_RE = re.compile(
+    r"(?<!\w)(" + "|".join(map(re.escape, Config.QUERY_ABBREVIATIONS)) + r")(?!\w)\.?"
+)
+
+def normalize_query(query: str) -> str:
+    """
+    Приводит запрос к канонической форме для ключей кеша:
+    нижний регистр, одиночные пробелы, раскрытые сокращения
+    :param query: Запрос пользователя
+    :return: Нормализованный запрос
+    """
+    query = _WHITESPACE_RE.sub(" ", query.casefold()).strip()
+    return _ABBREVIATION_RE.sub(lambda m: Config.QUERY_ABBREVIATIONS[m.group(1)], query)
@@ -0,0 +1,40 @@
+import pytest
+
+from functions.access_check import _extract_tables, _is_simple_sql
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT u.password FROM sales /* x */, users u",
+    'SELECT * FROM sales "s", users',
+    "SELECT * FROM sales AS s(a, b), users",
+    "SELECT * FROM sales s, users u",
+    "SELECT * FROM sales s JOIN orders o ON s.id = o.id, users",
+    "SELECT * FROM ONLY users",
+    "SELECT * FROM sales -- x\n, users",
+    "SELECT * FROM sales WHERE id IN (SELECT id FROM users)",
+])
+def test_hidden_tables_are_not_missed(sql):
+    """Запросы, где таблица не стоит сразу после FROM/JOIN, не идут быстрым путем"""
+    assert not _is_simple_sql(sql)
+    assert "users" in _extract_tables(sql)
+
+
+@pytest.mark.parametrize("sql, tables", [
+    ("SELECT c.name, s.amount FROM customers c JOIN sales s ON s.customer_id = c.id WHERE s.amount > 10",
+     ("customers", "sales")),
+    ("select * from public.sales as s left outer join report_q1 r on r.id = s.id order by s.id, r.id",
+     ("sales", "report_q1")),
+    ("SELECT * FROM sales", ("sales",)),
+])
+def test_simple_queries_use_fast_path(sql, tables):
+    assert _is_simple_sql(sql)
+    assert _extract_tables(sql) == tables
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT (SELECT max(id) FROM users) AS m FROM sales",
+    "SELECT * FROM (SELECT * FROM users) u",
+    "WITH x AS (SELECT * FROM users) SELECT * FROM x",
+])
+def test_subqueries_are_scanned(sql):
+    assert "users" in _extract_tables(sql)